@@ -0,0 +1,246 @@
+import json
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Literal
+
+import numpy as np
+import torch
+from pykeen.models import ComplEx, DistMult, SimplE, TransE
+
+from batch_prediction import MEMORY_BUDGET, TOP_K, TargetSide, get_entity_representation_size, predict_targets
+from compute_predicate_metrics import get_trained_models
+from triple_store import P, S, get_store_dir, open_triple_store
+
+AnnMetric = Literal['inner_product', 'l2']
+
+# Number of inverted lists that are scanned per query
+NUM_PROBES = 16
+
+
+def main():
+    trained_models = get_trained_models()
+    test_triples = open_triple_store(get_store_dir(32))['test']
+
+    # Evaluate recall and latency on a sample of test (s, p, ?) patterns
+    rng = np.random.default_rng(42)
+    sample = rng.choice(test_triples.shape[1], size=min(1000, test_triples.shape[1]), replace=False)
+    queries = np.stack([test_triples[S][sample], test_triples[P][sample]], axis=1).astype(np.int64)
+
+    for model_name, result in trained_models.items():
+        model = result['model'].eval()
+        index_dir = Path(f'embeddings/dim_32/{model_name}/ann_index')
+
+        print(f'[X] Building ANN index for {model_name}')
+        start = timer()
+        ann_index = build_ann_index(model)
+        save_ann_index(ann_index, index_dir)
+        print(f'[X] Built {len(ann_index["centroids"])} inverted lists in {timer() - start:.1f}s')
+
+        start = timer()
+        exact_ids, _ = predict_targets(model, 'tail', queries)
+        exact_time = timer() - start
+
+        for num_probes in (4, 16, 64):
+            start = timer()
+            ann_ids, _ = predict_targets_ann(model, ann_index, 'tail', queries, num_probes=num_probes)
+            ann_time = timer() - start
+
+            print(f'  {model_name} nprobe={num_probes:<3} recall@{TOP_K}={compute_recall_at_k(ann_ids, exact_ids):.3f} '
+                  f'ann={1000 * ann_time / len(queries):.2f}ms/query exact={1000 * exact_time / len(queries):.2f}ms/query')
+
+
+def get_ann_metric(model) -> AnnMetric:
+    return 'l2' if isinstance(model, TransE) else 'inner_product'
+
+
+def get_entity_vectors(model):
+    # Real-valued entity vectors v, such that each model's score is <q, v> or -||q - v||
+    with torch.inference_mode():
+        if isinstance(model, ComplEx):
+            entities = model.entity_representations[0](indices=None)
+            vectors = torch.cat([entities.real, entities.imag], dim=-1)
+        elif isinstance(model, SimplE):
+            vectors = torch.cat([representation(indices=None) for representation in model.entity_representations], dim=-1)
+        elif isinstance(model, (DistMult, TransE)):
+            vectors = model.entity_representations[0](indices=None)
+        else:
+            raise ValueError(f'ANN retrieval is not supported for {type(model).__name__}')
+
+    return vectors.detach().cpu().numpy().astype(np.float32)
+
+
+def get_query_vectors(model, side: TargetSide, queries):
+    queries = torch.as_tensor(np.asarray(queries, dtype=np.int64), device=model.device)
+    if side == 'tail':
+        entities, relations = queries[:, 0], queries[:, 1]
+    else:
+        relations, entities = queries[:, 0], queries[:, 1]
+
+    with torch.inference_mode():
+        e = [representation(indices=entities) for representation in model.entity_representations]
+        r = [representation(indices=relations) for representation in model.relation_representations]
+
+        if isinstance(model, ComplEx):
+            # Re(<h, r, conj(t)>) as real inner product over [Re, Im] parts
+            if side == 'tail':
+                q = e[0] * r[0]
+                vectors = torch.cat([q.real, q.imag], dim=-1)
+            else:
+                q = r[0] * torch.conj(e[0])
+                vectors = torch.cat([q.real, -q.imag], dim=-1)
+        elif isinstance(model, SimplE):
+            # 0.5 * (<h_0, r_0, t_0> + <t_1, r_1, h_1>) against entity vectors [e_0, e_1],
+            # which has the same form for both sides
+            vectors = 0.5 * torch.cat([e[0] * r[0], e[1] * r[1]], dim=-1)
+        elif isinstance(model, DistMult):
+            vectors = e[0] * r[0]
+        elif isinstance(model, TransE):
+            vectors = e[0] + r[0] if side == 'tail' else e[0] - r[0]
+        else:
+            raise ValueError(f'ANN retrieval is not supported for {type(model).__name__}')
+
+    return vectors.detach().cpu().numpy().astype(np.float32)
+
+
+# Inverted file (IVF) index: entity vectors are clustered with k-means and every
+# entity is stored in the list of its closest centroid
+def build_ann_index(model, num_lists=None, num_iterations=10, sample_size=200_000, seed=42):
+    vectors = get_entity_vectors(model)
+    metric = get_ann_metric(model)
+    num_lists = num_lists or max(1, int(np.sqrt(len(vectors))))
+
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=min(num_lists, len(sample)), replace=False)].copy()
+
+    for _ in range(num_iterations):
+        assignment = _assign_to_centroids(sample, centroids, metric)
+        counts = np.bincount(assignment, minlength=len(centroids))
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+
+        # Keep empty clusters at their previous position
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+    assignment = _assign_to_centroids(vectors, centroids, metric)
+    entity_ids = np.argsort(assignment, kind='stable').astype(np.int32)
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+
+    return {
+        'metric': metric,
+        'centroids': centroids,
+        'offsets': offsets,
+        'entity_ids': entity_ids,
+    }
+
+
+def _assign_to_centroids(vectors, centroids, metric: AnnMetric, chunk_size=65_536):
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        assignment[start:start + chunk_size] = _score_centroids(chunk, centroids, metric).argmax(axis=1)
+    return assignment
+
+
+def _score_centroids(queries, centroids, metric: AnnMetric):
+    if metric == 'inner_product':
+        return queries @ centroids.T
+
+    # Negative squared L2 distance without the query norm, which is constant per query
+    return 2 * queries @ centroids.T - (centroids ** 2).sum(axis=1)
+
+
+def save_ann_index(ann_index, index_dir):
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    for name in ('centroids', 'offsets', 'entity_ids'):
+        np.save(index_dir / f'{name}.npy', ann_index[name])
+    with open(index_dir / 'metadata.json', 'w') as metadata_file:
+        json.dump({'metric': ann_index['metric'], 'num_lists': len(ann_index['centroids'])}, metadata_file, indent=2)
+
+
+def load_ann_index(index_dir):
+    index_dir = Path(index_dir)
+    with open(index_dir / 'metadata.json') as metadata_file:
+        metadata = json.load(metadata_file)
+
+    return {
+        'metric': metadata['metric'],
+        **{name: np.load(index_dir / f'{name}.npy', mmap_mode='r') for name in ('centroids', 'offsets', 'entity_ids')}
+    }
+
+
+# Retrieves candidates from the num_probes closest inverted lists of every query and re-scores them exactly with the
+# model, returns the same arrays as predict_targets. Queries are scored in chunks grouped by relation, every query
+# against its own padded candidate list. Queries whose lists hold fewer than top_k candidates are padded with id -1
+# and score -inf, since id 0 is a real entity.
+def predict_targets_ann(model, ann_index, side: TargetSide, queries, top_k: int = TOP_K, num_probes: int = NUM_PROBES,
+                        memory_budget: int = MEMORY_BUDGET):
+    queries = np.asarray(queries, dtype=np.int64)
+    centroids = np.asarray(ann_index['centroids'])
+    offsets = np.asarray(ann_index['offsets'])
+    entity_ids = ann_index['entity_ids']
+
+    num_probes = min(num_probes, len(centroids))
+    centroid_scores = _score_centroids(get_query_vectors(model, side, queries), centroids, ann_index['metric'])
+    probes = np.argpartition(-centroid_scores, num_probes - 1, axis=1)[:, :num_probes]
+    list_lengths = offsets[probes + 1] - offsets[probes]
+    num_candidates = list_lengths.sum(axis=1)
+
+    top_ids = np.full((len(queries), top_k), -1, dtype=np.int32)
+    top_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+
+    # Like predict_targets, consecutive chunks share relation embeddings. Every candidate costs about one entity
+    # representation and one score.
+    relation_column = 0 if side == 'head' else 1
+    order = np.argsort(queries[:, relation_column], kind='stable')
+    bytes_per_query = max(1, int(num_candidates.max(initial=0))) * (get_entity_representation_size(model) + 1) * 4
+    chunk_size = max(1, memory_budget // bytes_per_query)
+
+    with torch.inference_mode():
+        for start in range(0, len(queries), chunk_size):
+            chunk = order[start:start + chunk_size]
+            width = int(num_candidates[chunk].max())
+            if width == 0:
+                continue
+
+            # Gather the probed lists of every query into one row, padded with entity 0 and masked afterwards
+            starts = offsets[probes[chunk]].reshape(-1)
+            lengths = list_lengths[chunk].reshape(-1)
+            positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+            valid = np.arange(width) < num_candidates[chunk][:, None]
+            candidates = np.zeros((len(chunk), width), dtype=np.int64)
+            candidates[valid] = entity_ids[positions]
+
+            batch = torch.as_tensor(queries[chunk], device=model.device)
+            candidate_tensor = torch.as_tensor(candidates, device=model.device)
+            if side == 'tail':
+                scores = model.score_t(batch, tails=candidate_tensor)
+            else:
+                scores = model.score_h(batch, heads=candidate_tensor)
+            scores[~torch.as_tensor(valid, device=model.device)] = -float('inf')
+
+            k = min(top_k, width)
+            best_scores, best = torch.topk(scores, k=k, dim=1)
+            best_ids = torch.gather(candidate_tensor, 1, best).cpu().numpy()
+            best_ids[np.arange(k) >= num_candidates[chunk][:, None]] = -1
+
+            top_ids[chunk, :k] = best_ids
+            top_scores[chunk, :k] = best_scores.cpu().numpy()
+
+    return top_ids, top_scores
+
+
+# Fraction of the exact top k entities that were also retrieved by the approximate search, padded ids of
+# either side are ignored
+def compute_recall_at_k(approximate_ids, exact_ids):
+    hits = [len(np.intersect1d(approximate[approximate >= 0], exact[exact >= 0]))
+            for approximate, exact in zip(approximate_ids, exact_ids)]
+    return np.sum(hits) / max(1, np.sum(np.asarray(exact_ids) >= 0))
+
+
+if __name__ == '__main__':
+    main()
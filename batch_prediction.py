@@ -0,0 +1,121 @@
+from typing import Literal
+
+import numpy as np
+import torch
+
+TargetSide = Literal['head', 'tail']
+
+# Number of top k predictions to keep per query
+TOP_K = 10
+
+# Memory in bytes that a single chunk of scored queries may allocate
+MEMORY_BUDGET = 2 * 1024 ** 3
+
+
+def predict_tails(model, heads, relations, top_k: int = TOP_K, memory_budget: int = MEMORY_BUDGET):
+    return predict_targets(model, 'tail', np.stack([heads, relations], axis=1), top_k, memory_budget)
+
+
+def predict_heads(model, relations, tails, top_k: int = TOP_K, memory_budget: int = MEMORY_BUDGET):
+    return predict_targets(model, 'head', np.stack([relations, tails], axis=1), top_k, memory_budget)
+
+
+# Scores (h, r) queries against all tails or (r, t) queries against all heads in chunks
+# and returns the top k entity ids and scores as (num_queries, top_k) arrays
+def predict_targets(model, side: TargetSide, queries, top_k: int = TOP_K, memory_budget: int = MEMORY_BUDGET):
+    queries = np.asarray(queries, dtype=np.int64)
+    if (queries < 0).any():
+        raise ValueError('Queries contain unknown entity or relation ids')
+
+    num_queries = len(queries)
+    top_k = min(top_k, model.num_entities)
+    top_ids = np.empty((num_queries, top_k), dtype=np.int32)
+    top_scores = np.empty((num_queries, top_k), dtype=np.float32)
+
+    # Group queries by relation, so that consecutive chunks share relation embeddings
+    relation_column = 0 if side == 'head' else 1
+    order = np.argsort(queries[:, relation_column], kind='stable')
+
+    chunk_size = get_query_chunk_size(model, memory_budget)
+    slice_size = get_query_slice_size(model, memory_budget)
+    with torch.inference_mode():
+        start = 0
+        while start < num_queries:
+            chunk = order[start:start + chunk_size]
+            batch = torch.as_tensor(queries[chunk], device=model.device)
+
+            try:
+                if side == 'tail':
+                    scores = model.score_t(batch, slice_size=slice_size)
+                else:
+                    scores = model.score_h(batch, slice_size=slice_size)
+                chunk_scores, chunk_ids = torch.topk(scores, k=top_k, dim=1)
+            except (MemoryError, RuntimeError) as error:
+                chunk_size, slice_size = reduce_batch_size(error, chunk_size, slice_size, model.num_entities,
+                                                           model.device)
+                continue
+
+            top_ids[chunk] = chunk_ids.cpu().numpy()
+            top_scores[chunk] = chunk_scores.cpu().numpy()
+            start += len(chunk)
+
+    return top_ids, top_scores
+
+
+def get_query_chunk_size(model, memory_budget: int = MEMORY_BUDGET):
+    # Interactions broadcast every query against all entity representations, so a query
+    # costs about num_entities * (embedding size + 1 score) floats
+    bytes_per_query = model.num_entities * (get_entity_representation_size(model) + 1) * 4
+    return max(1, memory_budget // bytes_per_query)
+
+
+# Entity slice size for models of which not even a single query fits into the memory budget, like the 512
+# dimensional models, so that only slices of the entity representations are materialised at once
+def get_query_slice_size(model, memory_budget: int = MEMORY_BUDGET):
+    bytes_per_score = (get_entity_representation_size(model) + 1) * 4
+    if model.num_entities * bytes_per_score <= memory_budget:
+        return None
+    return max(1, memory_budget // bytes_per_score)
+
+
+def is_out_of_memory_error(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error).lower()
+
+
+# Halves the batch size after an out of memory error, or the entity slice size once single queries do not fit,
+# so that long runs retry the failed batch instead of aborting. Batches of triples cannot be sliced and pass no
+# num_entities. Other errors, and out of memory errors that persist at the smallest sizes, are raised again.
+def reduce_batch_size(error, batch_size: int, slice_size=None, num_entities=None, device=None):
+    if not is_out_of_memory_error(error):
+        raise error
+
+    if batch_size > 1:
+        batch_size //= 2
+    elif num_entities is not None and (slice_size is None or slice_size > 1):
+        slice_size = (slice_size or num_entities) // 2
+    else:
+        raise error
+
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.empty_cache()
+    print(f'[X] Out of memory, retrying with batch size {batch_size} and slice size {slice_size}')
+    return batch_size, slice_size
+
+
+def get_entity_representation_size(model):
+    # Number of real values per entity, e.g. 2 * dim for ComplEx and SimplE. Measured on a single representation,
+    # since quantised representations keep their values outside of the parameters.
+    index = torch.zeros(1, dtype=torch.long, device=model.device)
+    with torch.inference_mode():
+        representations = [representation(indices=index) for representation in model.entity_representations]
+    return sum(
+        (torch.view_as_real(x) if x.is_complex() else x).numel()
+        for x in representations
+    )
+
+
+def decode_entities(entity_labels, entity_ids):
+    # Labels are only decoded for the predictions that are actually looked at, padded ids of the ANN search
+    # (see ann_index.py) have no label
+    entity_ids = np.asarray(entity_ids)
+    return np.where(entity_ids >= 0, entity_labels[entity_ids.clip(min=0)], None)
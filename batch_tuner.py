@@ -0,0 +1,103 @@
+import json
+from pathlib import Path
+from typing import Literal
+
+import psutil
+import torch
+
+from batch_prediction import get_entity_representation_size, reduce_batch_size
+from pipeline_trace import trace_stage
+
+TuningTarget = Literal['head', 'tail', 'triple']
+
+# Fraction of the currently available memory that a tuned batch may allocate. CPU processes are usually
+# killed by the OOM killer instead of raising a MemoryError, so the budget has to leave enough headroom.
+MEMORY_FRACTION = 0.5
+
+MAX_BATCH_SIZE = 65_536
+
+
+def get_memory_budget(device=None, memory_fraction: float = MEMORY_FRACTION):
+    device = torch.device(device or 'cpu')
+    if device.type == 'cuda':
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return int(free_memory * memory_fraction)
+    return int(psutil.virtual_memory().available * memory_fraction)
+
+
+def select_device(model, memory_fraction: float = MEMORY_FRACTION):
+    # Models are only moved to the GPU if their parameters fit into the free GPU memory with headroom for scoring
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+
+    model_bytes = sum(parameter.numel() * parameter.element_size() for parameter in model.parameters())
+    if model_bytes > get_memory_budget('cuda', memory_fraction):
+        return torch.device('cpu')
+    return torch.device('cuda')
+
+
+# Picks the largest batch size (and an entity slice size, if not even a single query fits) whose scores
+# stay within the memory budget, and verifies it by scoring a probe batch, halving the sizes on OOM
+@trace_stage('tune_batch_size')
+def tune_batch_size(model, target: TuningTarget = 'tail', memory_budget=None, max_batch_size: int = MAX_BATCH_SIZE):
+    memory_budget = memory_budget or get_memory_budget(model.device)
+
+    # Every scored (query, entity) pair broadcasts one entity representation and produces one float score
+    bytes_per_score = (get_entity_representation_size(model) + 1) * 4
+    if target == 'triple':
+        bytes_per_query = 3 * bytes_per_score
+    else:
+        bytes_per_query = model.num_entities * bytes_per_score
+
+    batch_size = int(min(max_batch_size, memory_budget // bytes_per_query))
+    slice_size = None
+    if batch_size < 1:
+        batch_size = 1
+        slice_size = int(max(1, memory_budget // bytes_per_score))
+
+    while True:
+        try:
+            _score_probe_batch(model, target, batch_size, slice_size)
+            break
+        except (MemoryError, RuntimeError) as error:
+            num_entities = None if target == 'triple' else model.num_entities
+            batch_size, slice_size = reduce_batch_size(error, batch_size, slice_size, num_entities, model.device)
+
+    return {
+        'target': target,
+        'batch_size': batch_size,
+        'slice_size': slice_size,
+        'memory_budget': int(memory_budget),
+        'device': str(model.device),
+    }
+
+
+def save_run_metadata(metadata_file, key, settings):
+    # Tuned settings of several models can be recorded in the same file under different keys
+    metadata_file = Path(metadata_file)
+    metadata = {}
+    if metadata_file.exists():
+        with open(metadata_file) as file:
+            metadata = json.load(file)
+
+    metadata[key] = settings
+    metadata_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(metadata_file, 'w') as file:
+        json.dump(metadata, file, indent=2)
+
+
+def _score_probe_batch(model, target: TuningTarget, batch_size, slice_size):
+    hrt_batch = torch.stack([
+        torch.randint(model.num_entities, (batch_size,)),
+        torch.randint(model.num_relations, (batch_size,)),
+        torch.randint(model.num_entities, (batch_size,))
+    ], dim=1).to(model.device)
+
+    with torch.inference_mode():
+        if target == 'triple':
+            model.score_hrt(hrt_batch)
+        else:
+            model.predict(hrt_batch=hrt_batch, target=target, slice_size=slice_size)
+
+    if model.device.type == 'cuda':
+        torch.cuda.empty_cache()
@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import platform
+from datetime import datetime
+from pathlib import Path
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import pykeen
+import torch
+from pykeen.evaluation import RankBasedEvaluator
+from pykeen.predict import predict_target, predict_triples
+from pykeen.triples import CoreTriplesFactory
+
+from batch_prediction import TOP_K, predict_targets
+from filtered_ranking import compute_filtered_ranks, get_filter_index
+from model_loading import EMBEDDING_DIMS, MODEL_CLASSES, MODEL_NAMES
+from pipeline_trace import run_trace, trace_stage
+from triple_store import O, P, S, SUBSET_TYPES, build_triple_store, get_mapped_triples, is_triple_store, \
+    open_triple_store
+
+BENCHMARK_DIR = 'benchmarks'
+BASELINE_FILE = 'benchmarks/baseline.json'
+
+# Shape of the synthetic graph, Wikidata5M has 4.6M entities, 822 relations and 20.6M training triples.
+# The defaults are much smaller, so that all models and dimensions can be benchmarked on a CPU.
+GRAPH_CONFIG = {
+    'num_entities': 100_000,
+    'num_relations': 822,
+    'num_train_triples': 1_000_000,
+    'num_valid_triples': 5_000,
+    'num_test_triples': 5_000,
+    # Exponents of the Zipfian distributions of the predicates and of the entities on either side
+    'relation_exponent': 1.1,
+    'entity_exponent': 0.8,
+    'seed': 0,
+}
+
+# Queries and triples of every measurement, also part of the configuration that a baseline has to match
+BENCHMARK_CONFIG = {
+    'num_latency_queries': 100,
+    'num_batch_queries': 1024,
+    'num_ranked_triples': 1000,
+    'num_evaluated_triples': 200,
+    'num_scored_triples': 100_000,
+    'top_k': TOP_K,
+    'repeats': 3,
+}
+
+# Metrics that changed by more than this fraction in the worse direction are reported as regressions
+REGRESSION_THRESHOLD = 0.1
+
+# Percentiles of the single query latency
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scoring, ranking and completion of all models on a '
+                                                 'synthetic Wikidata5M-shaped graph')
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=MODEL_NAMES)
+    parser.add_argument('--dims', nargs='+', type=int, default=EMBEDDING_DIMS)
+    for name, value in {**GRAPH_CONFIG, **BENCHMARK_CONFIG}.items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=type(value), default=value)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--output-dir', default=BENCHMARK_DIR)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--compare', default=None,
+                        help='Compare a saved results file with the baseline instead of running the benchmarks')
+    args = parser.parse_args()
+
+    if args.compare:
+        results = load_results(args.compare)
+    else:
+        graph_config = {name: getattr(args, name) for name in GRAPH_CONFIG}
+        benchmark_config = {name: getattr(args, name) for name in BENCHMARK_CONFIG}
+        results = run_benchmarks(args.models, args.dims, graph_config, benchmark_config, args.threads,
+                                 args.output_dir)
+
+    if Path(args.baseline).exists():
+        comparison = compare_results(results, load_results(args.baseline))
+        print_comparison(comparison)
+        num_regressions = int(comparison['regression'].sum())
+        print(f'[X] {num_regressions} of {len(comparison)} metrics regressed by more than '
+              f'{REGRESSION_THRESHOLD:.0%} against {args.baseline}')
+    else:
+        print(f'[X] No baseline found at {args.baseline}, run with --save-baseline to create it')
+
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        print(f'[X] Saved the results as baseline to {args.baseline}')
+
+
+# Runs all benchmarks of every model and dimension on the synthetic graph and saves the results as
+# benchmark_<timestamp>.json in output_dir. Models are randomly initialised, which costs the same as trained ones.
+def run_benchmarks(model_names=MODEL_NAMES, embedding_dims=EMBEDDING_DIMS, graph_config=None, benchmark_config=None,
+                   num_threads: int = None, output_dir=BENCHMARK_DIR):
+    graph_config = {**GRAPH_CONFIG, **(graph_config or {})}
+    benchmark_config = {**BENCHMARK_CONFIG, **(benchmark_config or {})}
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'graph_config': graph_config,
+        'benchmark_config': benchmark_config,
+        'measurements': [],
+    }
+    output_dir = Path(output_dir)
+    with run_trace('benchmark_suite', [output_dir]):
+        with trace_stage('create_graph'):
+            store_dir = create_synthetic_store(output_dir / 'graphs', graph_config)
+        store = open_triple_store(store_dir)
+        filter_index = get_filter_index(store_dir)
+
+        rng = np.random.default_rng(graph_config['seed'])
+        test_triples = get_mapped_triples(store, 'test')
+        workload = {
+            'latency_queries': test_triples[rng.integers(0, len(test_triples),
+                                                         benchmark_config['num_latency_queries']), :2],
+            'batch_queries': test_triples[rng.integers(0, len(test_triples),
+                                                       benchmark_config['num_batch_queries']), :2],
+            'ranked_triples': test_triples[:benchmark_config['num_ranked_triples']],
+            'evaluated_triples': test_triples[:benchmark_config['num_evaluated_triples']],
+            'scored_triples': get_mapped_triples(store, 'train')[:benchmark_config['num_scored_triples']],
+            'filter_triples': [torch.as_tensor(get_mapped_triples(store, subset_type))
+                               for subset_type in SUBSET_TYPES],
+        }
+
+        for embedding_dim in embedding_dims:
+            for model_name in model_names:
+                print(f'[X] Benchmarking {model_name} with dimension {embedding_dim}')
+                model = create_benchmark_model(model_name, embedding_dim, store, graph_config['seed'])
+                for benchmark_name, benchmark in BENCHMARKS.items():
+                    with trace_stage(f'{benchmark_name}/{model_name}_{embedding_dim}') as stage:
+                        metrics = benchmark(model, workload, filter_index, benchmark_config)
+                    results['measurements'].append({
+                        'benchmark': benchmark_name,
+                        'model': model_name,
+                        'dim': embedding_dim,
+                        'metrics': {
+                            **metrics,
+                            'model_bytes': _get_model_bytes(model),
+                            # Memory is attributed to a benchmark only when it raised the process high-water mark
+                            'peak_rss_increase': stage['peak_rss_increase'],
+                            'peak_rss': stage['peak_rss'],
+                        },
+                    })
+                    print(f'  {benchmark_name:<24} ' + ', '.join(f'{name}={value:.4g}'
+                                                                   for name, value in metrics.items()))
+                del model
+
+    results_file = output_dir / f'benchmark_{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+    save_results(results, results_file)
+    print(f'[X] Saved {len(results["measurements"])} measurements to {results_file}')
+    return results
+
+
+# Latency of completing one (h, r, ?) query at a time, with the batched top k of the completion engine
+# and with PyKEEN's predict_target
+def benchmark_single_query(model, workload, filter_index, config):
+    metrics = {}
+    for name, complete in {
+        'predict_targets': lambda query: predict_targets(model, 'tail', query[None], config['top_k']),
+        'pykeen_predict_target': lambda query: predict_target(model, head=int(query[0]), relation=int(query[1])),
+    }.items():
+        complete(workload['latency_queries'][0])
+        latencies = []
+        for query in workload['latency_queries']:
+            start = timer()
+            complete(query)
+            latencies.append(timer() - start)
+        for percentile in LATENCY_PERCENTILES:
+            metrics[f'{name}_p{percentile}_ms'] = float(np.percentile(latencies, percentile)) * 1000
+    return metrics
+
+
+def benchmark_batched_completion(model, workload, filter_index, config):
+    queries = workload['batch_queries']
+    duration = _measure(lambda: predict_targets(model, 'tail', queries, config['top_k']), config['repeats'])
+    return {'queries_per_second': len(queries) / duration}
+
+
+# Filtered head and tail ranks against all entities, with the filter index of compute_filtered_ranks and
+# with PyKEEN's RankBasedEvaluator, which filters with the mapped triples of all subsets
+def benchmark_full_ranking(model, workload, filter_index, config):
+    ranked_triples = workload['ranked_triples']
+    duration = _measure(lambda: compute_filtered_ranks(model, ranked_triples, filter_index), config['repeats'])
+
+    evaluated_triples = torch.as_tensor(workload['evaluated_triples'])
+    evaluator = RankBasedEvaluator()
+    evaluator_duration = _measure(lambda: evaluator.evaluate(
+        model, evaluated_triples, use_tqdm=False, additional_filter_triples=workload['filter_triples']
+    ), config['repeats'])
+
+    return {
+        'compute_filtered_ranks_triples_per_second': len(ranked_triples) / duration,
+        'rank_based_evaluator_triples_per_second': len(evaluated_triples) / evaluator_duration,
+    }
+
+
+def benchmark_triple_scoring(model, workload, filter_index, config):
+    scored_triples = torch.as_tensor(workload['scored_triples'])
+    duration = _measure(lambda: predict_triples(model, triples=scored_triples), config['repeats'])
+    return {'triples_per_second': len(scored_triples) / duration}
+
+
+BENCHMARKS = {
+    'single_query': benchmark_single_query,
+    'batched_completion': benchmark_batched_completion,
+    'full_ranking': benchmark_full_ranking,
+    'triple_scoring': benchmark_triple_scoring,
+}
+
+
+# Builds the triple store of a synthetic graph with Zipfian relation and entity frequencies, or reuses it if a
+# graph with the same configuration was created before. The same configuration always yields the same graph.
+def create_synthetic_store(graph_dir, graph_config):
+    store_dir = Path(graph_dir) / '-'.join(f'{key}_{graph_config[key]}' for key in sorted(graph_config))
+    if is_triple_store(store_dir):
+        return store_dir
+
+    print(f'[X] Creating synthetic graph with {graph_config["num_entities"]} entities and '
+          f'{graph_config["num_relations"]} relations in {store_dir}')
+    rng = np.random.default_rng(graph_config['seed'])
+    num_entities = graph_config['num_entities']
+    num_triples = sum(graph_config[f'num_{subset_type}_triples'] for subset_type in SUBSET_TYPES)
+
+    # Frequent relations and entities are spread over the id range instead of having the lowest ids
+    relation_probabilities = _get_zipf_probabilities(graph_config['num_relations'], graph_config['relation_exponent'])
+    entity_probabilities = _get_zipf_probabilities(num_entities, graph_config['entity_exponent'])
+    relation_ids = rng.permutation(graph_config['num_relations'])
+    entity_ids = rng.permutation(num_entities)
+
+    # Sampled with some excess, since duplicates and self loops are dropped
+    triples = np.empty((3, 0), dtype=np.int64)
+    while triples.shape[1] < num_triples:
+        num_samples = int((num_triples - triples.shape[1]) * 1.2) + 1
+        sample = np.stack([
+            entity_ids[rng.choice(num_entities, num_samples, p=entity_probabilities)],
+            relation_ids[rng.choice(len(relation_ids), num_samples, p=relation_probabilities)],
+            entity_ids[rng.choice(num_entities, num_samples, p=entity_probabilities)],
+        ])
+        triples = np.concatenate([triples, sample[:, sample[S] != sample[O]]], axis=1)
+        keys = (triples[P] * num_entities + triples[S]) * num_entities + triples[O]
+        _, first = np.unique(keys, return_index=True)
+        triples = triples[:, np.sort(first)]
+    triples = triples[:, rng.permutation(triples.shape[1])[:num_triples]]
+
+    # Written as the tab-separated files of Wikidata5M, so that the store is built like the real one
+    dataset_dir = store_dir / 'dataset'
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    start = 0
+    for subset_type in SUBSET_TYPES:
+        end = start + graph_config[f'num_{subset_type}_triples']
+        pd.DataFrame({
+            'S': np.char.add('Q', triples[S, start:end].astype(str)),
+            'P': np.char.add('P', triples[P, start:end].astype(str)),
+            'O': np.char.add('Q', triples[O, start:end].astype(str)),
+        }).to_csv(dataset_dir / f'wikidata5m_transductive_{subset_type}.txt', sep='\t', header=False, index=False)
+        start = end
+
+    build_triple_store(store_dir, {f'Q{i}': i for i in range(num_entities)},
+                       {f'P{i}': i for i in range(graph_config['num_relations'])}, dataset_dir)
+    return store_dir
+
+
+def create_benchmark_model(model_name, embedding_dim: int, store, seed: int = 0):
+    triples_factory = CoreTriplesFactory.create(
+        mapped_triples=torch.as_tensor(get_mapped_triples(store, 'train')),
+        num_entities=store['metadata']['num_entities'],
+        num_relations=store['metadata']['num_relations'],
+    )
+    model = MODEL_CLASSES[model_name](triples_factory=triples_factory, embedding_dim=embedding_dim,
+                                      random_seed=seed)
+    return model.eval()
+
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'pykeen': pykeen.get_version(),
+        'device': torch.cuda.get_device_name() if torch.cuda.is_available() else 'cpu',
+    }
+
+
+# Changes of every metric that was measured in both runs. Metrics ending in _per_second are better when higher,
+# latencies and memory when lower.
+def compare_results(results, baseline):
+    for config_name in ('graph_config', 'benchmark_config'):
+        if results[config_name] != baseline[config_name]:
+            print(f'[X] The {config_name} differs from the baseline, the comparison is not meaningful')
+    if results['environment'] != baseline['environment']:
+        print(f'[X] The environment differs from the baseline: '
+              + ', '.join(f'{key} {baseline["environment"].get(key)} -> {value}'
+                          for key, value in results['environment'].items()
+                          if baseline['environment'].get(key) != value))
+
+    comparison = _get_metric_table(results).merge(_get_metric_table(baseline),
+                                                  on=['benchmark', 'model', 'dim', 'metric'], suffixes=('', '_baseline'))
+    comparison['change'] = comparison['value'] / comparison['value_baseline'] - 1
+    higher_is_better = comparison['metric'].str.endswith('_per_second')
+    comparison['regression'] = np.where(higher_is_better, comparison['change'] < -REGRESSION_THRESHOLD,
+                                        comparison['change'] > REGRESSION_THRESHOLD)
+    # Memory that is reused from earlier benchmarks is not attributed, so changes of the increase are not flagged
+    comparison.loc[comparison['metric'] == 'peak_rss_increase', 'regression'] = False
+    return comparison
+
+
+def print_comparison(comparison):
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(comparison.assign(
+            change=comparison['change'].map(lambda change: f'{change:+.1%}'),
+            regression=np.where(comparison['regression'], 'REGRESSION', '')
+        ).to_string(index=False))
+
+
+def save_results(results, results_file):
+    results_file = Path(results_file)
+    results_file.parent.mkdir(parents=True, exist_ok=True)
+    temporary_file = results_file.with_suffix('.json.tmp')
+    with open(temporary_file, 'w') as file:
+        json.dump(results, file, indent=2)
+    os.replace(temporary_file, results_file)
+
+
+def load_results(results_file):
+    with open(results_file) as file:
+        return json.load(file)
+
+
+def _measure(function, repeats: int):
+    # Best of the repeats after a warm up run, which is the least disturbed by other processes
+    function()
+    durations = []
+    for _ in range(repeats):
+        start = timer()
+        function()
+        durations.append(timer() - start)
+    return min(durations)
+
+
+def _get_zipf_probabilities(num_values, exponent):
+    weights = np.arange(1, num_values + 1, dtype=float) ** -exponent
+    return weights / weights.sum()
+
+
+def _get_model_bytes(model):
+    return sum(parameter.numel() * parameter.element_size() for parameter in model.parameters())
+
+
+def _get_metric_table(results):
+    return pd.DataFrame([
+        {'benchmark': measurement['benchmark'], 'model': measurement['model'], 'dim': measurement['dim'],
+         'metric': metric_name, 'value': value}
+        for measurement in results['measurements']
+        for metric_name, value in measurement['metrics'].items()
+    ])
+
+
+if __name__ == '__main__':
+    main()
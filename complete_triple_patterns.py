@@ -1,11 +1,14 @@
-from typing import Literal
-
+import numpy as np
 import pandas as pd
 import torch
 from pykeen.predict import predict_target
 from pykeen.triples import TriplesFactory
 
-SubsetType = Literal['train', 'valid', 'test']
+from ann_index import NUM_PROBES, predict_targets_ann
+from batch_prediction import TOP_K, decode_entities, predict_heads, predict_tails
+from metrics_store import get_metric_value, load_metrics_store
+from triple_store import SubsetType, get_labeled_triples, get_store_dir, is_triple_store, map_entity_labels, \
+    map_relation_labels, open_triple_store
 
 
 def main():
@@ -20,7 +23,7 @@ def main():
     print(f'  Num Entities:  {model_factory.num_entities}')
     print(f'  Num Relations: {model_factory.num_relations} (Real: {model_factory.real_num_relations})')
 
-    predicate_metrics = pd.read_csv('metrics/predicate_metrics.csv')
+    predicate_metrics = load_metrics_store('metrics/predicate_metrics.csv')
 
     preds = predict_tail(model, 'Q1236794', 'P31', model_factory)
     preds_df = preds.add_membership_columns(training=wikidata5m_train, validation=wikidata5m_valid, testing=wikidata5m_test).df
@@ -31,6 +34,13 @@ def main():
     print('In test set:')
     print(preds_df[preds_df['in_testing'] == True])
 
+    # Complete the (s, p, ?) patterns of all test triples with the same predicate in one batch
+    wikidata5m_store = open_triple_store(get_store_dir(32))
+    test_patterns = wikidata5m_test[wikidata5m_test['P'] == 'P31']
+    top_ids, top_scores = predict_tail_batch(model, wikidata5m_store, test_patterns['S'], test_patterns['P'])
+    print(f'Top {TOP_K} tails for {test_patterns["S"].iloc[0]} P31 ?o:')
+    print(decode_entities(wikidata5m_store['entity_labels'], top_ids[0]), top_scores[0])
+
     predicate_label = wikidata5m_test['P'].iloc[10]
     arithmetic_mean_rank = get_predicate_metric(predicate_metrics, 'arithmetic_mean_rank', predicate_label, 'complex', 'tail', 'realistic')
     hits_at_1 = get_predicate_metric(predicate_metrics, 'hits_at_1', predicate_label, 'complex', 'tail', 'realistic')
@@ -44,7 +54,12 @@ def main():
     print(f'Hits at 10:           {hits_at_10}')
 
 
-def load_wikidata5m_dataset(subset_type: SubsetType):
+def load_wikidata5m_dataset(subset_type: SubsetType, embedding_dim: int = 32):
+    # Decode labels from the memory-mapped triple store if it was ingested (see triple_store.py)
+    store_dir = get_store_dir(embedding_dim)
+    if is_triple_store(store_dir):
+        return get_labeled_triples(open_triple_store(store_dir), subset_type)
+
     return pd.read_csv(f'dataset/wikidata5m/wikidata5m_transductive_{subset_type}.txt', sep='\t',
                        names=['S', 'P', 'O'])
 
@@ -59,18 +74,30 @@ def predict_tail(model, head, relation, triples_factory):
     )
 
 
-def get_predicate_metric(metrics: pd.DataFrame,
+def predict_tail_batch(model, store, heads, relations, top_k: int = TOP_K, ann_index=None, num_probes=NUM_PROBES):
+    heads, relations = map_entity_labels(store, heads), map_relation_labels(store, relations)
+
+    # Optionally retrieve approximate candidates from an ANN index instead of scoring all entities
+    if ann_index is not None:
+        return predict_targets_ann(model, ann_index, 'tail', np.stack([heads, relations], axis=1), top_k, num_probes)
+    return predict_tails(model, heads, relations, top_k)
+
+
+def predict_head_batch(model, store, relations, tails, top_k: int = TOP_K, ann_index=None, num_probes=NUM_PROBES):
+    relations, tails = map_relation_labels(store, relations), map_entity_labels(store, tails)
+
+    if ann_index is not None:
+        return predict_targets_ann(model, ann_index, 'head', np.stack([relations, tails], axis=1), top_k, num_probes)
+    return predict_heads(model, relations, tails, top_k)
+
+
+def get_predicate_metric(metrics_store,
                          metric_name: str,
                          predicate_label: str,
                          model_name: str,
                          target: str,
                          metric_type: str):
-    # return metrics.set_index(['Metric', 'relation_label', 'model', 'Side', 'Type']).loc[(metric_name, predicate_label, model_name, target, metric_type), 'Value']
-    return metrics.query('Metric == @metric_name and '
-                         'Type == @metric_type and '
-                         'relation_label == @predicate_label and '
-                         'model == @model_name and '
-                         'Side == @target')['Value'].iloc[0]
+    return get_metric_value(metrics_store, metric_name, predicate_label, model_name, target, metric_type)
 
 
 if __name__ == '__main__':
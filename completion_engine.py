@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from batch_prediction import MEMORY_BUDGET, TOP_K, TargetSide, get_query_chunk_size, get_query_slice_size, \
+    predict_targets, reduce_batch_size
+from metrics_store import get_metric_optimum, get_metric_slice, load_metrics_store
+from model_loading import MODEL_NAMES, load_model
+from triple_store import get_store_dir, map_entity_labels, map_relation_labels, open_triple_store
+
+DECISIVE_METRIC = 'hits_at_10'
+
+# Relations whose best model beats the second best by less than this relative margin
+# of the decisive metric are completed by the ensemble of all models
+ENSEMBLE_MARGIN = 0.02
+
+# Route code of relations that are completed by the ensemble
+ENSEMBLE_ROUTE = -1
+
+
+def main():
+    engine = load_completion_engine(embedding_dim=32)
+
+    routes = engine['routes']
+    print(f'[X] Routing {len(routes)} relations:')
+    for code, model_name in enumerate(engine['model_names']):
+        print(f'  {model_name:<10} {np.sum(routes == code)}')
+    print(f'  {"ensemble":<10} {np.sum(routes == ENSEMBLE_ROUTE)}')
+
+    print(complete_patterns(engine, 'tail', ['Q1236794', 'Q1236794'], ['P31', 'P106']))
+
+
+# Holds every model once, without the training triples factories, together with the triple store for
+# label lookups and a route table from relation ids to the best model
+def load_completion_engine(embedding_dim: int = 32, model_names=MODEL_NAMES,
+                           metrics_file='metrics/predicate_metrics.csv', decisive_metric: str = DECISIVE_METRIC,
+                           ensemble_margin: float = ENSEMBLE_MARGIN):
+    store = open_triple_store(get_store_dir(embedding_dim))
+
+    models = []
+    for model_name in model_names:
+        print(f'[X] Loading {model_name} model with dimension {embedding_dim}')
+        model = load_model(model_name, embedding_dim).eval()
+        model.requires_grad_(False)
+        models.append(model)
+
+    routes = build_routes(load_metrics_store(metrics_file), store['relation_labels'], model_names, decisive_metric,
+                          ensemble_margin)
+
+    return {
+        'store': store,
+        'model_names': list(model_names),
+        'models': models,
+        'routes': routes,
+    }
+
+
+def build_routes(metrics_store, relation_labels, model_names, decisive_metric: str = DECISIVE_METRIC,
+                 ensemble_margin: float = ENSEMBLE_MARGIN, side='both', rank_type='realistic'):
+    # (relation, model) table of the decisive metric in store relation order
+    values = get_metric_slice(metrics_store, metric_name=decisive_metric, side=side, rank_type=rank_type)
+    values = values.reindex(index=pd.Index(np.asarray(relation_labels)), columns=list(model_names)).to_numpy()
+
+    # Larger is better after the sign flip, relations without metrics are completed by the ensemble
+    if get_metric_optimum(decisive_metric) == 'min':
+        values = -values
+    values = np.nan_to_num(values, nan=-np.inf)
+
+    ranked = np.sort(np.concatenate([np.full((len(values), 1), -np.inf), values], axis=1), axis=1)
+    best, second_best = ranked[:, -1], ranked[:, -2]
+    with np.errstate(invalid='ignore'):
+        margin = (best - second_best) / np.maximum(np.abs(best), 1e-12)
+
+    routes = values.argmax(axis=1).astype(np.int8)
+    routes[~np.isfinite(best) | (margin < ensemble_margin)] = ENSEMBLE_ROUTE
+    return routes
+
+
+# Completes (s, p, ?) patterns for side 'tail' or (?, p, o) patterns for side 'head' given as labels
+def complete_patterns(engine, side: TargetSide, entity_labels, relation_labels, top_k: int = TOP_K, model_name=None):
+    store = engine['store']
+    entity_ids = map_entity_labels(store, entity_labels)
+    relation_ids = map_relation_labels(store, relation_labels)
+    known = (entity_ids >= 0) & (relation_ids >= 0)
+
+    queries = np.stack([entity_ids, relation_ids] if side == 'tail' else [relation_ids, entity_ids], axis=1)
+    top_ids, top_scores, routes = complete_targets(engine, side, queries[known], top_k, model_name)
+
+    target_column = f'{side}_label'
+    query_column = 'head_label' if side == 'tail' else 'tail_label'
+    query_index = np.repeat(np.flatnonzero(known), top_ids.shape[1])
+    return pd.DataFrame({
+        query_column: np.asarray(entity_labels)[query_index],
+        'relation_label': np.asarray(relation_labels)[query_index],
+        f'{side}_id': top_ids.reshape(-1),
+        target_column: store['entity_labels'][top_ids.reshape(-1)],
+        'score': top_scores.reshape(-1),
+        'model': np.repeat(get_route_names(engine, routes), top_ids.shape[1]),
+        'rank': np.tile(np.arange(1, top_ids.shape[1] + 1), len(top_ids)),
+    })
+
+
+# Routes every query to the best model of its relation (or to the given model) and scores the queries of each
+# model in one batch, returns the top k ids and scores of all queries and the route codes
+def complete_targets(engine, side: TargetSide, queries, top_k: int = TOP_K, model_name=None):
+    queries = np.asarray(queries, dtype=np.int64).reshape(-1, 2)
+    if model_name is None:
+        routes = engine['routes'][queries[:, 0] if side == 'head' else queries[:, 1]]
+    else:
+        routes = np.full(len(queries), engine['model_names'].index(model_name), dtype=np.int8)
+
+    top_k = min(top_k, engine['models'][0].num_entities)
+    top_ids = np.empty((len(queries), top_k), dtype=np.int32)
+    top_scores = np.empty((len(queries), top_k), dtype=np.float32)
+
+    for route in np.unique(routes):
+        routed = np.flatnonzero(routes == route)
+        if route == ENSEMBLE_ROUTE:
+            ids, scores = predict_targets_ensemble(engine['models'], side, queries[routed], top_k)
+        else:
+            ids, scores = predict_targets(engine['models'][route], side, queries[routed], top_k)
+        top_ids[routed] = ids
+        top_scores[routed] = scores
+
+    return top_ids, top_scores, routes
+
+
+# Averages the standardised scores of all models, since the raw scores of different interactions
+# are not on the same scale
+def predict_targets_ensemble(models, side: TargetSide, queries, top_k: int = TOP_K,
+                             memory_budget: int = MEMORY_BUDGET):
+    queries = np.asarray(queries, dtype=np.int64)
+    top_k = min(top_k, models[0].num_entities)
+    top_ids = np.empty((len(queries), top_k), dtype=np.int32)
+    top_scores = np.empty((len(queries), top_k), dtype=np.float32)
+
+    chunk_size = min(get_query_chunk_size(model, memory_budget) for model in models)
+    slice_sizes = [get_query_slice_size(model, memory_budget) for model in models]
+    slice_size = min([slice_size for slice_size in slice_sizes if slice_size is not None], default=None)
+    with torch.inference_mode():
+        start = 0
+        while start < len(queries):
+            chunk = queries[start:start + chunk_size]
+
+            try:
+                ensemble_scores = 0
+                for model in models:
+                    batch = torch.as_tensor(chunk, device=model.device)
+                    if side == 'tail':
+                        scores = model.score_t(batch, slice_size=slice_size)
+                    else:
+                        scores = model.score_h(batch, slice_size=slice_size)
+                    scale = scores.std(dim=1, keepdim=True).clamp_min(1e-12)
+                    scores = (scores - scores.mean(dim=1, keepdim=True)) / scale
+                    ensemble_scores = ensemble_scores + scores.cpu()
+
+                chunk_scores, chunk_ids = torch.topk(ensemble_scores / len(models), k=top_k, dim=1)
+            except (MemoryError, RuntimeError) as error:
+                chunk_size, slice_size = reduce_batch_size(error, chunk_size, slice_size, models[0].num_entities,
+                                                           models[0].device)
+                continue
+
+            top_ids[start:start + len(chunk)] = chunk_ids.numpy()
+            top_scores[start:start + len(chunk)] = chunk_scores.numpy()
+            start += len(chunk)
+
+    return top_ids, top_scores
+
+
+def get_route_names(engine, routes):
+    names = np.asarray(engine['model_names'] + ['ensemble'])
+    return names[np.where(routes == ENSEMBLE_ROUTE, len(engine['model_names']), routes)]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import json
+from timeit import default_timer as timer
+from urllib.parse import urlencode
+
+import numpy as np
+
+from batch_prediction import TOP_K
+from completion_server import HOST, PORT
+from triple_store import get_labeled_triples, get_store_dir, open_triple_store
+
+# Percentiles of the request latency in the report
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send concurrent completion queries to completion_server.py')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--dim', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--hops', type=int, choices=[1, 2], default=1)
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    queries = create_test_queries(open_triple_store(get_store_dir(args.dim)), args.requests, args.hops, args.seed)
+    report = asyncio.run(run_load_test(args.host, args.port, queries, args.concurrency, args.top_k))
+    print_report(report)
+
+
+# (s, p, ?o) queries of random test triples, two-hop queries continue from ?o with the relation of another
+# random test triple
+def create_test_queries(store, num_queries: int, hops: int = 1, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    test_triples = get_labeled_triples(store, 'test')
+    sample = test_triples.iloc[rng.integers(0, len(test_triples), num_queries)]
+    second_relations = test_triples['P'].to_numpy()[rng.integers(0, len(test_triples), num_queries)]
+
+    queries = []
+    for subject, relation, second_relation in zip(sample['S'], sample['P'], second_relations):
+        query = f'SELECT * WHERE {{ wd:{subject} wdt:{relation} ?o'
+        if hops == 2:
+            query += f' . ?o wdt:{second_relation} ?o2'
+        queries.append(query + ' }')
+    return queries
+
+
+async def run_load_test(host, port, queries, concurrency: int = 32, top_k: int = TOP_K):
+    latencies = np.full(len(queries), np.nan)
+    statuses = np.zeros(len(queries), dtype=np.int32)
+    next_query = iter(range(len(queries)))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for index in next_query:
+                start = timer()
+                statuses[index], _ = await _get(reader, writer, host,
+                                                '/sparql?' + urlencode({'query': queries[index], 'top_k': top_k}))
+                latencies[index] = timer() - start
+        finally:
+            writer.close()
+
+    before = await _get_stats(host, port)
+    start = timer()
+    await asyncio.gather(*[client() for _ in range(min(concurrency, len(queries)))])
+    duration = timer() - start
+    after = await _get_stats(host, port)
+
+    batches = after['batches'] - before['batches']
+    return {
+        'requests': len(queries),
+        'errors': int(np.sum(statuses != 200)),
+        'concurrency': concurrency,
+        'duration': duration,
+        'qps': len(queries) / duration,
+        **{f'p{percentile}': float(np.percentile(latencies, percentile)) for percentile in LATENCY_PERCENTILES},
+        'max': float(np.max(latencies)),
+        'mean_batch_size': (after['batched_queries'] - before['batched_queries']) / max(1, batches),
+    }
+
+
+def print_report(report):
+    print(f'[X] {report["requests"]} requests with concurrency {report["concurrency"]} in '
+          f'{report["duration"]:.2f}s, {report["errors"]} errors')
+    print(f'  QPS:  {report["qps"]:.1f}')
+    for percentile in LATENCY_PERCENTILES:
+        print(f'  p{percentile}:  {report[f"p{percentile}"] * 1000:.1f}ms')
+    print(f'  max:  {report["max"] * 1000:.1f}ms')
+    print(f'  Mean scoring batch size: {report["mean_batch_size"]:.1f} queries')
+
+
+async def _get_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, body = await _get(reader, writer, host, '/stats')
+    finally:
+        writer.close()
+    return json.loads(body)
+
+
+async def _get(reader, writer, host, target):
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\nAccept: application/json\r\n\r\n'.encode())
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, await reader.readexactly(int(headers['content-length']))
+
+
+if __name__ == '__main__':
+    main()
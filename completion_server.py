@@ -0,0 +1,400 @@
+import argparse
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from timeit import default_timer as timer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from batch_prediction import TOP_K
+from completion_engine import load_completion_engine
+from query_planner import BEAM_WIDTH, complete_query, create_prediction_cache, is_variable, predict_cached
+from rdf_export import WIKIDATA_PREFIX
+
+HOST = '127.0.0.1'
+
+# Next to the HTTP port 8890 of the Virtuoso instance in virtuoso/virtuoso.ini
+PORT = 8891
+
+# Time that the first prediction request of a batch waits for concurrent requests
+MAX_BATCH_DELAY = 0.002
+
+# Number of (entity, relation) queries after which a batch is scored without waiting
+MAX_BATCH_QUERIES = 4096
+
+# Queries that are completed at the same time, every query runs in its own thread and waits for the batches
+MAX_CONCURRENT_QUERIES = 64
+
+# Largest number of bindings that a single query may request
+MAX_LIMIT = 10_000
+
+# Largest number of targets per hop, requests in the same batch are scored with the largest top k among them
+MAX_TOP_K = 1000
+
+MAX_REQUEST_SIZE = 1024 ** 2
+
+SPARQL_RESULTS_TYPE = 'application/sparql-results+json'
+XSD_PREFIX = 'http://www.w3.org/2001/XMLSchema#'
+
+# Terms of a basic graph pattern: IRIs, prefixed names, variables, labels and the '.' separating the patterns
+TERM_PATTERN = re.compile(r'<[^>]*>|[^\s<>{}.]+|\.')
+
+SELECT_PATTERN = re.compile(
+    r'\s*(?:PREFIX\s+[^\s:]*:\s*<[^>]*>\s*)*(?:SELECT\s+(?:DISTINCT\s+)?(?P<variables>.*?)\s*WHERE\s*)?'
+    r'\{(?P<patterns>.*)\}\s*(?:LIMIT\s+(?P<limit>\d+))?\s*',
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve triple pattern completions over HTTP')
+    parser.add_argument('--dim', type=int, default=32)
+    parser.add_argument('--metrics-file', default='metrics/predicate_metrics.csv')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    engine = load_completion_engine(args.dim, metrics_file=args.metrics_file)
+    asyncio.run(serve(engine, args.host, args.port))
+
+
+async def serve(engine, host: str = HOST, port: int = PORT):
+    server = create_server(engine)
+    batcher_task = asyncio.create_task(run_batcher(server['batcher']))
+
+    http_server = await asyncio.start_server(lambda reader, writer: handle_connection(server, reader, writer),
+                                             host, port)
+    print(f'[X] Serving completions at http://{host}:{port}/sparql')
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        batcher_task.cancel()
+        server['query_executor'].shutdown(wait=False)
+
+
+def create_server(engine):
+    return {
+        'engine': engine,
+        'batcher': create_batcher(engine),
+        'query_executor': ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUERIES),
+        'num_requests': 0,
+    }
+
+
+# Collects the prediction requests of all concurrent queries, so that every hop of every query is scored in a
+# shared batch. The prediction cache is only used by the single scoring thread.
+def create_batcher(engine):
+    return {
+        'engine': engine,
+        'cache': create_prediction_cache(),
+        'pending': [],
+        'num_pending': 0,
+        'ready': asyncio.Event(),
+        'full': asyncio.Event(),
+        'scorer': ThreadPoolExecutor(max_workers=1),
+        'num_batches': 0,
+        'num_queries': 0,
+    }
+
+
+async def submit_predictions(batcher, side, queries, top_k: int, model_name=None):
+    future = asyncio.get_running_loop().create_future()
+    batcher['pending'].append((side, model_name, np.asarray(queries, dtype=np.int64), top_k, future))
+    batcher['num_pending'] += len(queries)
+
+    batcher['ready'].set()
+    if batcher['num_pending'] >= MAX_BATCH_QUERIES:
+        batcher['full'].set()
+    return await future
+
+
+async def run_batcher(batcher):
+    loop = asyncio.get_running_loop()
+    while True:
+        await batcher['ready'].wait()
+        try:
+            await asyncio.wait_for(batcher['full'].wait(), MAX_BATCH_DELAY)
+        except asyncio.TimeoutError:
+            pass
+
+        pending = batcher['pending']
+        batcher['pending'], batcher['num_pending'] = [], 0
+        batcher['ready'].clear()
+        batcher['full'].clear()
+
+        # Requests that arrive while the batch is scored form the next batch. A failing batch fails its requests
+        # only, the batcher keeps serving the next ones.
+        try:
+            results = await loop.run_in_executor(batcher['scorer'], _score_batch, batcher, pending)
+        except Exception as error:
+            results = [error] * len(pending)
+        for (*_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+async def handle_connection(server, reader, writer):
+    try:
+        while True:
+            request = await _read_request(reader)
+            if request is None:
+                break
+            if 'error' in request:
+                # The body of the request is not read, so the rest of the stream cannot be parsed anymore
+                status, message = request['error']
+                writer.write(_format_response(status, 'application/json', {'error': message}, keep_alive=False))
+                await writer.drain()
+                break
+
+            status, content_type, body = await handle_request(server, request)
+            keep_alive = request['headers'].get('connection', '').lower() != 'close'
+            writer.write(_format_response(status, content_type, body, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    # Malformed requests and closed connections end the connection
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_request(server, request):
+    server['num_requests'] += 1
+    url = urlsplit(request['target'])
+
+    if url.path == '/stats':
+        return HTTPStatus.OK, 'application/json', get_server_stats(server)
+    if url.path not in ('/', '/sparql'):
+        return HTTPStatus.NOT_FOUND, 'application/json', {'error': f'Unknown path {url.path}'}
+
+    parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    content_type = request['headers'].get('content-type', '').split(';')[0].strip()
+    if request['method'] == 'POST' and content_type == 'application/sparql-query':
+        parameters['query'] = request['body'].decode()
+    elif request['method'] == 'POST':
+        parameters.update({name: values[-1] for name, values in parse_qs(request['body'].decode()).items()})
+    elif request['method'] != 'GET':
+        return HTTPStatus.METHOD_NOT_ALLOWED, 'application/json', {'error': f'Unsupported method {request["method"]}'}
+
+    accept = request['headers'].get('accept', '')
+    sparql_results = parameters.get('format') == 'sparql-json' or SPARQL_RESULTS_TYPE in accept
+
+    start = timer()
+    try:
+        query = parse_sparql(parameters.get('query', ''))
+        top_k = int(parameters.get('top_k', TOP_K))
+        if not 1 <= top_k <= MAX_TOP_K:
+            raise ValueError(f'top_k has to be between 1 and {MAX_TOP_K}')
+        model_name = parameters.get('model')
+        if model_name is not None and model_name not in server['engine']['model_names']:
+            raise ValueError(f'Unknown model {model_name}')
+
+        loop = asyncio.get_running_loop()
+        predictions = await loop.run_in_executor(server['query_executor'], run_query, server, loop, query, top_k,
+                                                 model_name)
+    except ValueError as error:
+        return HTTPStatus.BAD_REQUEST, 'application/json', {'error': str(error)}
+    except Exception as error:
+        return HTTPStatus.INTERNAL_SERVER_ERROR, 'application/json', {'error': f'{type(error).__name__}: {error}'}
+
+    predictions = predictions.head(query['limit'])
+    if sparql_results:
+        return HTTPStatus.OK, SPARQL_RESULTS_TYPE, format_sparql_results(predictions, query['variables'])
+    return HTTPStatus.OK, 'application/json', {
+        'bindings': format_bindings(predictions, query['variables']),
+        'time': timer() - start,
+    }
+
+
+# Parses a SELECT query over a basic graph pattern, or a basic graph pattern only, into the (s, p, o) patterns of
+# query_planner.py. Entities and relations may be given as IRIs, prefixed names like wd:Q5 and wdt:P31 or labels.
+def parse_sparql(query):
+    match = SELECT_PATTERN.fullmatch(query)
+    if match is None:
+        if '{' in query or '}' in query:
+            raise ValueError('Only SELECT queries over a single basic graph pattern are supported')
+        match = SELECT_PATTERN.fullmatch('{' + query + '}')
+
+    patterns, terms = [], []
+    for token in TERM_PATTERN.findall(match['patterns']) + ['.']:
+        if token != '.':
+            terms.append(_to_label(token))
+            continue
+        if len(terms) not in (0, 3):
+            raise ValueError(f'Triple pattern "{" ".join(terms)}" does not consist of subject, predicate and object')
+        if terms:
+            patterns.append(tuple(terms))
+        terms = []
+    if not patterns:
+        raise ValueError('The query contains no triple patterns')
+
+    pattern_variables = list(dict.fromkeys(term for pattern in patterns for term in (pattern[0], pattern[2])
+                                           if is_variable(term)))
+    variables = (match['variables'] or '*').split()
+    if variables == ['*']:
+        variables = pattern_variables
+    unknown = [variable for variable in variables if variable not in pattern_variables]
+    if unknown:
+        raise ValueError(f'Selected variables {unknown} are not bound by the triple patterns')
+
+    return {
+        'patterns': patterns,
+        'variables': [variable[1:] for variable in variables],
+        'limit': min(int(match['limit'] or MAX_LIMIT), MAX_LIMIT),
+    }
+
+
+# Runs in a query thread, the hops of the query are scored by the batcher in the event loop
+def run_query(server, loop, query, top_k: int, model_name=None):
+    def predict(side, queries, k):
+        return asyncio.run_coroutine_threadsafe(
+            submit_predictions(server['batcher'], side, queries, k, model_name), loop
+        ).result()
+
+    beam_width = max(BEAM_WIDTH, query['limit'])
+    return complete_query(server['engine'], query['patterns'], top_k, beam_width, predict=predict)
+
+
+def format_bindings(predictions, variables):
+    columns = {name: predictions[name].tolist() for name in predictions.columns}
+    return [
+        {
+            **{
+                key: columns[f'{variable}{suffix}'][row]
+                for variable in variables
+                for key, suffix in ((variable, '_label'), (f'{variable}_score', '_score'),
+                                    (f'{variable}_model', '_model'), (f'{variable}_rank', '_rank'))
+            },
+            'rank': columns['combined_rank'][row],
+        }
+        for row in range(len(predictions))
+    ]
+
+
+# SPARQL 1.1 query results JSON, every variable comes with its score, model and rank, the bindings are ordered
+# by the product of the ranks of all hops
+def format_sparql_results(predictions, variables):
+    result_variables = [name for variable in variables
+                        for name in (variable, f'{variable}_score', f'{variable}_model', f'{variable}_rank')]
+
+    bindings = []
+    for binding in format_bindings(predictions, variables):
+        sparql_binding = {}
+        for variable in variables:
+            sparql_binding[variable] = {'type': 'uri', 'value': WIKIDATA_PREFIX + binding[variable]}
+            sparql_binding[f'{variable}_score'] = _typed_literal(f'{binding[f"{variable}_score"]:.6g}', 'float')
+            sparql_binding[f'{variable}_model'] = {'type': 'literal', 'value': binding[f'{variable}_model']}
+            sparql_binding[f'{variable}_rank'] = _typed_literal(binding[f'{variable}_rank'], 'integer')
+        sparql_binding['rank'] = _typed_literal(binding['rank'], 'integer')
+        bindings.append(sparql_binding)
+
+    return {'head': {'vars': result_variables + ['rank']}, 'results': {'bindings': bindings}}
+
+
+def get_server_stats(server):
+    batcher = server['batcher']
+    return {
+        'requests': server['num_requests'],
+        'batches': batcher['num_batches'],
+        'batched_queries': batcher['num_queries'],
+        'mean_batch_size': batcher['num_queries'] / max(1, batcher['num_batches']),
+        'cache_hits': batcher['cache']['hits'],
+        'cache_misses': batcher['cache']['misses'],
+    }
+
+
+def _score_batch(batcher, pending):
+    # One scoring call per side and model for all pending requests, with the largest top k among them
+    results = [None] * len(pending)
+    groups = {}
+    for index, (side, model_name, *_) in enumerate(pending):
+        groups.setdefault((side, model_name), []).append(index)
+
+    for (side, model_name), indices in groups.items():
+        queries = [pending[index][2] for index in indices]
+        top_k = max(pending[index][3] for index in indices)
+        try:
+            top_ids, top_scores, models = predict_cached(batcher['engine'], batcher['cache'], side,
+                                                         np.concatenate(queries), top_k, model_name)
+        # Errors are passed to the requests of the group, e.g. out of memory errors of a single model
+        except Exception as error:
+            for index in indices:
+                results[index] = error
+            continue
+
+        batcher['num_batches'] += 1
+        batcher['num_queries'] += len(top_ids)
+        offsets = np.cumsum([0] + [len(query) for query in queries])
+        for index, start, end in zip(indices, offsets[:-1], offsets[1:]):
+            k = pending[index][3]
+            results[index] = (top_ids[start:end, :k], top_scores[start:end, :k], models[start:end])
+
+    return results
+
+
+def _to_label(term):
+    if is_variable(term):
+        return term
+    # IRIs like https://www.wikidata.org/wiki/Q5 or http://www.wikidata.org/prop/direct/P31 end with the label
+    if term.startswith('<'):
+        return term[1:-1].rstrip('/').rsplit('/', 1)[-1]
+    return term.split(':', 1)[-1]
+
+
+def _typed_literal(value, datatype):
+    return {'type': 'literal', 'datatype': f'{XSD_PREFIX}{datatype}', 'value': str(value)}
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    request = {'method': method.upper(), 'target': target, 'headers': headers, 'body': b''}
+    try:
+        content_length = int(headers.get('content-length', 0))
+    except ValueError:
+        content_length = -1
+    if content_length < 0:
+        return {**request, 'error': (HTTPStatus.BAD_REQUEST, f'Invalid Content-Length {headers["content-length"]}')}
+    if content_length > MAX_REQUEST_SIZE:
+        return {**request, 'error': (HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                     f'Request body is larger than {MAX_REQUEST_SIZE} bytes')}
+
+    if content_length > 0:
+        request['body'] = await reader.readexactly(content_length)
+    return request
+
+
+def _format_response(status, content_type, content, keep_alive):
+    body = json.dumps(content).encode()
+    headers = [
+        f'HTTP/1.1 {status.value} {status.phrase}',
+        f'Content-Type: {content_type}; charset=utf-8',
+        f'Content-Length: {len(body)}',
+        'Access-Control-Allow-Origin: *',
+        f'Connection: {"keep-alive" if keep_alive else "close"}',
+    ]
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,93 @@
-import pandas as pd
+import argparse
+from pathlib import Path
+
+import numpy as np
 import torch
-from pykeen.predict import predict_triples
-from pykeen.models import DistMult, SimplE, TransE
-from pykeen.triples import TriplesFactory
+from numpy.lib.format import open_memmap
 
-# Get torch device
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+from batch_prediction import reduce_batch_size
+from batch_tuner import save_run_metadata, select_device, tune_batch_size
+from model_loading import EMBEDDING_DIMS, MODEL_NAMES, load_model
+from triple_store import SUBSET_TYPES, SubsetType, get_store_dir, open_triple_store
 
 
 def main():
-    model_name = 'transe'
+    parser = argparse.ArgumentParser(description='Score all Wikidata5M triples with the trained models')
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=MODEL_NAMES)
+    parser.add_argument('--dims', nargs='+', type=int, choices=EMBEDDING_DIMS, default=EMBEDDING_DIMS)
+    args = parser.parse_args()
+
+    for embedding_dim in args.dims:
+        print(f'[X] Loading Wikidata5M triple store for dimension {embedding_dim}')
+        store = open_triple_store(get_store_dir(embedding_dim))
+
+        for model_name in args.models:
+            # Empty CUDA cache
+            torch.cuda.empty_cache()
+
+            print(f'[X] Loading {model_name} model with dimension {embedding_dim}')
+            model = load_model(model_name, embedding_dim)
+
+            # Move model to GPU only if it fits into the free GPU memory
+            device = select_device(model)
+            model.to(device).eval()
+
+            settings = tune_batch_size(model, target='triple')
+            output_dir = get_predictions_dir(model_name, embedding_dim)
+            save_run_metadata(output_dir / 'run_metadata.json', 'predictions', settings)
+            print(f'[X] Using device {device} and batch size {settings["batch_size"]}')
+
+            for subset_type in SUBSET_TYPES:
+                print(f'[X] Computing predictions for {store["metadata"]["num_triples"][subset_type]} '
+                      f'{subset_type} triples')
+                compute_predictions(model, store, subset_type, output_dir, settings['batch_size'])
+
+            # Release the model before the next one is loaded
+            del model
+
+
+def get_predictions_dir(model_name, embedding_dim: int, root: str = '.'):
+    return Path(root) / f'embeddings/dim_{embedding_dim}/{model_name}/predicted_scores'
 
-    # Empty CUDA cache
-    torch.cuda.empty_cache()
 
-    print(f'[X] Loading {model_name} model')
-    train_factory = TriplesFactory.from_path_binary(f'embeddings/dim_512/{model_name}/training_factory')
+# Scores the triples of a store subset chunk by chunk and writes them to a float32 array aligned with the
+# columns of the store, so that memory stays bounded by the chunk size and labels are looked up in the store.
+# Chunks that run out of memory are scored again with half the batch size.
+def compute_predictions(model, store, subset_type: SubsetType, output_dir, batch_size: int):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    model = TransE(
-        triples_factory=train_factory,
-        embedding_dim=512
-    )
-    model.load_state_dict(torch.load(f'embeddings/dim_512/{model_name}/trained_model_state_dict.pt'))
-    model.to(device).eval()    # Move model to GPU (comment out when model too big for GPU memory)
+    triples = store[subset_type]
+    num_triples = triples.shape[1]
 
-    print(f'[X] Loading Wikidata5M datasets')
-    wikidata5m_train = pd.read_csv('dataset/wikidata5m/wikidata5m_transductive_train.txt', sep='\t', names=['S', 'P', 'O'])
-    wikidata5m_valid = pd.read_csv('dataset/wikidata5m/wikidata5m_transductive_valid.txt', sep='\t', names=['S', 'P', 'O'])
-    wikidata5m_test = pd.read_csv('dataset/wikidata5m/wikidata5m_transductive_test.txt', sep='\t', names=['S', 'P', 'O'])
-    wikidata5m_all = pd.concat([wikidata5m_train, wikidata5m_valid, wikidata5m_test]).values
+    scores_file = output_dir / f'{subset_type}.npy'
+    temporary_file = output_dir / f'{subset_type}.npy.tmp'
+    scores = open_memmap(temporary_file, mode='w+', dtype=np.float32, shape=(num_triples,))
 
-    print('[X] Start computing predictions for all triples')
+    with torch.inference_mode():
+        start = 0
+        while start < num_triples:
+            chunk = np.ascontiguousarray(triples[:, start:start + batch_size].T, dtype=np.int64)
+            hrt_batch = torch.from_numpy(chunk).to(model.device)
+            try:
+                scores[start:start + len(chunk)] = model.score_hrt(hrt_batch).view(-1).float().cpu().numpy()
+            except (MemoryError, RuntimeError) as error:
+                # Triples cannot be sliced, only the batch size is halved
+                batch_size, _ = reduce_batch_size(error, batch_size, device=model.device)
+                continue
+            start += len(chunk)
 
-    mapped_triples = train_factory.map_triples(wikidata5m_all)
-    mapped_triples.to(device)
+    scores.flush()
+    del scores
+    temporary_file.replace(scores_file)
 
-    pack = predict_triples(model=model, triples=mapped_triples, batch_size=512)
-    scores_df = pack.process(factory=train_factory).df
 
-    print(f'[X] Saving predicted scores')
-    scores_df.to_csv(f'embeddings/dim_512/{model_name}/predicted_scores.csv', index=False)
+def open_predicted_scores(model_name, embedding_dim: int, root: str = '.'):
+    predictions_dir = get_predictions_dir(model_name, embedding_dim, root)
+    return {
+        subset_type: np.load(predictions_dir / f'{subset_type}.npy', mmap_mode='r')
+        for subset_type in SUBSET_TYPES
+    }
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import argparse
 import os
 from timeit import default_timer as timer
 from datetime import timedelta
@@ -5,34 +6,60 @@ from datetime import timedelta
 import numpy as np
 import pandas as pd
 import torch
-from pykeen.evaluation import RankBasedEvaluator, RankBasedMetricResults
 from pykeen.triples import TriplesFactory
-from pykeen.datasets import get_dataset
-from pykeen.evaluation.rank_based_evaluator import _iter_ranks
+
+from filtered_ranking import get_filter_index
+from metrics_cache import update_predicate_metrics
+from model_loading import MODEL_NAMES, load_model
+from pipeline_trace import add_profiler_argument, run_trace
+from sampled_evaluation import CI_TOLERANCE, NUM_SAMPLES, evaluate_sampled_predicate_metrics
+from triple_store import P, get_store_dir, open_triple_store
 
 
 def main():
-    wikidata5m_test_set = pd.read_csv('dataset/wikidata5m/wikidata5m_transductive_test.txt', sep="\t",
-                                      names=['S', 'P', 'O'], header=None)
-    trained_models = get_trained_models()
-    print(
-        f'[X] Loaded {len(trained_models)} trained models and {get_number_of_predicates(wikidata5m_test_set)} test '
-        f'splits per predicate')
+    parser = argparse.ArgumentParser(description='Evaluate the models with dimension 32 per predicate')
+    parser.add_argument('--sampled', action='store_true',
+                        help='Estimate the metrics from sampled candidates with bootstrap confidence intervals')
+    parser.add_argument('--num-samples', type=int, default=NUM_SAMPLES)
+    parser.add_argument('--tolerance', type=float, default=CI_TOLERANCE)
+    add_profiler_argument(parser)
+    args = parser.parse_args()
+
+    with run_trace('compute_predicate_metrics', [f'embeddings/dim_32/{model_name}' for model_name in MODEL_NAMES],
+                   args.profiler):
+        evaluate_predicate_metrics(args.sampled, args.num_samples, args.tolerance)
 
-    wikidata5m_dataset = get_dataset(dataset='Wikidata5M')
 
+def evaluate_predicate_metrics(sampled=False, num_samples: int = NUM_SAMPLES, tolerance: float = CI_TOLERANCE):
+    wikidata5m_store = open_triple_store(get_store_dir(32))
+    print(f'[X] Loaded {len(np.unique(wikidata5m_store["test"][P]))} test splits per predicate')
+
+    num_triples = wikidata5m_store['metadata']['num_triples']
     print(
-        f'[X] Loaded {wikidata5m_dataset.get_normalized_name()} dataset with {wikidata5m_dataset.training.num_triples} '
-        f'training, {wikidata5m_dataset.validation.num_triples} validation and {wikidata5m_dataset.testing.num_triples} '
-        'test triples')
+        f'[X] Loaded Wikidata5M triple store with {num_triples["train"]} training, {num_triples["valid"]} validation '
+        f'and {num_triples["test"]} test triples')
 
     print(f'[X] Starting evaluation on models')
     start = timer()
-    predicate_metrics = evaluate_models_per_predicate(trained_models, wikidata5m_test_set, wikidata5m_dataset)
+    filter_index = get_filter_index(get_store_dir(32))
+
+    if sampled:
+        # Sampled metrics are kept apart from the exact ones, which the other scripts rely on
+        predicate_metrics = pd.concat([
+            evaluate_sampled_predicate_metrics(load_model(model_name, 32), wikidata5m_store, filter_index, model_name,
+                                               num_samples=num_samples, tolerance=tolerance)
+            for model_name in MODEL_NAMES
+        ], ignore_index=True)
+        metrics_file = 'metrics/predicate_metrics_sampled.csv'
+    else:
+        # Only (model, relation) pairs whose model files, test triples or known triples changed are ranked again,
+        # the metrics of all relations are aggregated from the cached ranks
+        predicate_metrics = update_predicate_metrics(MODEL_NAMES, 32, wikidata5m_store, filter_index)
+        metrics_file = 'metrics/predicate_metrics.csv'
 
     print(f'[X] Finished evaluation in {timedelta(seconds=timer() - start)}')
 
-    predicate_metrics.to_csv('metrics/predicate_metrics.csv', index=False)
+    predicate_metrics.to_csv(metrics_file, index=False)
 
 
 def get_number_of_predicates(dataset_df):
@@ -60,58 +87,5 @@ def _load_trained_model(saved_model_dir):
     }
 
 
-def evaluate_models_per_predicate(trained_models, wikidata5m_test_set, dataset):
-    aggregated_metrics = pd.DataFrame()
-    for model_name, result in trained_models.items():
-        model = result['model']
-        training_factory = result['factory']
-
-        test_factory = TriplesFactory.from_labeled_triples(
-            triples=wikidata5m_test_set.values,
-            entity_to_id=training_factory.entity_to_id,
-            relation_to_id=training_factory.relation_to_id
-        )
-
-        evaluator = RankBasedEvaluator(clear_on_finalize=False)
-        evaluator.evaluate(
-            model=model,
-            mapped_triples=test_factory.mapped_triples,
-            additional_filter_triples=[
-                dataset.training.mapped_triples,
-                dataset.validation.mapped_triples
-            ]
-        )
-
-        ranks_df = test_factory.tensor_to_df(
-            tensor=test_factory.mapped_triples,
-            **{"-".join(("rank",) + key): np.concatenate(value) for key, value in evaluator.ranks.items()},
-            **{"-".join(("num_candidates", key)): np.concatenate(value) for key, value in
-               evaluator.num_candidates.items()},
-        )
-
-        for (relation_id, relation_label), group in ranks_df.groupby(by=['relation_id', 'relation_label']):
-            relation_ranks = {}
-            relation_num_candidates = {}
-
-            for column in group.columns:
-                if column.startswith('rank-'):
-                    relation_ranks[tuple(column.split('-')[1:])] = [group[column].values]
-                elif column.startswith('num_candidates-'):
-                    relation_num_candidates[tuple(column.split('-'))[1]] = [group[column].values]
-
-            metric_results = RankBasedMetricResults.from_ranks(
-                metrics=evaluator.metrics,
-                rank_and_candidates=_iter_ranks(ranks=relation_ranks, num_candidates=relation_num_candidates)
-            ).to_df()
-
-            metric_results['relation_id'] = relation_id
-            metric_results['relation_label'] = relation_label
-            metric_results['model'] = model_name
-
-            aggregated_metrics = pd.concat([aggregated_metrics, metric_results], ignore_index=True)
-
-    return aggregated_metrics
-
-
 if __name__ == '__main__':
     main()
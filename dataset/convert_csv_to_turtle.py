@@ -1,23 +1,24 @@
-import pandas as pd
+import sys
+from pathlib import Path
 
-wikidata_prefix = 'https://www.wikidata.org/wiki/'
+# Make the triple store importable when running from the dataset directory
+sys.path.append(str(Path(__file__).resolve().parent.parent))
 
+from rdf_export import export_labeled_triples, export_store
+from triple_store import is_triple_store
 
-def main():
-    df = pd.read_csv('./wikidata5m/wikidata5m_transductive_train.txt', sep='\t', names=['S', 'P', 'O'])
-
-    # Transform triples to Turtle format in the dataframe
-    turtle_df = df.apply(row_to_turtle, axis=1)
-
-    turtle_file = './wikidata5m/wikidata5m_transductive_train.ttl'
-    with open(turtle_file, 'w') as f:
-        f.write(f'@prefix wd: <{wikidata_prefix}>\n\n')
+# Split gzipped Turtle files and a global.graph file, which virtuoso/rdf_loader.sql loads in parallel with
+# ld_dir('.../wikidata5m/rdf', '%.ttl.gz', NULL) and several rdf_loader_run() calls
+output_dir = './wikidata5m/rdf'
 
-    turtle_df.to_csv(turtle_file, mode='a', header=False, index=False)
 
-
-def row_to_turtle(row):
-    return f'wd:{row["S"]} wd:{row["P"]} wd:{row["O"]} .'
+def main():
+    store_dir = './wikidata5m/store/dim_32'
+    if is_triple_store(store_dir):
+        export_store(store_dir, ['train'], output_dir, rdf_format='ttl')
+    else:
+        export_labeled_triples('./wikidata5m/wikidata5m_transductive_train.txt', 'wikidata5m_transductive_train',
+                               output_dir, rdf_format='ttl')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,201 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from triple_store import O, P, S, SUBSET_TYPES, get_store_dir, open_triple_store
+from wikidata_labels import LABEL_DB, fetch_wikidata_labels, get_labels, open_label_index
+
+STATISTICS_DIR = 'statistics'
+
+EXAMPLE_PREDICATE_COUNTS_FILE = 'metrics/example_predicate_counts.csv'
+
+# Number of triples that are encoded at once while reading the store
+CHUNK_SIZE = 10_000_000
+
+# Relations with fewer than this many objects per subject on average are functional on that side,
+# like the 1-1, 1-N, N-1 and N-N relation categories of Bordes et al.
+CATEGORY_THRESHOLD = 1.5
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute per-predicate statistics of Wikidata5M in a single pass')
+    parser.add_argument('--dim', type=int, default=32)
+    parser.add_argument('--subsets', nargs='+', choices=SUBSET_TYPES, default=['train'])
+    parser.add_argument('--example-predicates', nargs='+', default=None,
+                        help=f'Predicates written to {EXAMPLE_PREDICATE_COUNTS_FILE}, by default the ones it contains')
+    args = parser.parse_args()
+
+    statistics = load_dataset_statistics(get_store_dir(args.dim), args.subsets)
+    predicate_statistics = statistics['predicates']
+    print(f'[X] Statistics of {len(predicate_statistics)} predicates in {args.subsets}:')
+    print(predicate_statistics.sort_values('triples', ascending=False).head(10).to_string(index=False))
+    print(predicate_statistics['category'].value_counts().to_string())
+
+    example_predicates = args.example_predicates
+    if example_predicates is None and Path(EXAMPLE_PREDICATE_COUNTS_FILE).exists():
+        example_predicates = pd.read_csv(EXAMPLE_PREDICATE_COUNTS_FILE)['P'].tolist()
+    if example_predicates:
+        label_index = open_label_index(LABEL_DB, fetcher=fetch_wikidata_labels)
+        predicate_counts = get_predicate_counts(statistics, example_predicates,
+                                                get_labels(label_index, example_predicates))
+        predicate_counts.to_csv(EXAMPLE_PREDICATE_COUNTS_FILE, index=False)
+        print(f'[X] Wrote counts of {len(predicate_counts)} predicates to {EXAMPLE_PREDICATE_COUNTS_FILE}')
+
+
+# Loads the statistics of the given subsets of a store, they are computed and cached in the store on first use
+def load_dataset_statistics(store_dir, subset_types=('train',)):
+    statistics_dir = get_statistics_dir(store_dir, subset_types)
+    if not (statistics_dir / 'metadata.json').exists():
+        print(f'[X] Computing statistics of {list(subset_types)} triples in {store_dir}')
+        save_dataset_statistics(compute_dataset_statistics(open_triple_store(store_dir), subset_types),
+                                statistics_dir)
+
+    with open(statistics_dir / 'metadata.json') as metadata_file:
+        metadata = json.load(metadata_file)
+
+    return {
+        'metadata': metadata,
+        'predicates': pd.read_csv(statistics_dir / 'predicates.csv'),
+        'object_degrees': pd.read_csv(statistics_dir / 'object_degrees.csv'),
+        'subject_degrees': pd.read_csv(statistics_dir / 'subject_degrees.csv'),
+    }
+
+
+def get_statistics_dir(store_dir, subset_types=('train',)):
+    return Path(store_dir) / STATISTICS_DIR / '-'.join(subset_types)
+
+
+# Reads the integer-coded triples once and encodes them as (p, s, o) keys. A single sort of the keys removes
+# duplicates and groups the objects of every (p, s) pair, a second sort of the (p, o) keys groups the subjects
+# of every (p, o) pair. All cardinalities are exact counts of the runs of equal keys.
+def compute_dataset_statistics(store, subset_types=('train',), chunk_size: int = CHUNK_SIZE):
+    num_entities = store['metadata']['num_entities']
+    num_relations = store['metadata']['num_relations']
+
+    num_triples = sum(store[subset_type].shape[1] for subset_type in subset_types)
+    keys = np.empty(num_triples, dtype=np.int64)
+    triple_counts = np.zeros(num_relations, dtype=np.int64)
+
+    position = 0
+    for subset_type in subset_types:
+        triples = store[subset_type]
+        for start in range(0, triples.shape[1], chunk_size):
+            chunk = np.asarray(triples[:, start:start + chunk_size], dtype=np.int64)
+            keys[position:position + chunk.shape[1]] = (chunk[P] * num_entities + chunk[S]) * num_entities + chunk[O]
+            triple_counts += np.bincount(chunk[P], minlength=num_relations)
+            position += chunk.shape[1]
+
+    keys.sort()
+    keys = _get_runs(keys)[0]
+
+    # (p, s) keys of the sorted triples are sorted as well
+    subject_keys, objects_per_subject = _get_runs(keys // num_entities)
+    object_keys = (keys // num_entities ** 2) * num_entities + keys % num_entities
+    del keys
+    object_keys.sort()
+    object_keys, subjects_per_object = _get_runs(object_keys)
+
+    subject_relations = subject_keys // num_entities
+    object_relations = object_keys // num_entities
+    num_subjects = np.bincount(subject_relations, minlength=num_relations)
+    num_objects = np.bincount(object_relations, minlength=num_relations)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distinct_triples = np.bincount(subject_relations, weights=objects_per_subject, minlength=num_relations)
+        predicates = pd.DataFrame({
+            'relation_label': np.asarray(store['relation_labels']),
+            'triples': triple_counts,
+            'distinct_triples': distinct_triples.astype(np.int64),
+            'subjects': num_subjects,
+            'objects': num_objects,
+            'objects_per_subject': distinct_triples / num_subjects,
+            'subjects_per_object': distinct_triples / num_objects,
+            'max_objects_per_subject': _get_maxima(subject_relations, objects_per_subject, num_relations),
+            'max_subjects_per_object': _get_maxima(object_relations, subjects_per_object, num_relations),
+            # Shares of subjects with a single object and of objects with a single subject
+            'functional_ratio': np.bincount(subject_relations, weights=objects_per_subject == 1,
+                                            minlength=num_relations) / num_subjects,
+            'inverse_functional_ratio': np.bincount(object_relations, weights=subjects_per_object == 1,
+                                                    minlength=num_relations) / num_objects,
+        })
+
+    head_side = np.where(predicates['subjects_per_object'] < CATEGORY_THRESHOLD, '1', 'N')
+    tail_side = np.where(predicates['objects_per_subject'] < CATEGORY_THRESHOLD, '1', 'N')
+    predicates['category'] = np.char.add(np.char.add(head_side, '-'), tail_side)
+
+    return {
+        'metadata': {
+            'subset_types': list(subset_types),
+            'num_triples': num_triples,
+            'num_distinct_triples': int(distinct_triples.sum()),
+        },
+        'predicates': predicates[predicates['triples'] > 0].reset_index(drop=True),
+        'object_degrees': _get_degree_distribution(subject_relations, objects_per_subject, store['relation_labels']),
+        'subject_degrees': _get_degree_distribution(object_relations, subjects_per_object, store['relation_labels']),
+    }
+
+
+def save_dataset_statistics(statistics, statistics_dir):
+    statistics_dir = Path(statistics_dir)
+    statistics_dir.mkdir(parents=True, exist_ok=True)
+    for name in ('predicates', 'object_degrees', 'subject_degrees'):
+        statistics[name].to_csv(statistics_dir / f'{name}.csv', index=False)
+
+    # The metadata is written last and marks the statistics as complete
+    with open(statistics_dir / 'metadata.json', 'w') as metadata_file:
+        json.dump(statistics['metadata'], metadata_file, indent=2)
+
+
+# Counts in the format of metrics/example_predicate_counts.csv
+def get_predicate_counts(statistics, predicates, property_labels):
+    predicate_counts = statistics['predicates'].set_index('relation_label').loc[list(predicates)].reset_index()
+    return pd.DataFrame({
+        'P': predicate_counts['relation_label'],
+        'wd_label': predicate_counts['relation_label'].map(property_labels),
+        'pred_count': predicate_counts['triples'],
+        'total_subject_count': predicate_counts['subjects'],
+        'total_object_count': predicate_counts['objects'],
+    }).sort_values('P', ignore_index=True)
+
+
+# Number of distinct objects of every subject of the predicates, expanded from the degree distribution
+def get_object_counts_per_subject(statistics, predicates):
+    degrees = statistics['object_degrees']
+    degrees = degrees[degrees['relation_label'].isin(predicates)]
+    return pd.DataFrame({
+        'P': np.repeat(degrees['relation_label'].to_numpy(), degrees['count'].to_numpy()),
+        'object_count': np.repeat(degrees['degree'].to_numpy(), degrees['count'].to_numpy()),
+    })
+
+
+def _get_runs(sorted_keys):
+    # Distinct keys of a sorted array and the lengths of their runs
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    return sorted_keys[starts], np.diff(np.append(starts, len(sorted_keys)))
+
+
+def _get_maxima(relations, degrees, num_relations):
+    # The pairs are sorted by relation, so every relation is a contiguous range
+    maxima = np.zeros(num_relations, dtype=np.int64)
+    relation_ids, lengths = _get_runs(relations)
+    if len(relation_ids) > 0:
+        maxima[relation_ids] = np.maximum.reduceat(degrees, np.cumsum(lengths) - lengths)
+    return maxima
+
+
+def _get_degree_distribution(relations, degrees, relation_labels):
+    # Number of pairs of every (relation, degree) combination
+    num_degrees = degrees.max(initial=0) + 1
+    keys, counts = np.unique(relations * num_degrees + degrees, return_counts=True)
+    return pd.DataFrame({
+        'relation_label': np.asarray(relation_labels)[keys // num_degrees],
+        'degree': keys % num_degrees,
+        'count': counts,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import os
+from datetime import timedelta
+from itertools import product
+from multiprocessing import get_context
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+import torch
+
+from batch_tuner import get_memory_budget, tune_batch_size
+from filter_index import open_filter_index
+from filtered_ranking import compute_filtered_ranks, get_filter_index
+from metric_aggregation import aggregate_predicate_metrics
+from model_loading import EMBEDDING_DIMS, MODEL_NAMES, load_model, save_predicate_metrics
+from pipeline_trace import add_profiler_argument, run_trace, trace_stage
+from triple_store import P, get_store_dir, open_triple_store
+
+# Number of test shards per model, so that a single large model does not
+# keep one worker busy while the others are idle
+NUM_SHARDS = 4
+
+# State of a worker process, filled by _init_worker
+_worker_state = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate all models per predicate in a process pool')
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=MODEL_NAMES)
+    parser.add_argument('--dims', nargs='+', type=int, choices=EMBEDDING_DIMS, default=EMBEDDING_DIMS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--shards', type=int, default=NUM_SHARDS)
+    parser.add_argument('--batch-size', type=int, default=None)
+    add_profiler_argument(parser)
+    args = parser.parse_args()
+
+    print(f'[X] Evaluating {len(args.models)} models with dimensions {args.dims} in {args.shards} shards '
+          f'on {args.workers} workers with {args.threads_per_worker} threads each')
+    start = timer()
+    trace_dirs = [f'embeddings/dim_{embedding_dim}/{model_name}' for embedding_dim in args.dims
+                  for model_name in args.models]
+    with run_trace('evaluation_scheduler', trace_dirs, args.profiler):
+        predicate_metrics = evaluate_in_parallel(args.models, args.dims, args.workers, args.threads_per_worker,
+                                                 args.shards, args.batch_size)
+        print(f'[X] Finished evaluation in {timedelta(seconds=timer() - start)}')
+
+        for embedding_dim, metrics in predicate_metrics.items():
+            save_predicate_metrics(metrics, embedding_dim)
+
+
+def evaluate_in_parallel(model_names, embedding_dims, num_workers, threads_per_worker=1, num_shards=NUM_SHARDS,
+                         batch_size=None):
+    stores = {embedding_dim: open_triple_store(get_store_dir(embedding_dim)) for embedding_dim in embedding_dims}
+
+    # Model-major order, so that a worker tends to receive consecutive shards of the model it has loaded
+    work_units = list(product(embedding_dims, model_names, range(num_shards)))
+
+    # The filter indexes are built once and memory-mapped by every worker, which shares their pages
+    filter_dirs = {embedding_dim: get_store_dir(embedding_dim) for embedding_dim in embedding_dims}
+    for filter_dir in filter_dirs.values():
+        get_filter_index(filter_dir)
+
+    # Spawned workers do not inherit the thread pools of the parent's torch runtime
+    context = get_context('spawn')
+    num_workers = min(num_workers, len(work_units))
+
+    # Without a fixed batch size, every worker tunes its batch size to its share of the available memory
+    memory_budget = get_memory_budget() // num_workers
+    num_triples = sum(store['metadata']['num_triples']['test'] for store in stores.values()) * len(model_names)
+
+    # The stages of the workers are not traced, their CPU time is counted once the pool is closed
+    with trace_stage('evaluate_shards', num_triples=num_triples, batch_size=batch_size), \
+            context.Pool(processes=num_workers, initializer=_init_worker,
+                         initargs=(threads_per_worker, filter_dirs, batch_size, memory_budget)) as pool:
+        shard_results = {}
+        for work_unit, relation_ids, ranks, num_candidates in pool.imap_unordered(
+                _evaluate_work_unit, [(*work_unit, num_shards) for work_unit in work_units]):
+            print(f'[X] Finished shard {work_unit[2] + 1}/{num_shards} of {work_unit[1]} with dimension '
+                  f'{work_unit[0]}')
+            shard_results[work_unit] = (relation_ids, ranks, num_candidates)
+
+    return {
+        embedding_dim: merge_shard_results(shard_results, embedding_dim, model_names, num_shards,
+                                           stores[embedding_dim]['relation_labels'])
+        for embedding_dim in embedding_dims
+    }
+
+
+def merge_shard_results(shard_results, embedding_dim, model_names, num_shards, relation_labels):
+    # Shards are concatenated in their test set order, independent of the order in which they finished
+    model_metrics = []
+    for model_name in model_names:
+        shards = [shard_results[embedding_dim, model_name, shard_index] for shard_index in range(num_shards)]
+        shards = [shard for shard in shards if len(shard[0]) > 0]
+        # An empty or fully unmapped test split leaves no triples to aggregate
+        if not shards:
+            print(f'[X] No test triples of {model_name} at dim {embedding_dim}')
+            continue
+        ranks = {key: np.concatenate([shard[1][key] for shard in shards]) for key in shards[0][1]}
+        num_candidates = {key: np.concatenate([shard[2][key] for shard in shards]) for key in shards[0][2]}
+
+        model_metrics.append(aggregate_predicate_metrics(
+            relation_ids=np.concatenate([shard[0] for shard in shards]),
+            ranks=ranks,
+            num_candidates=num_candidates,
+            relation_labels=relation_labels,
+            model_name=model_name
+        ))
+
+    if not model_metrics:
+        return pd.DataFrame(columns=['Side', 'Type', 'Metric', 'Value', 'relation_id', 'relation_label', 'model'])
+    return pd.concat(model_metrics, ignore_index=True)
+
+
+def _init_worker(threads_per_worker, filter_dirs, batch_size, memory_budget):
+    torch.set_num_threads(threads_per_worker)
+
+    _worker_state.update({
+        'filter_indexes': {
+            embedding_dim: open_filter_index(filter_dir) for embedding_dim, filter_dir in filter_dirs.items()
+        },
+        'batch_size': batch_size,
+        'memory_budget': memory_budget,
+        'model_key': None,
+        'model': None,
+        'settings': None,
+    })
+
+
+def _get_worker_model(model_name, embedding_dim):
+    # Only the last model is kept, the larger models do not fit into memory more than once per worker
+    if _worker_state['model_key'] != (model_name, embedding_dim):
+        _worker_state['model'] = None
+        _worker_state['model'] = load_model(model_name, embedding_dim).eval()
+        _worker_state['model_key'] = (model_name, embedding_dim)
+
+        if _worker_state['batch_size'] is None:
+            _worker_state['settings'] = tune_batch_size(_worker_state['model'],
+                                                        memory_budget=_worker_state['memory_budget'])
+        else:
+            _worker_state['settings'] = {'batch_size': _worker_state['batch_size'], 'slice_size': None}
+    return _worker_state['model'], _worker_state['settings']
+
+
+def _evaluate_work_unit(work_unit):
+    embedding_dim, model_name, shard_index, num_shards = work_unit
+
+    test_triples = open_triple_store(get_store_dir(embedding_dim))['test']
+    bounds = np.linspace(0, test_triples.shape[1], num_shards + 1).astype(np.int64)
+    shard_triples = np.ascontiguousarray(test_triples[:, bounds[shard_index]:bounds[shard_index + 1]].T,
+                                         dtype=np.int64)
+    if len(shard_triples) == 0:
+        return (embedding_dim, model_name, shard_index), shard_triples[:, P], {}, {}
+
+    model, settings = _get_worker_model(model_name, embedding_dim)
+    ranks, num_candidates = compute_filtered_ranks(
+        model=model,
+        mapped_triples=shard_triples,
+        filter_index=_worker_state['filter_indexes'][embedding_dim],
+        batch_size=settings['batch_size'],
+        slice_size=settings['slice_size']
+    )
+    return (embedding_dim, model_name, shard_index), shard_triples[:, P], ranks, num_candidates
+
+
+if __name__ == '__main__':
+    main()
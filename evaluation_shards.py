@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from filtered_ranking import compute_filtered_ranks
+from metrics_cache import get_files_fingerprint
+from triple_store import P
+
+# Number of test shards whose ranks are persisted independently
+NUM_SHARDS = 64
+
+JOURNAL_FILE = 'journal.jsonl'
+
+
+# Evaluates the test triples shard by shard and persists the ranks of every finished shard, so that a
+# restarted run only evaluates the shards that are missing from the journal. The journal starts with the
+# fingerprint of get_evaluation_fingerprint, shards of a journal with another fingerprint are evaluated again.
+def evaluate_shards(model, test_triples, filter_index, shard_dir, num_shards: int = NUM_SHARDS, batch_size=None,
+                    slice_size=None, fingerprint=None):
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    if read_journal_header(shard_dir).get('fingerprint') != fingerprint:
+        if (shard_dir / JOURNAL_FILE).exists():
+            print(f'[X] Discarding the shards in {shard_dir}, they were evaluated with another model, filter index '
+                  f'or test set')
+        _clear_shards(shard_dir)
+        _write_journal_header(shard_dir, num_shards, fingerprint)
+
+    journal = read_journal(shard_dir, num_shards)
+    if journal:
+        print(f'[X] Resuming evaluation, {len(journal)} of {num_shards} shards already finished')
+
+    bounds = get_shard_bounds(len(test_triples), num_shards)
+    for shard_index in range(num_shards):
+        start, end = int(bounds[shard_index]), int(bounds[shard_index + 1])
+        if shard_index in journal:
+            if (journal[shard_index]['start'], journal[shard_index]['end']) != (start, end):
+                raise ValueError(f'Shard {shard_index} in {shard_dir} was evaluated on a different test set')
+            continue
+
+        print(f'[X] Evaluating shard {shard_index + 1}/{num_shards} with test triples {start} to {end}')
+        shard_triples = np.asarray(test_triples[start:end], dtype=np.int64)
+
+        # The filter index contains the whole test set, not only the triples of this shard
+        ranks, num_candidates = {}, {}
+        if end > start:
+            ranks, num_candidates = compute_filtered_ranks(model, shard_triples, filter_index, batch_size=batch_size,
+                                                           slice_size=slice_size)
+
+        save_shard(shard_dir, shard_index, num_shards, start, end, shard_triples[:, P], ranks, num_candidates)
+
+
+# Fingerprint of everything the shard ranks depend on: the model files, the test triples and the store
+# triples that the filter index was built from
+def get_evaluation_fingerprint(model_paths, test_triples, filter_index, root: str = '.'):
+    test_hash = hashlib.sha256(np.ascontiguousarray(test_triples, dtype=np.int64).tobytes()).hexdigest()
+    filter_hash = hashlib.sha256(json.dumps(filter_index['metadata'], sort_keys=True).encode()).hexdigest()
+    return hashlib.sha256('\n'.join([get_files_fingerprint(model_paths, root), test_hash, filter_hash])
+                          .encode()).hexdigest()
+
+
+def get_shard_bounds(num_triples, num_shards: int = NUM_SHARDS):
+    return np.linspace(0, num_triples, num_shards + 1).astype(np.int64)
+
+
+def get_shard_file(shard_index):
+    return f'shard_{shard_index:05d}.npz'
+
+
+def save_shard(shard_dir, shard_index, num_shards, start, end, relation_ids, ranks, num_candidates):
+    shard_dir = Path(shard_dir)
+
+    # Realistic ranks are multiples of 0.5 below 2^23, which float32 represents exactly
+    arrays = {'relation_ids': relation_ids.astype(np.int32)}
+    arrays.update({'-'.join(('rank',) + key): value.astype(np.float32) for key, value in ranks.items()})
+    arrays.update({'-'.join(('num_candidates', key)): value.astype(np.int32) for key, value in num_candidates.items()})
+
+    # Write to a temporary file first, a crash must not leave a truncated shard behind
+    shard_file = shard_dir / get_shard_file(shard_index)
+    temporary_file = shard_dir / f'{shard_file.name}.tmp'
+    with open(temporary_file, 'wb') as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_file, shard_file)
+
+    # The journal entry is only written after the shard file is complete
+    entry = {'shard': shard_index, 'num_shards': num_shards, 'start': start, 'end': end, 'file': shard_file.name}
+    with open(shard_dir / JOURNAL_FILE, 'a') as journal_file:
+        journal_file.write(json.dumps(entry) + '\n')
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def read_journal(shard_dir, num_shards: int = NUM_SHARDS):
+    journal_path = Path(shard_dir) / JOURNAL_FILE
+    if not journal_path.exists():
+        return {}
+
+    journal = {}
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            # A partially written last line belongs to a shard that was not finished
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+            # The header holds the fingerprint of the run
+            if 'shard' not in entry:
+                continue
+            if entry['num_shards'] != num_shards:
+                raise ValueError(f'Journal in {shard_dir} was written for {entry["num_shards"]} shards, '
+                                 f'but {num_shards} shards were requested')
+            if (Path(shard_dir) / entry['file']).exists():
+                journal[entry['shard']] = entry
+
+    return journal
+
+
+def read_journal_header(shard_dir):
+    journal_path = Path(shard_dir) / JOURNAL_FILE
+    if not journal_path.exists():
+        return {}
+
+    with open(journal_path) as journal_file:
+        try:
+            entry = json.loads(journal_file.readline())
+        except json.JSONDecodeError:
+            return {}
+    return entry if 'shard' not in entry else {}
+
+
+def _write_journal_header(shard_dir, num_shards, fingerprint):
+    with open(Path(shard_dir) / JOURNAL_FILE, 'w') as journal_file:
+        journal_file.write(json.dumps({'num_shards': num_shards, 'fingerprint': fingerprint}) + '\n')
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def _clear_shards(shard_dir):
+    (Path(shard_dir) / JOURNAL_FILE).unlink(missing_ok=True)
+    for shard_file in Path(shard_dir).glob('shard_*.npz*'):
+        shard_file.unlink()
+
+
+# Reads the ranks of all shards in test set order, in the format of collect_evaluator_ranks
+def load_shard_ranks(shard_dir, num_shards: int = NUM_SHARDS):
+    journal = read_journal(shard_dir, num_shards)
+    missing = sorted(set(range(num_shards)) - set(journal))
+    if missing:
+        raise ValueError(f'Shards {missing} in {shard_dir} have not been evaluated yet')
+
+    relation_ids, ranks, num_candidates = [], {}, {}
+    for shard_index in range(num_shards):
+        with np.load(Path(shard_dir) / journal[shard_index]['file']) as shard:
+            relation_ids.append(shard['relation_ids'])
+            for name in shard.files:
+                if name.startswith('rank-'):
+                    ranks.setdefault(tuple(name.split('-')[1:]), []).append(shard[name])
+                elif name.startswith('num_candidates-'):
+                    num_candidates.setdefault(name.split('-')[1], []).append(shard[name])
+
+    return (
+        np.concatenate(relation_ids),
+        {key: np.concatenate(value) for key, value in ranks.items()},
+        {key: np.concatenate(value) for key, value in num_candidates.items()}
+    )
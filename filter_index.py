@@ -0,0 +1,144 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from batch_prediction import TargetSide
+from pipeline_trace import run_trace, trace_stage
+from triple_store import O, P, S, STORE_FACTORIES, SUBSET_TYPES, is_triple_store, open_triple_store
+
+# Every known true triple of a store is filtered during ranking, which are the train, valid and test triples
+FILTER_DIR = 'filter'
+
+# Key columns and target column of the filter indexes, (h, r) -> tails and (r, t) -> heads
+FILTER_SIDES = {
+    'tail': (S, P, O),
+    'head': (P, O, S),
+}
+
+
+def main():
+    for store_dir in STORE_FACTORIES:
+        if not is_triple_store(store_dir):
+            print(f'[X] Skipping {store_dir}, no triple store found')
+            continue
+
+        print(f'[X] Building (h, r) and (r, t) filter indexes for {store_dir}')
+        with run_trace('filter_index', [Path(store_dir) / FILTER_DIR]):
+            build_filter_index(store_dir, open_triple_store(store_dir))
+
+
+def build_filter_index(store_dir, store):
+    filter_dir = Path(store_dir) / FILTER_DIR
+    filter_dir.mkdir(exist_ok=True)
+    (filter_dir / 'metadata.json').unlink(missing_ok=True)
+
+    triples = np.concatenate([np.asarray(store[subset_type]) for subset_type in SUBSET_TYPES], axis=1)
+    num_entities = store['metadata']['num_entities']
+    num_relations = store['metadata']['num_relations']
+
+    num_pairs = {}
+    with trace_stage('build_filter_index', num_triples=triples.shape[1]):
+        for side, (first, second, target) in FILTER_SIDES.items():
+            keys = _get_pair_keys(triples[first], triples[second], num_entities, num_relations, side)
+
+            targets = triples[target]
+            order = np.lexsort((targets, keys))
+            keys, targets = keys[order], targets[order]
+
+            # Duplicates across the subsets are filtered only once
+            unique = np.ones(len(keys), dtype=bool)
+            unique[1:] = (keys[1:] != keys[:-1]) | (targets[1:] != targets[:-1])
+            keys, targets = keys[unique], targets[unique]
+            pair_keys, counts = np.unique(keys, return_counts=True)
+
+            # offsets[i]:offsets[i + 1] is the range of targets of the pair with key pair_keys[i]
+            offsets = np.zeros(len(pair_keys) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+
+            np.save(filter_dir / f'{side}_keys.npy', pair_keys)
+            np.save(filter_dir / f'{side}_offsets.npy', offsets)
+            np.save(filter_dir / f'{side}_targets.npy', targets.astype(np.int32))
+            num_pairs[side] = len(pair_keys)
+
+    with open(filter_dir / 'metadata.json', 'w') as metadata_file:
+        json.dump({
+            'num_entities': num_entities,
+            'num_relations': num_relations,
+            'num_triples': triples.shape[1],
+            'num_pairs': num_pairs,
+            'store': _get_store_signature(store['metadata']),
+        }, metadata_file, indent=2)
+
+
+# A filter index is only valid for the store triples it was built from, an index of a store that was ingested
+# again, e.g. after the test split gained triples, has to be rebuilt
+def is_filter_index(store_dir):
+    metadata_path = Path(store_dir) / FILTER_DIR / 'metadata.json'
+    if not metadata_path.exists() or not is_triple_store(store_dir):
+        return False
+
+    with open(metadata_path) as metadata_file:
+        metadata = json.load(metadata_file)
+    with open(Path(store_dir) / 'metadata.json') as store_metadata_file:
+        store_metadata = json.load(store_metadata_file)
+    return metadata.get('store') == _get_store_signature(store_metadata)
+
+
+def open_filter_index(store_dir):
+    filter_dir = Path(store_dir) / FILTER_DIR
+    with open(filter_dir / 'metadata.json') as metadata_file:
+        metadata = json.load(metadata_file)
+
+    return {
+        'metadata': metadata,
+        **{
+            side: {
+                name: np.load(filter_dir / f'{side}_{name}.npy', mmap_mode='r')
+                for name in ('keys', 'offsets', 'targets')
+            }
+            for side in FILTER_SIDES
+        }
+    }
+
+
+# Returns the known targets of a batch of (n, 3) triples as (batch_index, entity_id) pairs,
+# the sparse counterpart of pykeen's create_sparse_positive_filter_
+def get_filter_pairs(filter_index, side: TargetSide, batch):
+    batch = np.asarray(batch, dtype=np.int64)
+    first, second, _ = FILTER_SIDES[side]
+    keys = _get_pair_keys(batch[:, first], batch[:, second], filter_index['metadata']['num_entities'],
+                          filter_index['metadata']['num_relations'], side)
+
+    pair_keys = filter_index[side]['keys']
+    offsets = filter_index[side]['offsets']
+    positions = np.searchsorted(pair_keys, keys).clip(max=len(pair_keys) - 1)
+    found = pair_keys[positions] == keys
+
+    starts = np.where(found, offsets[positions], 0)
+    lengths = np.where(found, offsets[positions + 1] - starts, 0)
+
+    # Gather all target ranges at once, every element is its range start plus its position within the range
+    batch_indices = np.repeat(np.arange(len(batch)), lengths)
+    range_offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    entity_ids = filter_index[side]['targets'][np.repeat(starts, lengths) + range_offsets]
+
+    return batch_indices, entity_ids.astype(np.int64)
+
+
+def _get_store_signature(store_metadata):
+    return {
+        'num_triples': store_metadata['num_triples'],
+        'fingerprints': store_metadata.get('fingerprints'),
+    }
+
+
+def _get_pair_keys(first, second, num_entities, num_relations, side: TargetSide):
+    # (h, r) pairs are keyed by h * num_relations + r and (r, t) pairs by r * num_entities + t
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    return first * (num_relations if side == 'tail' else num_entities) + second
+
+
+if __name__ == '__main__':
+    main()
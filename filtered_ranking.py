@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+from batch_prediction import MEMORY_BUDGET, get_query_chunk_size, reduce_batch_size
+from filter_index import build_filter_index, get_filter_pairs, is_filter_index, open_filter_index
+from pipeline_trace import trace_stage
+from triple_store import O, S, open_triple_store
+
+RANK_SIDES = {
+    'head': S,
+    'tail': O,
+}
+
+
+def get_filter_index(store_dir):
+    # The filter index is built once per store and then shared by all models evaluated on it, it is built again
+    # once the store has been ingested again
+    if not is_filter_index(store_dir):
+        print(f'[X] Building filter index for {store_dir}')
+        build_filter_index(store_dir, open_triple_store(store_dir))
+    return open_filter_index(store_dir)
+
+
+# Filtered head and tail ranks of (n, 3) mapped triples, in the format of collect_evaluator_ranks.
+# Instead of comparing every batch with all filter triples, the known targets of a batch are looked
+# up in the filter index and masked out of the scores. A batch that runs out of memory is retried with
+# half the batch size, or half the slice size once single triples do not fit.
+def compute_filtered_ranks(model, mapped_triples, filter_index, batch_size=None, slice_size=None,
+                           memory_budget: int = MEMORY_BUDGET):
+    mapped_triples = np.asarray(mapped_triples, dtype=np.int64)
+    batch_size = batch_size or get_query_chunk_size(model, memory_budget)
+
+    ranks = {(side, rank_type): [] for side in RANK_SIDES for rank_type in ('optimistic', 'realistic', 'pessimistic')}
+    num_candidates = {side: [] for side in RANK_SIDES}
+
+    model.eval()
+    with torch.inference_mode(), trace_stage('rank', num_triples=len(mapped_triples), batch_size=batch_size):
+        start = 0
+        while start < len(mapped_triples):
+            batch = mapped_triples[start:start + batch_size]
+            try:
+                batch_ranks, batch_candidates = _rank_batch(model, batch, filter_index, slice_size)
+            except (MemoryError, RuntimeError) as error:
+                batch_size, slice_size = reduce_batch_size(error, batch_size, slice_size, model.num_entities,
+                                                           model.device)
+                continue
+
+            for key, value in batch_ranks.items():
+                ranks[key].append(value)
+            for side, value in batch_candidates.items():
+                num_candidates[side].append(value)
+            start += len(batch)
+
+    return (
+        {key: np.concatenate(value) for key, value in ranks.items()},
+        {key: np.concatenate(value) for key, value in num_candidates.items()}
+    )
+
+
+def _rank_batch(model, batch, filter_index, slice_size=None):
+    hrt_batch = torch.as_tensor(batch, device=model.device)
+    batch_range = torch.arange(len(batch), device=model.device)
+
+    ranks = {}
+    num_candidates = {}
+    for side, column in RANK_SIDES.items():
+        scores = model.predict(hrt_batch=hrt_batch, target=side, slice_size=slice_size)
+        true_scores = scores[batch_range, hrt_batch[:, column]]
+
+        # Mask all known targets with NaN and restore the true target afterwards, like pykeen's filter_scores_
+        batch_indices, entity_ids = get_filter_pairs(filter_index, side, batch)
+        scores[torch.as_tensor(batch_indices, device=model.device),
+               torch.as_tensor(entity_ids, device=model.device)] = float('nan')
+        scores[batch_range, hrt_batch[:, column]] = true_scores
+
+        # Same rank definitions as pykeen's Ranks.from_scores, NaN scores are never counted
+        optimistic = (scores > true_scores[:, None]).sum(dim=1) + 1
+        pessimistic = (scores >= true_scores[:, None]).sum(dim=1)
+        ranks[side, 'optimistic'] = optimistic.cpu().numpy()
+        ranks[side, 'pessimistic'] = pessimistic.cpu().numpy()
+        ranks[side, 'realistic'] = ((optimistic + pessimistic).float() * 0.5).cpu().numpy()
+        num_candidates[side] = torch.isfinite(scores).sum(dim=1).cpu().numpy()
+
+    return ranks, num_candidates
@@ -1,11 +1,25 @@
-import numpy as np
+import argparse
+
 import pandas as pd
-import requests
 from matplotlib import pyplot as plt
 
+from predicate_analysis import build_predicate_tensor, get_metric_variances, get_model_extremes, \
+    get_rank_agreement, load_predicate_metrics
+from wikidata_labels import LABEL_DB, fetch_wikidata_labels, get_labels, open_label_index
+
 
 def main():
-    predicate_metrics = pd.read_csv('metrics/predicate_metrics.csv')
+    parser = argparse.ArgumentParser(description='Find the predicates on which the models differ the most')
+    parser.add_argument('--metrics-file', default='metrics/predicate_metrics.csv',
+                        help='Exact metrics or the sampled ones of compute_predicate_metrics.py --sampled')
+    parser.add_argument('--dims', nargs='+', type=int, default=None,
+                        help='Compare the models over these dimensions instead of the metrics file')
+    args = parser.parse_args()
+
+    if args.dims is None:
+        predicate_metrics = pd.read_csv(args.metrics_file)
+    else:
+        predicate_metrics = load_predicate_metrics(args.dims)
 
     # Only consider realistic values, evaluated on both ends
     predicate_metrics = predicate_metrics.query('Type == "realistic" and Side == "both"')
@@ -15,12 +29,23 @@ def main():
 
     predicate_metrics = filter_metrics(predicate_metrics, selected_metrics)
 
-    variances_df = find_largest_metric_variances(predicate_metrics).head(5)
+    predicate_tensor = build_predicate_tensor(predicate_metrics, selected_metrics)
+    variances_df = get_metric_variances(predicate_tensor).head(5)
 
     print('Selected predicates and variances:')
     print(variances_df)
 
-    example_predicates = predicate_metrics[predicate_metrics['relation_label'].isin(variances_df['relation_label'])]
+    selected = predicate_metrics['relation_label'].isin(variances_df['relation_label'])
+    print('Agreement of the model rankings over the metrics:')
+    print(get_rank_agreement(predicate_tensor).loc[variances_df['relation_label']])
+    print('Best and worst models:')
+    extremes = get_model_extremes(predicate_tensor)
+    print(extremes[extremes['relation_label'].isin(variances_df['relation_label'])].to_string(index=False))
+
+    # The plots show a single dimension
+    if 'dim' in predicate_metrics.columns:
+        selected &= predicate_metrics['dim'] == predicate_metrics['dim'].min()
+    example_predicates = predicate_metrics[selected]
 
     plot_selected_predicate_metrics(example_predicates)
 
@@ -29,49 +54,9 @@ def filter_metrics(predicate_metrics, selected_metrics):
     return predicate_metrics[predicate_metrics['Metric'].isin(selected_metrics)]
 
 
+# Mean variance of the metrics over the models per predicate, from a single pivot of the long-format metrics
 def find_largest_metric_variances(predicate_metrics):
-    predicates = predicate_metrics['relation_label'].unique()
-    metric_names = predicate_metrics['Metric'].unique()
-    model_names = predicate_metrics['model'].unique()
-
-    metric_values = np.empty((len(predicates), len(metric_names), len(model_names)))
-
-    for y, metric_name in enumerate(metric_names):
-        for z, model_name in enumerate(model_names):
-            metrics = predicate_metrics.query('Metric == @metric_name and model == @model_name')
-
-            metric_values[:, y, z] = metrics['Value'].values
-
-    metric_variances = np.var(metric_values, axis=2).mean(axis=1)
-
-    variances_df = pd.DataFrame({
-        'relation_label': predicates,
-        'variance': metric_variances
-    })
-
-    return variances_df.sort_values(by='variance', ascending=False, ignore_index=True)
-
-
-def find_largest_metric_variances_easy(predicate_metrics):
-    predicates = predicate_metrics['relation_label'].unique()
-
-    metric_variances = []
-    for pred in predicates:
-        arithmetic_mean_rank = predicate_metrics.query('relation_label == @pred and Metric == "arithmetic_mean_rank"')['Value']
-        hits_at_5 = predicate_metrics.query('relation_label == @pred and Metric == "hits_at_5"')['Value']
-        hits_at_10 = predicate_metrics.query('relation_label == @pred and Metric == "hits_at_10"')['Value']
-
-        pred_variance = np.mean([
-            np.var(arithmetic_mean_rank),
-            np.var(hits_at_5),
-            np.var(hits_at_10)
-        ])
-
-        metric_variances.append([pred, pred_variance])
-
-    variances_df = pd.DataFrame(metric_variances, columns=['relation_label', 'variance'])
-
-    return variances_df.sort_values(by='variance', ascending=False, ignore_index=True)
+    return get_metric_variances(build_predicate_tensor(predicate_metrics))
 
 
 def plot_selected_predicate_metrics(predicate_metrics):
@@ -110,22 +95,9 @@ def plot_selected_predicate_metrics(predicate_metrics):
 
 
 def get_wikidata_property_names(property_ids: list):
-    wikidata_api = 'https://www.wikidata.org/w/api.php'
-    params = {
-        'action': 'wbgetentities',
-        'ids': '|'.join(property_ids),
-        'languages': 'en',
-        'props': 'labels',
-        'format': 'json'
-    }
-
-    response = requests.get(wikidata_api, params).json()
-
-    property_names = []
-    for pid in property_ids:
-        property_names.append(response['entities'][pid]['labels']['en']['value'])
-
-    return property_names
+    # Labels come from the local label index, only unknown ids are fetched from the Wikidata API
+    label_index = open_label_index(LABEL_DB, fetcher=fetch_wikidata_labels)
+    return get_labels(label_index, property_ids)
 
 
 if __name__ == '__main__':
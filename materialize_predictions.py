@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import torch
+
+from batch_prediction import TOP_K
+from completion_engine import DECISIVE_METRIC, complete_targets, get_route_names, load_completion_engine
+from filter_index import get_filter_pairs, open_filter_index
+from filtered_ranking import get_filter_index
+from metrics_store import get_metric_optimum, get_metric_slice, load_metrics_store
+from model_loading import MODEL_NAMES
+from pipeline_trace import add_profiler_argument, run_trace, trace_stage
+from rdf_export import GRAPH_IRI, TERM_DELIMITERS, format_triples, get_part_file, prepare_output_dir, \
+    write_compressed_file
+from triple_store import P, S, SUBSET_TYPES, get_store_dir, open_triple_store
+
+OutputFormat = Literal['nt', 'csv']
+
+# Predicted triples are loaded into their own graph, so that they can be queried separately from the dataset
+PREDICTION_GRAPH_IRI = f'{GRAPH_IRI}/predicted'
+
+# Namespace of the reified prediction statements and of their score, model and rank properties
+PREDICTION_PREFIX = f'{GRAPH_IRI}/prediction/'
+
+RDF_PREFIX = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+XSD_PREFIX = 'http://www.w3.org/2001/XMLSchema#'
+
+# Relations are completed if their best model reaches all thresholds, metrics where smaller is better are upper bounds
+THRESHOLDS = {DECISIVE_METRIC: 0.3}
+
+# (s, p) pairs per output file, every pair yields up to TOP_K predictions with eight lines each in N-Triples
+PAIRS_PER_FILE = 10_000
+
+# Table that csv_register loads the CSV files into, it is created from the first file if it does not exist
+CSV_TABLE = 'DB.DBA.PREDICTED_TRIPLES'
+
+PLAN_FILE = 'plan.json'
+PAIRS_FILE = 'pairs.npy'
+
+# State of a worker process, filled by _init_worker
+_worker_state = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the top k tail predictions of selected relations as '
+                                                 'Virtuoso bulk load files')
+    parser.add_argument('--dim', type=int, default=32)
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=MODEL_NAMES)
+    parser.add_argument('--metrics-file', default='metrics/predicate_metrics.csv')
+    parser.add_argument('--thresholds', nargs='+', default=[f'{k}={v}' for k, v in THRESHOLDS.items()],
+                        help='Metric thresholds as metric=value')
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--format', choices=['nt', 'csv'], default='nt')
+    parser.add_argument('--output-dir', default='dataset/wikidata5m/predicted')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads-per-worker', type=int, default=max(1, os.cpu_count() // 4))
+    add_profiler_argument(parser)
+    args = parser.parse_args()
+
+    thresholds = {metric: float(value) for metric, value in (threshold.split('=') for threshold in args.thresholds)}
+    trace_dirs = [f'embeddings/dim_{args.dim}/{model_name}' for model_name in args.models]
+    with run_trace('materialize_predictions', trace_dirs, args.profiler):
+        materialize_predictions(args.dim, args.models, args.metrics_file, thresholds, args.top_k, args.format,
+                                args.output_dir, args.workers, args.threads_per_worker)
+
+
+# Completes all known (s, p) pairs of the selected relations in shards of PAIRS_PER_FILE pairs. The pairs are
+# saved with the plan, so that an interrupted run continues with the shards whose files do not exist yet.
+def materialize_predictions(embedding_dim: int = 32, model_names=MODEL_NAMES,
+                            metrics_file='metrics/predicate_metrics.csv', thresholds=None, top_k: int = TOP_K,
+                            output_format: OutputFormat = 'nt', output_dir='dataset/wikidata5m/predicted',
+                            num_workers: int = 1, threads_per_worker: int = 1, pairs_per_file: int = PAIRS_PER_FILE):
+    thresholds = thresholds or THRESHOLDS
+    output_dir = prepare_output_dir(output_dir, PREDICTION_GRAPH_IRI)
+    store_dir = get_store_dir(embedding_dim)
+
+    plan = {
+        'embedding_dim': embedding_dim,
+        'models': list(model_names),
+        'metrics_file': str(metrics_file),
+        'thresholds': thresholds,
+        'top_k': top_k,
+        'format': output_format,
+        'pairs_per_file': pairs_per_file,
+    }
+    pairs = _load_plan(output_dir, plan)
+    if pairs is None:
+        store = open_triple_store(store_dir)
+        relation_ids = select_relations(load_metrics_store(metrics_file), store['relation_labels'], model_names,
+                                        thresholds)
+        with trace_stage('select_pairs'):
+            pairs = select_pairs(store, relation_ids)
+        print(f'[X] Selected {len(pairs)} (s, p) pairs of {len(relation_ids)} relations')
+        _save_plan(output_dir, plan, pairs)
+
+    work_units = [
+        (part, start, min(start + pairs_per_file, len(pairs)))
+        for part, start in enumerate(range(0, len(pairs), pairs_per_file))
+        if not (output_dir / get_prediction_file(part, output_format)).exists()
+    ]
+    print(f'[X] Completing {len(work_units)} of {-(-len(pairs) // pairs_per_file)} shards into {output_dir}')
+    if not work_units:
+        return
+
+    # The filter index is built before the workers memory-map it
+    get_filter_index(store_dir)
+
+    # Every worker loads the models once and writes the shards it receives
+    context = get_context('spawn')
+    num_workers = max(1, min(num_workers, len(work_units)))
+    # Predicted triples before the known ones are dropped
+    num_pairs = sum(end - start for _, start, end in work_units)
+    with trace_stage('complete_shards', num_triples=num_pairs * top_k, batch_size=pairs_per_file), \
+            context.Pool(processes=num_workers, initializer=_init_worker,
+                         initargs=(threads_per_worker, embedding_dim, model_names, metrics_file, store_dir,
+                                   output_dir, top_k, output_format)) as pool:
+        for output_file, num_predictions in pool.imap_unordered(_complete_shard, work_units):
+            print(f'[X] Wrote {num_predictions} predictions to {output_file.name}')
+
+
+# Relations whose best model reaches every threshold, as ids in store order
+def select_relations(metrics_store, relation_labels, model_names, thresholds, side='both', rank_type='realistic'):
+    selected = np.ones(len(relation_labels), dtype=bool)
+    for metric_name, threshold in thresholds.items():
+        values = get_metric_slice(metrics_store, metric_name=metric_name, side=side, rank_type=rank_type)
+        values = values.reindex(index=pd.Index(np.asarray(relation_labels)), columns=list(model_names)).to_numpy()
+
+        # Relations without any value for the metric are never selected
+        if get_metric_optimum(metric_name) == 'min':
+            selected &= np.nan_to_num(values, nan=np.inf).min(axis=1) <= threshold
+        else:
+            selected &= np.nan_to_num(values, nan=-np.inf).max(axis=1) >= threshold
+
+    return np.flatnonzero(selected)
+
+
+# Distinct (s, p) pairs of all subsets with a selected relation, sorted by relation so that the shards
+# of a relation are scored by the same model
+def select_pairs(store, relation_ids):
+    num_entities = store['metadata']['num_entities']
+    keys = []
+    for subset_type in SUBSET_TYPES:
+        triples = store[subset_type]
+        selected = np.isin(triples[P], relation_ids)
+        keys.append(triples[P][selected].astype(np.int64) * num_entities + triples[S][selected])
+
+    keys = np.unique(np.concatenate(keys))
+    return np.stack([keys % num_entities, keys // num_entities], axis=1).astype(np.int32)
+
+
+def get_prediction_file(part, output_format: OutputFormat):
+    return get_part_file('predictions', part, output_format)
+
+
+# Predicted triples together with a reified statement carrying the score, the model and the rank of the prediction
+def format_predictions(predictions):
+    start, end = TERM_DELIMITERS['nt']
+    statements = [
+        f'<{PREDICTION_PREFIX}statement/{subject}-{predicate}-{obj}>'
+        for subject, predicate, obj in zip(predictions['subject'], predictions['predicate'], predictions['object'])
+    ]
+
+    lines = [format_triples(predictions['subject'], predictions['predicate'], predictions['object'], 'nt')]
+    lines += [
+        f'{statement} <{RDF_PREFIX}type> <{RDF_PREFIX}Statement> .\n'
+        f'{statement} <{RDF_PREFIX}subject> {start}{subject}{end} .\n'
+        f'{statement} <{RDF_PREFIX}predicate> {start}{predicate}{end} .\n'
+        f'{statement} <{RDF_PREFIX}object> {start}{obj}{end} .\n'
+        f'{statement} <{PREDICTION_PREFIX}score> "{score:.6g}"^^<{XSD_PREFIX}float> .\n'
+        f'{statement} <{PREDICTION_PREFIX}model> "{model}" .\n'
+        f'{statement} <{PREDICTION_PREFIX}rank> "{rank}"^^<{XSD_PREFIX}integer> .\n'
+        for statement, subject, predicate, obj, score, model, rank in zip(
+            statements, predictions['subject'], predictions['predicate'], predictions['object'],
+            predictions['score'].tolist(), predictions['model'], predictions['rank'].tolist()
+        )
+    ]
+    return ''.join(lines)
+
+
+def write_csv_sidecars(output_file):
+    # csv_register reads the options from <name>.cfg and the target table from <name>.tb next to <name>.csv.gz
+    name = Path(output_file).name.removesuffix('.csv.gz')
+    with open(Path(output_file).parent / f'{name}.cfg', 'w') as cfg_file:
+        cfg_file.write('[csv]\ncsv-delimiter = ,\ncsv-quote = "\nheader = 0\noffset = 1\n')
+    with open(Path(output_file).parent / f'{name}.tb', 'w') as table_file:
+        table_file.write(CSV_TABLE + '\n')
+
+
+def _load_plan(output_dir, plan):
+    plan_file = output_dir / PLAN_FILE
+    if not plan_file.exists():
+        return None
+
+    with open(plan_file) as file:
+        saved_plan = json.load(file)
+    if saved_plan != plan:
+        raise ValueError(f'{output_dir} contains predictions of a different plan {saved_plan}, '
+                         f'use another output directory')
+    return np.load(output_dir / PAIRS_FILE, mmap_mode='r')
+
+
+def _save_plan(output_dir, plan, pairs):
+    # The plan file is written last and marks the pairs as complete
+    np.save(output_dir / PAIRS_FILE, pairs)
+    with open(output_dir / PLAN_FILE, 'w') as file:
+        json.dump(plan, file, indent=2)
+
+
+def _init_worker(threads_per_worker, embedding_dim, model_names, metrics_file, store_dir, output_dir, top_k,
+                 output_format):
+    torch.set_num_threads(threads_per_worker)
+
+    _worker_state.update({
+        'engine': load_completion_engine(embedding_dim, model_names, metrics_file),
+        'filter_index': open_filter_index(store_dir),
+        'pairs': np.load(Path(output_dir) / PAIRS_FILE, mmap_mode='r'),
+        'output_dir': Path(output_dir),
+        'top_k': top_k,
+        'output_format': output_format,
+    })
+
+
+def _complete_shard(work_unit):
+    part, start, end = work_unit
+    engine, output_format = _worker_state['engine'], _worker_state['output_format']
+    store = engine['store']
+
+    queries = np.asarray(_worker_state['pairs'][start:end], dtype=np.int64)
+    top_ids, top_scores, routes = complete_targets(engine, 'tail', queries, _worker_state['top_k'])
+
+    # Predictions that are already known triples are not materialised
+    num_entities = store['metadata']['num_entities']
+    batch_indices, entity_ids = get_filter_pairs(_worker_state['filter_index'], 'tail',
+                                                 np.column_stack([queries, np.zeros(len(queries), dtype=np.int64)]))
+    query_index = np.repeat(np.arange(len(queries)), top_ids.shape[1])
+    unknown = ~np.isin(query_index * num_entities + top_ids.reshape(-1), batch_indices * num_entities + entity_ids)
+    query_index = query_index[unknown]
+
+    predictions = {
+        'subject': store['entity_labels'][queries[query_index, 0]],
+        'predicate': store['relation_labels'][queries[query_index, 1]],
+        'object': store['entity_labels'][top_ids.reshape(-1)[unknown]],
+        'score': top_scores.reshape(-1)[unknown],
+        'model': get_route_names(engine, routes)[query_index],
+        'rank': np.tile(np.arange(1, top_ids.shape[1] + 1), len(queries))[unknown],
+    }
+
+    output_file = _worker_state['output_dir'] / get_prediction_file(part, output_format)
+    if output_format == 'csv':
+        # Sidecars first, so that every complete CSV file can be registered
+        write_csv_sidecars(output_file)
+        write_compressed_file(output_file, pd.DataFrame(predictions).to_csv(index=False))
+    else:
+        write_compressed_file(output_file, format_predictions(predictions))
+
+    return output_file, int(unknown.sum())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import numpy as np
+import pandas as pd
+
+from pipeline_trace import trace_stage
+
+# Rank types and sides in the order of pykeen's RankBasedMetricResults, the combined
+# 'both' side concatenates the head and tail ranks
+RANK_TYPES = ['optimistic', 'realistic', 'pessimistic']
+SIDES = ['head', 'tail']
+PACK_SIDES = SIDES + ['both']
+
+# Metrics in the order of embeddings/dim_512/complex/predicate_metrics.csv. The other committed files list the
+# metrics before the hits in other orders, since pykeen does not keep a fixed order for them.
+METRIC_NAMES = [
+    'adjusted_arithmetic_mean_rank', 'count', 'standard_deviation', 'adjusted_geometric_mean_rank_index',
+    'arithmetic_mean_rank', 'median_absolute_deviation', 'z_inverse_harmonic_mean_rank', 'z_arithmetic_mean_rank',
+    'harmonic_mean_rank', 'inverse_harmonic_mean_rank', 'inverse_geometric_mean_rank', 'variance', 'median_rank',
+    'inverse_median_rank', 'adjusted_arithmetic_mean_rank_index', 'z_geometric_mean_rank',
+    'inverse_arithmetic_mean_rank', 'adjusted_inverse_harmonic_mean_rank', 'geometric_mean_rank', 'hits_at_1',
+    'hits_at_3', 'hits_at_5', 'hits_at_10', 'z_hits_at_k', 'adjusted_hits_at_k'
+]
+
+HITS_AT_K = [1, 3, 5, 10]
+
+# k of the adjusted and z-scored hits, the last one wins in pykeen's results dictionary
+ADJUSTED_HITS_K = 10
+
+# Scale of scipy.stats.median_abs_deviation(scale='normal')
+MAD_NORMAL_SCALE = 1.482602218505602
+
+EPSILON = 1.0e-12
+
+
+def collect_evaluator_ranks(evaluator):
+    # Concatenated ranks and num_candidates of a RankBasedEvaluator(clear_on_finalize=False)
+    ranks = {key: np.concatenate(value) for key, value in evaluator.ranks.items()}
+    num_candidates = {key: np.concatenate(value) for key, value in evaluator.num_candidates.items()}
+    return ranks, num_candidates
+
+
+# Computes all rank-based metrics per relation in one pass with segment reductions and returns them in the
+# long format of RankBasedMetricResults.to_df(), extended by the relation_id, relation_label and model columns
+def aggregate_predicate_metrics(relation_ids, ranks, num_candidates, relation_labels, model_name):
+    relations, segments = np.unique(np.asarray(relation_ids), return_inverse=True)
+    num_segments = len(relations)
+
+    # Generalized harmonic numbers up to the largest number of candidates, shared by all packs
+    max_candidates = int(max(value.max() for value in num_candidates.values()))
+    candidate_range = np.arange(1, max_candidates + 1, dtype=float)
+    harmonic_numbers = np.cumsum(1.0 / candidate_range)
+    harmonic_numbers_2 = np.cumsum(candidate_range ** -2)
+
+    values = np.empty((num_segments, len(METRIC_NAMES), len(RANK_TYPES) * len(PACK_SIDES)))
+    pack_index = 0
+    with trace_stage('aggregate', num_triples=len(segments)):
+        for rank_type in RANK_TYPES:
+            for side in PACK_SIDES:
+                pack_sides = SIDES if side == 'both' else [side]
+                pack_ranks = np.concatenate([ranks[s, rank_type] for s in pack_sides]).astype(float)
+                pack_candidates = np.concatenate([num_candidates[s] for s in pack_sides]).astype(np.int64)
+                pack_segments = np.tile(segments, len(pack_sides))
+
+                metrics = _compute_segment_metrics(pack_segments, num_segments, pack_ranks, pack_candidates,
+                                                   harmonic_numbers, harmonic_numbers_2)
+                for i, metric_name in enumerate(METRIC_NAMES):
+                    values[:, i, pack_index] = metrics[metric_name]
+                pack_index += 1
+
+    num_packs = len(RANK_TYPES) * len(PACK_SIDES)
+    rows_per_relation = len(METRIC_NAMES) * num_packs
+    relation_labels = np.asarray(relation_labels)
+
+    return pd.DataFrame({
+        'Side': np.tile(PACK_SIDES * len(RANK_TYPES), num_segments * len(METRIC_NAMES)),
+        'Type': np.tile(np.repeat(RANK_TYPES, len(PACK_SIDES)), num_segments * len(METRIC_NAMES)),
+        'Metric': np.tile(np.repeat(METRIC_NAMES, num_packs), num_segments),
+        'Value': values.reshape(-1),
+        'relation_id': np.repeat(relations, rows_per_relation),
+        'relation_label': np.repeat(relation_labels[relations], rows_per_relation),
+        'model': model_name,
+    })
+
+
+def _compute_segment_metrics(segments, num_segments, ranks, num_candidates, harmonic_numbers, harmonic_numbers_2):
+    counts = np.bincount(segments, minlength=num_segments).astype(float)
+
+    def segment_mean(x):
+        return np.bincount(segments, weights=x, minlength=num_segments) / counts
+
+    metrics = {'count': counts}
+
+    # Means of the ranks
+    mean_rank = segment_mean(ranks)
+    log_mean_rank = segment_mean(np.log(ranks))
+    mean_reciprocal_rank = segment_mean(1.0 / ranks)
+    metrics['arithmetic_mean_rank'] = mean_rank
+    metrics['inverse_arithmetic_mean_rank'] = 1.0 / mean_rank
+    metrics['geometric_mean_rank'] = np.exp(log_mean_rank)
+    metrics['inverse_geometric_mean_rank'] = np.exp(-log_mean_rank)
+    metrics['harmonic_mean_rank'] = 1.0 / mean_reciprocal_rank
+    metrics['inverse_harmonic_mean_rank'] = mean_reciprocal_rank
+
+    # Population variance with a second pass for numerical stability
+    variance = segment_mean((ranks - mean_rank[segments]) ** 2)
+    metrics['variance'] = variance
+    metrics['standard_deviation'] = np.sqrt(variance)
+
+    median_rank = _segment_median(segments, counts, ranks)
+    metrics['median_rank'] = median_rank
+    metrics['inverse_median_rank'] = 1.0 / median_rank
+    metrics['median_absolute_deviation'] = MAD_NORMAL_SCALE * _segment_median(
+        segments, counts, np.abs(ranks - median_rank[segments]))
+
+    for k in HITS_AT_K:
+        metrics[f'hits_at_{k}'] = segment_mean((ranks <= k).astype(float))
+
+    # Expectations and variances under uniformly distributed ranks, cf. pykeen.metrics.ranking
+    expected_mean_rank = segment_mean(0.5 * (num_candidates + 1))
+    variance_mean_rank = segment_mean((num_candidates.astype(float) ** 2 - 1) / 12.0) / counts
+
+    h1 = harmonic_numbers[num_candidates - 1]
+    h2 = harmonic_numbers_2[num_candidates - 1]
+    expected_mrr = segment_mean(h1 / num_candidates)
+    variance_mrr = segment_mean(np.maximum((num_candidates * h2 - h1 ** 2) / num_candidates ** 2, 0.0)) / counts
+
+    hits_probability = np.minimum(ADJUSTED_HITS_K / num_candidates, 1.0)
+    expected_hits = segment_mean(hits_probability)
+    variance_hits = segment_mean(hits_probability * (1 - hits_probability)) / counts
+
+    # E[GMR] = prod_i E[r_i^(1/m)] and V[GMR] = prod_i E[r_i^(2/m)] - E[GMR]^2
+    exponents = 1.0 / counts[segments]
+    log_expected_gmr = np.bincount(
+        segments, weights=np.log(_power_sums(num_candidates, exponents)) - np.log(num_candidates),
+        minlength=num_segments)
+    log_second_moment_gmr = np.bincount(
+        segments, weights=np.log(_power_sums(num_candidates, 2 * exponents)) - np.log(num_candidates),
+        minlength=num_segments)
+    expected_gmr = np.exp(log_expected_gmr)
+    variance_gmr = np.exp(log_second_moment_gmr) - expected_gmr ** 2
+
+    metrics['adjusted_arithmetic_mean_rank'] = mean_rank * _safe_divide(1.0, expected_mean_rank)
+    metrics['adjusted_arithmetic_mean_rank_index'] = _reindex(mean_rank, expected_mean_rank)
+    metrics['adjusted_geometric_mean_rank_index'] = _reindex(metrics['geometric_mean_rank'], expected_gmr)
+    metrics['adjusted_inverse_harmonic_mean_rank'] = _reindex(mean_reciprocal_rank, expected_mrr)
+    metrics['adjusted_hits_at_k'] = _reindex(metrics[f'hits_at_{ADJUSTED_HITS_K}'], expected_hits)
+
+    # Decreasing base metrics change their sign, so that larger z-scores are always better
+    metrics['z_arithmetic_mean_rank'] = -_z_score(mean_rank, expected_mean_rank, variance_mean_rank)
+    metrics['z_geometric_mean_rank'] = -_z_score(metrics['geometric_mean_rank'], expected_gmr, variance_gmr)
+    metrics['z_inverse_harmonic_mean_rank'] = _z_score(mean_reciprocal_rank, expected_mrr, variance_mrr)
+    metrics['z_hits_at_k'] = _z_score(metrics[f'hits_at_{ADJUSTED_HITS_K}'], expected_hits, variance_hits)
+
+    return metrics
+
+
+def _segment_median(segments, counts, values):
+    # Sort values within their segments and average the two middle elements
+    sorted_values = values[np.lexsort((values, segments))]
+    starts = np.concatenate([[0], np.cumsum(counts[:-1])]).astype(np.int64)
+    counts = counts.astype(np.int64)
+    return 0.5 * (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2])
+
+
+# Computes sum_{j=1}^{n} j^a elementwise. The first terms are summed exactly and the remainder is given by
+# the Euler-Maclaurin formula, which avoids summing up to millions of candidates for every distinct exponent.
+def _power_sums(n, exponents, num_exact_terms=64):
+    n = n.astype(float)
+    sums = np.zeros_like(exponents)
+    for j in range(1, num_exact_terms + 1):
+        sums += np.where(j <= n, float(j) ** exponents, 0.0)
+
+    a = exponents
+    lower = float(num_exact_terms + 1)
+    upper = np.maximum(n, lower)
+    tail = ((upper ** (a + 1) - lower ** (a + 1)) / (a + 1)
+            + (upper ** a + lower ** a) / 2
+            + a * (upper ** (a - 1) - lower ** (a - 1)) / 12
+            - a * (a - 1) * (a - 2) * (upper ** (a - 3) - lower ** (a - 3)) / 720)
+
+    return sums + np.where(n >= lower, tail, 0.0)
+
+
+def _safe_divide(x, y):
+    # Same guard against division by zero as pykeen's DerivedRankBasedMetric
+    y = np.copysign(np.maximum(np.abs(y), EPSILON), y)
+    return x / y
+
+
+def _reindex(value, expected_value):
+    scale = _safe_divide(1.0, 1.0 - expected_value)
+    return scale * value - scale * expected_value
+
+
+def _z_score(value, expected_value, variance):
+    scale = _safe_divide(1.0, np.sqrt(variance))
+    return scale * value - scale * expected_value
@@ -0,0 +1,263 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from batch_tuner import save_run_metadata, tune_batch_size
+from filtered_ranking import compute_filtered_ranks, get_filter_index
+from metric_aggregation import aggregate_predicate_metrics
+from mmap_models import ENTITY_EMBEDDINGS_FILE, RELATION_EMBEDDINGS_FILE
+from model_loading import EMBEDDING_DIMS, MODEL_NAMES, load_model, save_predicate_metrics
+from pipeline_trace import add_profiler_argument, run_trace
+from triple_store import O, P, S, SUBSET_TYPES, get_store_dir, open_triple_store
+
+RANK_CACHE_DIR = 'metrics/rank_cache'
+
+MANIFEST_FILE = 'manifest.json'
+
+# Content hashes of model files by path, reused as long as size and modification time are unchanged
+FILE_HASHES_FILE = 'file_hashes.json'
+
+# Part of every fingerprint, has to be increased whenever the computation of the ranks changes
+RANKING_VERSION = 1
+
+# Test triples of stale relations are ranked in groups of about this size, every finished group is persisted
+GROUP_SIZE = 100_000
+
+HASH_CHUNK_SIZE = 16 * 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the predicate metrics of changed models and relations')
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=MODEL_NAMES)
+    parser.add_argument('--dims', nargs='+', type=int, choices=EMBEDDING_DIMS, default=EMBEDDING_DIMS)
+    add_profiler_argument(parser)
+    args = parser.parse_args()
+
+    trace_dirs = [f'embeddings/dim_{embedding_dim}/{model_name}' for embedding_dim in args.dims
+                  for model_name in args.models]
+    with run_trace('metrics_cache', trace_dirs, args.profiler):
+        for embedding_dim in args.dims:
+            store_dir = get_store_dir(embedding_dim)
+            predicate_metrics = update_predicate_metrics(args.models, embedding_dim, open_triple_store(store_dir),
+                                                         get_filter_index(store_dir))
+            save_predicate_metrics(predicate_metrics, embedding_dim)
+
+
+def update_predicate_metrics(model_names, embedding_dim: int, store, filter_index, root: str = '.'):
+    relation_fingerprints = get_relation_fingerprints(store)
+
+    model_metrics = []
+    for model_name in model_names:
+        update_rank_cache(model_name, embedding_dim, store, filter_index,
+                          lambda: load_model(model_name, embedding_dim), relation_fingerprints, root)
+        model_metrics.append(load_cached_predicate_metrics(model_name, embedding_dim, store, root))
+
+    return pd.concat(model_metrics, ignore_index=True)
+
+
+# Ranks the test triples of every relation whose fingerprint differs from the cached one. The fingerprint of a
+# (model, relation) unit covers the model files, the relation's test triples and all known triples of the relation,
+# which are the only triples its filtered ranks depend on. get_model is only called if a unit is stale.
+def update_rank_cache(model_name, embedding_dim: int, store, filter_index, get_model, relation_fingerprints=None,
+                      root: str = '.'):
+    relation_fingerprints = relation_fingerprints or get_relation_fingerprints(store)
+    cache_dir = get_rank_cache_dir(model_name, embedding_dim, root)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    model_fingerprint = get_model_fingerprint(model_name, embedding_dim, root)
+    fingerprints = {
+        relation_id: _hash_strings(
+            [str(RANKING_VERSION), model_fingerprint, relation_fingerprints['test'][relation_id],
+             relation_fingerprints['filter'][relation_id]]
+        )
+        for relation_id in relation_fingerprints['test_relations']
+    }
+
+    manifest = _read_manifest(cache_dir)
+    stale = [relation_id for relation_id, fingerprint in fingerprints.items()
+             if manifest.get(str(relation_id)) != fingerprint or not (cache_dir / _get_rank_file(relation_id)).exists()]
+    print(f'[X] {len(fingerprints) - len(stale)} of {len(fingerprints)} relations of {model_name} with dimension '
+          f'{embedding_dim} are up to date')
+    if not stale:
+        return
+
+    model = get_model().eval()
+    settings = tune_batch_size(model)
+    save_run_metadata(cache_dir / 'run_metadata.json', model_name, settings)
+
+    test_triples, bounds = relation_fingerprints['test_triples'], relation_fingerprints['test_bounds']
+    for group in _group_relations(stale, bounds):
+        group_triples = np.concatenate([test_triples[bounds[r]:bounds[r + 1]] for r in group]).astype(np.int64)
+        ranks, num_candidates = compute_filtered_ranks(model, group_triples, filter_index,
+                                                       batch_size=settings['batch_size'],
+                                                       slice_size=settings['slice_size'])
+
+        start = 0
+        for relation_id in group:
+            end = start + int(bounds[relation_id + 1] - bounds[relation_id])
+            _save_relation_ranks(cache_dir / _get_rank_file(relation_id),
+                                 {key: value[start:end] for key, value in ranks.items()},
+                                 {key: value[start:end] for key, value in num_candidates.items()})
+            manifest[str(relation_id)] = fingerprints[relation_id]
+            start = end
+
+        # The manifest is only updated after the rank files of the group are complete
+        _write_manifest(cache_dir, manifest)
+        print(f'[X] Ranked {len(group_triples)} test triples of {len(group)} relations of {model_name}')
+
+
+# Aggregates the metrics of all relations from the cached ranks, the metric configuration of
+# metric_aggregation.py is applied anew on every call
+def load_cached_predicate_metrics(model_name, embedding_dim: int, store, root: str = '.'):
+    cache_dir = get_rank_cache_dir(model_name, embedding_dim, root)
+    test_relations = np.unique(np.asarray(store['test'][P]))
+
+    relation_ids, ranks, num_candidates = [], {}, {}
+    for relation_id in test_relations:
+        with np.load(cache_dir / _get_rank_file(relation_id)) as relation_ranks:
+            for name in relation_ranks.files:
+                if name.startswith('rank-'):
+                    ranks.setdefault(tuple(name.split('-')[1:]), []).append(relation_ranks[name])
+                elif name.startswith('num_candidates-'):
+                    num_candidates.setdefault(name.split('-')[1], []).append(relation_ranks[name])
+            relation_ids.append(np.full(len(relation_ranks['num_candidates-head']), relation_id, dtype=np.int32))
+
+    return aggregate_predicate_metrics(
+        relation_ids=np.concatenate(relation_ids),
+        ranks={key: np.concatenate(value) for key, value in ranks.items()},
+        num_candidates={key: np.concatenate(value) for key, value in num_candidates.items()},
+        relation_labels=store['relation_labels'],
+        model_name=model_name
+    )
+
+
+def get_rank_cache_dir(model_name, embedding_dim: int, root: str = '.'):
+    return Path(root) / RANK_CACHE_DIR / f'dim_{embedding_dim}' / model_name
+
+
+# Hashes the test triples and all known triples of every relation in canonical (p, s, o) order,
+# so that the fingerprints do not depend on the order of the dataset files
+def get_relation_fingerprints(store):
+    num_relations = store['metadata']['num_relations']
+
+    fingerprints = {}
+    for name, subset_types in (('test', ['test']), ('filter', SUBSET_TYPES)):
+        triples = np.concatenate([np.asarray(store[subset_type]) for subset_type in subset_types], axis=1)
+        order = np.lexsort((triples[O], triples[S], triples[P]))
+        triples = np.ascontiguousarray(triples[:, order].T)
+        bounds = np.searchsorted(triples[:, P], np.arange(num_relations + 1))
+
+        fingerprints[name] = [hashlib.sha256(triples[bounds[r]:bounds[r + 1]].tobytes()).hexdigest()
+                              for r in range(num_relations)]
+        if name == 'test':
+            fingerprints['test_triples'] = triples
+            fingerprints['test_bounds'] = bounds
+            fingerprints['test_relations'] = [int(r) for r in np.flatnonzero(np.diff(bounds))]
+
+    return fingerprints
+
+
+def get_model_fingerprint(model_name, embedding_dim: int, root: str = '.'):
+    model_dir = Path(root) / f'embeddings/dim_{embedding_dim}/{model_name}'
+    if embedding_dim == 32:
+        model_files = ['trained_model.pkl', 'training_triples']
+    else:
+        model_files = [ENTITY_EMBEDDINGS_FILE, RELATION_EMBEDDINGS_FILE, 'trained_model_state_dict.pt',
+                       'training_factory']
+    return get_files_fingerprint([model_dir / model_file for model_file in model_files], root)
+
+
+# Content fingerprint of files and directories by their names, missing ones are left out
+def get_files_fingerprint(paths, root: str = '.'):
+    # Hashes of unchanged files are read from the hash file instead of hashing several GB again
+    hashes_file = Path(root) / RANK_CACHE_DIR / FILE_HASHES_FILE
+    file_hashes = json.loads(hashes_file.read_text()) if hashes_file.exists() else {}
+    fingerprint = _hash_strings([
+        f'{Path(path).name}:{_hash_path(Path(path), file_hashes)}' for path in paths if Path(path).exists()
+    ])
+
+    hashes_file.parent.mkdir(parents=True, exist_ok=True)
+    hashes_file.write_text(json.dumps(file_hashes, indent=2))
+    return fingerprint
+
+
+def _hash_path(path, file_hashes):
+    # Directories like the binary triples factories are hashed file by file in sorted order
+    if path.is_dir():
+        return _hash_strings([f'{file.relative_to(path)}:{_hash_path(file, file_hashes)}'
+                              for file in sorted(path.rglob('*')) if file.is_file()])
+
+    stat = path.stat()
+    key = str(path.resolve())
+    entry = file_hashes.get(key)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    file_hashes[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+    return file_hashes[key]['sha256']
+
+
+def _hash_strings(strings):
+    return hashlib.sha256('\n'.join(strings).encode()).hexdigest()
+
+
+def _group_relations(relation_ids, bounds, group_size: int = GROUP_SIZE):
+    group, num_triples = [], 0
+    for relation_id in relation_ids:
+        group.append(relation_id)
+        num_triples += int(bounds[relation_id + 1] - bounds[relation_id])
+        if num_triples >= group_size:
+            yield group
+            group, num_triples = [], 0
+    if group:
+        yield group
+
+
+def _get_rank_file(relation_id):
+    return f'ranks_{relation_id:05d}.npz'
+
+
+def _save_relation_ranks(rank_file, ranks, num_candidates):
+    # Same array names as the evaluation shards, written to a temporary file first
+    arrays = {'-'.join(('rank',) + key): value.astype(np.float32) for key, value in ranks.items()}
+    arrays.update({'-'.join(('num_candidates', key)): value.astype(np.int32) for key, value in num_candidates.items()})
+
+    # The file is synced before it replaces the old one, the manifest must never point at a truncated file
+    temporary_file = rank_file.with_name(f'{rank_file.name}.tmp')
+    with open(temporary_file, 'wb') as file:
+        np.savez(file, **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_file, rank_file)
+
+
+def _read_manifest(cache_dir):
+    manifest_path = Path(cache_dir) / MANIFEST_FILE
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def _write_manifest(cache_dir, manifest):
+    manifest_path = Path(cache_dir) / MANIFEST_FILE
+    temporary_file = manifest_path.with_name(f'{MANIFEST_FILE}.tmp')
+    with open(temporary_file, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(temporary_file, manifest_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# Axes of the dense metric array, in the column names of the predicate_metrics.csv files
+METRIC_AXES = ['Metric', 'relation_label', 'model', 'Side', 'Type']
+
+# Metrics for which smaller values are better, larger values are better for all other metrics
+MIN_METRICS = {
+    'arithmetic_mean_rank', 'adjusted_arithmetic_mean_rank', 'geometric_mean_rank', 'harmonic_mean_rank',
+    'median_rank', 'variance', 'standard_deviation', 'median_absolute_deviation'
+}
+
+
+def get_metric_optimum(metric_name):
+    return 'min' if metric_name in MIN_METRICS else 'max'
+
+
+# Loads a long-format predicate metrics CSV (or DataFrame) once into a dense array indexed by
+# (metric, relation, model, side, type) codes, missing combinations are NaN
+def load_metrics_store(predicate_metrics):
+    if not isinstance(predicate_metrics, pd.DataFrame):
+        predicate_metrics = pd.read_csv(predicate_metrics)
+
+    axes = {}
+    codes = []
+    for axis in METRIC_AXES:
+        categorical = pd.Categorical(predicate_metrics[axis].astype(str))
+        axes[axis] = pd.Index(categorical.categories)
+        codes.append(categorical.codes)
+
+    values = np.full([len(axes[axis]) for axis in METRIC_AXES], np.nan)
+    values[tuple(codes)] = predicate_metrics['Value'].to_numpy(dtype=float)
+
+    # Best model per (metric, relation, side, type) for both optima, so that model routing is a lookup.
+    # Relations without any value for a metric get the code -1.
+    model_axis = METRIC_AXES.index('model')
+    missing = np.isnan(values).all(axis=model_axis)
+    best_models = {
+        'max': np.where(missing, -1, np.nan_to_num(values, nan=-np.inf).argmax(axis=model_axis)),
+        'min': np.where(missing, -1, np.nan_to_num(values, nan=np.inf).argmin(axis=model_axis)),
+    }
+
+    return {
+        'axes': axes,
+        'values': values,
+        'best_models': {optimum: codes.astype(np.int8) for optimum, codes in best_models.items()},
+    }
+
+
+def get_metric_value(metrics_store, metric_name, relation_label, model_name, side='both', rank_type='realistic'):
+    return metrics_store['values'][_get_codes(metrics_store, metric_name, relation_label, model_name, side, rank_type)]
+
+
+# Vectorised access, axes given as None are kept. Returns a Series over the relations for a single
+# remaining relation axis, a DataFrame for two remaining axes and the raw array otherwise.
+def get_metric_slice(metrics_store, metric_name=None, relation_label=None, model_name=None, side=None,
+                     rank_type=None):
+    keys = [metric_name, relation_label, model_name, side, rank_type]
+    index = tuple(slice(None) if key is None else metrics_store['axes'][axis].get_loc(key)
+                  for axis, key in zip(METRIC_AXES, keys))
+    values = metrics_store['values'][index]
+
+    free_axes = [axis for axis, key in zip(METRIC_AXES, keys) if key is None]
+    if len(free_axes) == 1:
+        return pd.Series(values, index=metrics_store['axes'][free_axes[0]], name=free_axes[0]).dropna()
+    if len(free_axes) == 2:
+        return pd.DataFrame(values, index=metrics_store['axes'][free_axes[0]],
+                            columns=metrics_store['axes'][free_axes[1]])
+    return values
+
+
+def get_best_model(metrics_store, relation_label, metric_name, side='both', rank_type='realistic', optimum=None):
+    axes = metrics_store['axes']
+    optimum = optimum or get_metric_optimum(metric_name)
+    model_code = metrics_store['best_models'][optimum][
+        axes['Metric'].get_loc(metric_name),
+        axes['relation_label'].get_loc(relation_label),
+        axes['Side'].get_loc(side),
+        axes['Type'].get_loc(rank_type)
+    ]
+    return axes['model'][model_code] if model_code >= 0 else None
+
+
+# Best model of every relation as Series indexed by relation label
+def get_best_models(metrics_store, metric_name, side='both', rank_type='realistic', optimum=None):
+    axes = metrics_store['axes']
+    optimum = optimum or get_metric_optimum(metric_name)
+    model_codes = metrics_store['best_models'][optimum][
+        axes['Metric'].get_loc(metric_name), :, axes['Side'].get_loc(side), axes['Type'].get_loc(rank_type)
+    ]
+
+    best_models = pd.Series(axes['model'][np.maximum(model_codes, 0)], index=axes['relation_label'], name='model')
+    return best_models[model_codes >= 0]
+
+
+def _get_codes(metrics_store, metric_name, relation_label, model_name, side, rank_type):
+    axes = metrics_store['axes']
+    return tuple(axes[axis].get_loc(key)
+                 for axis, key in zip(METRIC_AXES, (metric_name, relation_label, model_name, side, rank_type)))
@@ -0,0 +1,120 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+from pykeen.nn.representation import Representation
+from pykeen.triples import CoreTriplesFactory
+
+# Embedding files written by pretrained_models/extract_pretrained_embeddings.py
+ENTITY_EMBEDDINGS_FILE = 'entity_embeddings.npy'
+RELATION_EMBEDDINGS_FILE = 'relation_embeddings.npy'
+
+
+def is_mmap_model(model_dir):
+    model_dir = Path(model_dir)
+    return (model_dir / ENTITY_EMBEDDINGS_FILE).exists() and (model_dir / RELATION_EMBEDDINGS_FILE).exists()
+
+
+# Builds an inference-only model whose representations are backed by the memory-mapped embedding arrays, so that
+# only the rows of the entities that are scored are read from disk. Real-valued arrays of complex models are used
+# as real parts with zero imaginary parts, like the complex64 cast in create_pykeen_model.py.
+def load_mmap_model(model_class, model_dir, embedding_dim: int = 512):
+    model_dir = Path(model_dir)
+
+    # Copy-on-write maps are writable for torch.from_numpy, but pages are only read and shared with the page cache
+    entity_values = np.load(model_dir / ENTITY_EMBEDDINGS_FILE, mmap_mode='c')
+    relation_values = np.load(model_dir / RELATION_EMBEDDINGS_FILE, mmap_mode='c')
+
+    model = create_empty_model(model_class, embedding_dim, len(entity_values), len(relation_values))
+    model.entity_representations = torch.nn.ModuleList(
+        _split_representations(entity_values, model.entity_representations, model_dir / ENTITY_EMBEDDINGS_FILE)
+    )
+    model.relation_representations = torch.nn.ModuleList(
+        _split_representations(relation_values, model.relation_representations, model_dir / RELATION_EMBEDDINGS_FILE)
+    )
+    return model.eval()
+
+
+# Creates the model on the meta device, so that none of its representations are allocated.
+# They have to be replaced before the model is used.
+def create_empty_model(model_class, embedding_dim: int, num_entities: int, num_relations: int):
+    # The model only needs the numbers of entities and relations, not the training triples
+    triples_factory = CoreTriplesFactory.create(
+        mapped_triples=torch.empty((0, 3), dtype=torch.long),
+        num_entities=num_entities,
+        num_relations=num_relations
+    )
+    with torch.device('meta'):
+        return model_class(triples_factory=triples_factory, embedding_dim=embedding_dim)
+
+
+class MemoryMappedEmbedding(Representation):
+    # values is a (max_id, row_size) array, int8 values are multiplied with one scale per row. Complex
+    # representations are stored as interleaved real and imaginary parts, or as real parts only if real_only is set.
+    def __init__(self, values, shape, scales=None, is_complex=False, real_only=False):
+        super().__init__(max_id=len(values), shape=shape, unique=False)
+        self.values = values
+        self.scales = scales
+        self.is_complex = is_complex
+        self.real_only = real_only
+
+        # The arrays stay memory-mapped on the CPU, the empty buffer only tracks the device of the model
+        self.register_buffer('device_marker', torch.empty(0), persistent=False)
+
+    def _plain_forward(self, indices=None):
+        if indices is None:
+            # Without indices all rows are used as they are, float32 arrays are not copied at all. Real-only complex
+            # arrays are still converted as a whole, which is why large tables are scored in entity slices.
+            rows, scales = self.values, self.scales
+            prefix = (self.max_id,)
+        else:
+            flat_indices = indices.reshape(-1).cpu().numpy()
+            # Entity slices of sliced scoring are contiguous ranges, which are read as views instead of copies
+            if len(flat_indices) > 1 and np.all(np.diff(flat_indices) == 1):
+                flat_indices = slice(flat_indices[0], flat_indices[-1] + 1)
+            rows = self.values[flat_indices]
+            scales = self.scales[flat_indices] if self.scales is not None else None
+            prefix = tuple(indices.shape)
+
+        x = torch.from_numpy(rows).to(self.device_marker.device).float()
+        if scales is not None:
+            x = x * torch.from_numpy(scales).to(x.device)[:, None]
+
+        if not self.is_complex:
+            return x.reshape(*prefix, *self.shape)
+        if self.real_only:
+            x = x.reshape(*prefix, *self.shape)
+            return torch.complex(x, torch.zeros_like(x))
+        return torch.view_as_complex(x.reshape(*prefix, *self.shape, 2))
+
+
+def _split_representations(values, representations, path):
+    # Complex arrays are viewed as interleaved float pairs without copying
+    real_only = not np.iscomplexobj(values)
+    if not real_only:
+        values = values.view(values.real.dtype)
+    values = values.reshape(len(values), -1)
+
+    row_sizes = []
+    for representation in representations:
+        row_size = int(np.prod(representation.shape))
+        if getattr(representation, 'is_complex', False) and not real_only:
+            row_size *= 2
+        row_sizes.append(row_size)
+
+    if sum(row_sizes) != values.shape[1]:
+        raise ValueError(f'{path} has {values.shape[1]} values per row, but the model expects {sum(row_sizes)}')
+
+    # Models with several representations per entity or relation, like SimplE, use consecutive column ranges
+    mmap_representations = []
+    offset = 0
+    for representation, row_size in zip(representations, row_sizes):
+        mmap_representations.append(MemoryMappedEmbedding(
+            values[:, offset:offset + row_size] if len(representations) > 1 else values,
+            shape=representation.shape,
+            is_complex=getattr(representation, 'is_complex', False),
+            real_only=real_only
+        ))
+        offset += row_size
+
+    return mmap_representations
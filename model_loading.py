@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import torch
+from pykeen.models import ComplEx, DistMult, SimplE, TransE
+from pykeen.triples import TriplesFactory
+
+from mmap_models import is_mmap_model, load_mmap_model
+from pipeline_trace import trace_stage
+
+MODEL_NAMES = ['complex', 'distmult', 'simple', 'transe']
+EMBEDDING_DIMS = [32, 512]
+
+MODEL_CLASSES = {
+    'complex': ComplEx,
+    'distmult': DistMult,
+    'simple': SimplE,
+    'transe': TransE,
+}
+
+
+def save_predicate_metrics(predicate_metrics, embedding_dim):
+    # Same locations as compute_predicate_metrics.py and pretrained_models/evaluate_model.py
+    if embedding_dim == 32:
+        predicate_metrics.to_csv('metrics/predicate_metrics.csv', index=False)
+        return
+
+    for model_name, metrics in predicate_metrics.groupby('model', sort=False):
+        metrics.to_csv(f'embeddings/dim_{embedding_dim}/{model_name}/predicate_metrics.csv', index=False)
+
+
+@trace_stage('load_model')
+def load_model(model_name, embedding_dim):
+    model_dir = Path(f'embeddings/dim_{embedding_dim}/{model_name}')
+    if embedding_dim == 32:
+        return torch.load(model_dir / 'trained_model.pkl')
+
+    # Embeddings extracted from the pretrained models are memory-mapped instead of loading the training factory
+    # and the state dict, arrays that do not match the model layout fall back to the state dict
+    if is_mmap_model(model_dir):
+        try:
+            return load_mmap_model(MODEL_CLASSES[model_name], model_dir, embedding_dim)
+        except ValueError as error:
+            print(f'[X] Loading the state dict of {model_name}, {error}')
+
+    train_factory = TriplesFactory.from_path_binary(model_dir / 'training_factory')
+    model = MODEL_CLASSES[model_name](triples_factory=train_factory, embedding_dim=embedding_dim)
+    model.load_state_dict(torch.load(model_dir / 'trained_model_state_dict.pt'))
+    return model
@@ -0,0 +1,299 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Literal
+
+import psutil
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ProfilerType = Literal['cprofile', 'sampling']
+
+PROFILER_TYPES: list[ProfilerType] = ['cprofile', 'sampling']
+
+# Scripts without command line arguments, like the train_*.py scripts, take the profiler from this variable
+PROFILER_ENVIRONMENT_VARIABLE = 'KGE_PROFILER'
+
+TRACE_FILE_PREFIX = 'trace'
+
+# Seconds between two stack samples of the sampling profiler
+SAMPLING_INTERVAL = 0.005
+
+# Functions of a profile that are listed in the trace, the full profile is written next to it
+NUM_PROFILE_FUNCTIONS = 30
+
+# Trace of the running script, filled by run_trace. Stages of other threads are recorded into the same trace
+# with their own stage stack, stages of worker processes are not traced.
+_trace_state = {'trace': None, 'start': None}
+_thread_state = threading.local()
+
+
+def add_profiler_argument(parser):
+    parser.add_argument('--profiler', choices=PROFILER_TYPES, default=os.environ.get(PROFILER_ENVIRONMENT_VARIABLE),
+                        help=f'Profile the run, also set by ${PROFILER_ENVIRONMENT_VARIABLE}')
+
+
+# Traces a script run, the stages inside are recorded with wall time, CPU time, memory, triples per second and
+# batch sizes. The trace is written as trace_<name>_<timestamp>.json to every trace directory, also if the run
+# fails, and a profile of the run next to the trace of the first directory.
+@contextmanager
+def run_trace(name, trace_dirs, profiler: ProfilerType = None):
+    profiler = profiler or os.environ.get(PROFILER_ENVIRONMENT_VARIABLE) or None
+    if profiler is not None and profiler not in PROFILER_TYPES:
+        raise ValueError(f'Unknown profiler {profiler}, expected one of {PROFILER_TYPES}')
+
+    trace = {
+        'name': name,
+        'run_id': datetime.now().strftime('%Y%m%d-%H%M%S'),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'argv': sys.argv,
+        'pid': os.getpid(),
+        'cpu_count': os.cpu_count(),
+        'profiler': profiler,
+        'status': 'running',
+        'stages': [],
+    }
+    trace_dirs = [Path(trace_dir) for trace_dir in trace_dirs]
+    _thread_state.stack = []
+
+    profile = _start_profiler(profiler)
+    start = _get_usage()
+    _trace_state.update({'trace': trace, 'start': start['time']})
+    try:
+        yield trace
+        trace['status'] = 'finished'
+    except BaseException as error:
+        trace['status'] = f'failed: {type(error).__name__}'
+        raise
+    finally:
+        trace.update(_get_usage_difference(start, _get_usage()))
+        _trace_state['trace'] = None
+        if profile is not None:
+            profile_file = trace_dirs[0] / f'{TRACE_FILE_PREFIX}_{name}_{trace["run_id"]}'
+            trace['profile'] = _stop_profiler(profiler, profile, profile_file)
+
+        trace['summary'] = summarize_stages(trace['stages'])
+        for trace_dir in trace_dirs:
+            _save_trace(trace, trace_dir / f'{TRACE_FILE_PREFIX}_{name}_{trace["run_id"]}.json')
+        print_trace_summary(trace)
+
+
+# Records a stage of the running trace, nested stages are named by their path like 'evaluate/rank'. The yielded
+# dict can be updated inside the stage, e.g. with num_triples and batch_size once they are known. Without a
+# running trace the stage is not recorded.
+@contextmanager
+def trace_stage(name, num_triples: int = None, batch_size: int = None):
+    stage = {'num_triples': num_triples, 'batch_size': batch_size}
+    trace = _trace_state['trace']
+    if trace is None:
+        yield stage
+        return
+
+    stack = getattr(_thread_state, 'stack', None)
+    if stack is None:
+        stack = _thread_state.stack = []
+    stack.append(name)
+    stage['path'] = '/'.join(stack)
+
+    start = _get_usage()
+    try:
+        yield stage
+    finally:
+        stack.pop()
+        stage.update(_get_usage_difference(start, _get_usage()))
+        if stage['num_triples'] is not None and stage['wall_time'] > 0:
+            stage['triples_per_second'] = stage['num_triples'] / stage['wall_time']
+        stage['thread'] = threading.current_thread().name
+        trace['stages'].append(stage)
+
+
+# Totals per stage path, in the order in which the stages were first entered
+def summarize_stages(stages):
+    summary = {}
+    for stage in sorted(stages, key=lambda stage: stage['start_time']):
+        path_summary = summary.setdefault(stage['path'], {
+            'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'num_triples': 0, 'batch_sizes': [], 'peak_rss': 0
+        })
+        path_summary['calls'] += 1
+        path_summary['wall_time'] += stage['wall_time']
+        path_summary['cpu_time'] += stage['cpu_time']
+        path_summary['num_triples'] += stage['num_triples'] or 0
+        path_summary['peak_rss'] = max(path_summary['peak_rss'], stage['peak_rss'])
+        if stage['batch_size'] is not None and stage['batch_size'] not in path_summary['batch_sizes']:
+            path_summary['batch_sizes'].append(stage['batch_size'])
+
+    for path_summary in summary.values():
+        path_summary['triples_per_second'] = (path_summary['num_triples'] / path_summary['wall_time']
+                                              if path_summary['num_triples'] and path_summary['wall_time'] > 0
+                                              else None)
+    return summary
+
+
+def print_trace_summary(trace):
+    print(f'[X] Trace of {trace["name"]} ({trace["status"]}): {trace["wall_time"]:.2f}s wall, '
+          f'{trace["cpu_time"]:.2f}s CPU, {trace["peak_rss"] / 1024 ** 2:.0f} MiB peak RSS')
+    for path, path_summary in trace['summary'].items():
+        throughput = path_summary['triples_per_second']
+        print(f'  {path:<40} {path_summary["calls"]:>6}x {path_summary["wall_time"]:>10.2f}s wall '
+              f'{path_summary["cpu_time"]:>10.2f}s CPU' + (f' {throughput:>12.0f} triples/s' if throughput else ''))
+
+
+def load_traces(trace_dir, name=None):
+    pattern = f'{TRACE_FILE_PREFIX}_{name}_*.json' if name else f'{TRACE_FILE_PREFIX}_*.json'
+    traces = []
+    for trace_file in sorted(Path(trace_dir).glob(pattern)):
+        with open(trace_file) as file:
+            traces.append(json.load(file))
+    return traces
+
+
+def _get_usage():
+    return {
+        'time': timer(),
+        'cpu_time': time.process_time(),
+        'children_cpu_time': _get_children_cpu_time(),
+        'rss': psutil.Process().memory_info().rss,
+        'peak_rss': _get_peak_rss(),
+    }
+
+
+def _get_usage_difference(start, end):
+    return {
+        # Seconds since the start of the run
+        'start_time': start['time'] - _trace_state['start'],
+        'wall_time': end['time'] - start['time'],
+        'cpu_time': end['cpu_time'] - start['cpu_time'],
+        # CPU time of child processes is only counted once they have been joined, like the workers of a pool
+        'children_cpu_time': end['children_cpu_time'] - start['children_cpu_time'],
+        'start_rss': start['rss'],
+        'end_rss': end['rss'],
+        # The high-water mark covers the whole process, a stage only raised it if it is larger than at its start
+        'peak_rss': max(end['peak_rss'], end['rss']),
+        'peak_rss_increase': max(0, end['peak_rss'] - start['peak_rss']),
+    }
+
+
+def _get_children_cpu_time():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _get_peak_rss():
+    if resource is None:
+        return psutil.Process().memory_info().rss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def _save_trace(trace, trace_file):
+    trace_file.parent.mkdir(parents=True, exist_ok=True)
+    temporary_file = trace_file.with_suffix('.json.tmp')
+    with open(temporary_file, 'w') as file:
+        json.dump(trace, file, indent=2, default=str)
+    os.replace(temporary_file, trace_file)
+
+
+def _start_profiler(profiler):
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+    if profiler == 'sampling':
+        return _start_sampling_profiler()
+    return None
+
+
+# Returns the profile entry of the trace, the complete profile is written to profile_file with the suffix .prof
+# for cProfile, readable by pstats or snakeviz, and .folded for the sampling profiler, readable by flamegraph.pl
+# or speedscope
+def _stop_profiler(profiler, profile, profile_file):
+    profile_file.parent.mkdir(parents=True, exist_ok=True)
+    if profiler == 'cprofile':
+        profile.disable()
+        profile_file = profile_file.with_suffix('.prof')
+        profile.dump_stats(profile_file)
+
+        functions = sorted(pstats.Stats(profile).stats.items(), key=lambda item: item[1][3], reverse=True)
+        return {
+            'file': str(profile_file),
+            'functions': [
+                {'function': _format_function(*function), 'calls': calls, 'total_time': total_time,
+                 'cumulative_time': cumulative_time}
+                for function, (_, calls, total_time, cumulative_time, _) in functions[:NUM_PROFILE_FUNCTIONS]
+            ],
+        }
+
+    profile['stop'].set()
+    profile['thread'].join()
+    profile_file = profile_file.with_suffix('.folded')
+    with open(profile_file, 'w') as file:
+        for stack, count in profile['stacks'].items():
+            file.write(f'{";".join(stack)} {count}\n')
+
+    # Samples in which a function is on the stack and on top of it, their shares approximate its cumulative
+    # and its own time
+    function_samples = Counter()
+    self_samples = Counter()
+    for stack, count in profile['stacks'].items():
+        for function in set(stack):
+            function_samples[function] += count
+        self_samples[stack[-1]] += count
+    num_samples = max(1, sum(profile['stacks'].values()))
+    return {
+        'file': str(profile_file),
+        'interval': SAMPLING_INTERVAL,
+        'samples': sum(profile['stacks'].values()),
+        'functions': [
+            {'function': function, 'samples': count, 'self_samples': self_samples[function],
+             'share': count / num_samples, 'self_share': self_samples[function] / num_samples}
+            for function, count in function_samples.most_common(NUM_PROFILE_FUNCTIONS)
+        ],
+        'self_functions': [
+            {'function': function, 'self_samples': count, 'self_share': count / num_samples}
+            for function, count in self_samples.most_common(NUM_PROFILE_FUNCTIONS)
+        ],
+    }
+
+
+# Samples the stack of the main thread every SAMPLING_INTERVAL seconds from a daemon thread. Unlike cProfile it
+# adds no overhead to the function calls, but time spent in native code without the GIL released can delay samples.
+def _start_sampling_profiler():
+    profile = {
+        'stacks': Counter(),
+        'stop': threading.Event(),
+    }
+    main_thread_id = threading.main_thread().ident
+
+    def sample():
+        while not profile['stop'].wait(SAMPLING_INTERVAL):
+            frame = sys._current_frames().get(main_thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_format_function(frame.f_code.co_filename, frame.f_code.co_firstlineno,
+                                              frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                profile['stacks'][tuple(reversed(stack))] += 1
+
+    profile['thread'] = threading.Thread(target=sample, name='sampling-profiler', daemon=True)
+    profile['thread'].start()
+    return profile
+
+
+def _format_function(file_name, line_number, function_name):
+    return f'{function_name} ({Path(file_name).name}:{line_number})'
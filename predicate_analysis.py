@@ -0,0 +1,171 @@
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+from metrics_store import get_metric_optimum
+from model_loading import EMBEDDING_DIMS, MODEL_NAMES
+
+# Axes of the predicate tensor, in the column names of the predicate_metrics.csv files plus the embedding dimension
+TENSOR_AXES = ['relation_label', 'Metric', 'model', 'dim']
+
+
+# Long-format metrics of all models and dimensions with a dim column, read from the locations of
+# model_loading.save_predicate_metrics. Missing files are skipped.
+def load_predicate_metrics(embedding_dims=EMBEDDING_DIMS, model_names=MODEL_NAMES, root: str = '.'):
+    metrics_files = {}
+    for embedding_dim in embedding_dims:
+        if embedding_dim == 32:
+            metrics_files[embedding_dim] = [Path(root) / 'metrics/predicate_metrics.csv']
+        else:
+            metrics_files[embedding_dim] = [
+                Path(root) / f'embeddings/dim_{embedding_dim}/{model_name}/predicate_metrics.csv'
+                for model_name in model_names
+            ]
+
+    predicate_metrics = [
+        pd.read_csv(metrics_file).assign(dim=embedding_dim)
+        for embedding_dim, files in metrics_files.items() for metrics_file in files if metrics_file.exists()
+    ]
+    if not predicate_metrics:
+        raise FileNotFoundError(f'No predicate metrics found for dimensions {list(embedding_dims)} in {root}')
+
+    predicate_metrics = pd.concat(predicate_metrics, ignore_index=True)
+    return predicate_metrics[predicate_metrics['model'].isin(model_names)]
+
+
+# Pivots long-format metrics of one side and rank type into a dense (relation, metric, model, dim) array. Every
+# row is placed by its own codes, so the order of the rows does not matter and missing combinations are NaN.
+# Metrics without a dim column are taken as metrics of embedding_dim.
+def build_predicate_tensor(predicate_metrics, metric_names=None, side='both', rank_type='realistic',
+                           embedding_dim: int = 32):
+    if side is not None:
+        predicate_metrics = predicate_metrics[predicate_metrics['Side'] == side]
+    if rank_type is not None:
+        predicate_metrics = predicate_metrics[predicate_metrics['Type'] == rank_type]
+    if metric_names is not None:
+        predicate_metrics = predicate_metrics[predicate_metrics['Metric'].isin(metric_names)]
+    if 'dim' not in predicate_metrics.columns:
+        predicate_metrics = predicate_metrics.assign(dim=embedding_dim)
+
+    axes = {}
+    codes = []
+    for axis in TENSOR_AXES:
+        categorical = pd.Categorical(predicate_metrics[axis])
+        axes[axis] = pd.Index(categorical.categories, name=axis)
+        codes.append(categorical.codes)
+
+    # Keep the metric order of metric_names, e.g. for plots
+    if metric_names is not None:
+        metric_names = [metric_name for metric_name in metric_names if metric_name in axes['Metric']]
+        codes[1] = pd.Index(metric_names).get_indexer(axes['Metric'][codes[1]])
+        axes['Metric'] = pd.Index(metric_names, name='Metric')
+
+    shape = [len(axes[axis]) for axis in TENSOR_AXES]
+    flat_codes = np.ravel_multi_index(codes, shape) if len(predicate_metrics) > 0 else np.empty(0, dtype=np.int64)
+    if len(np.unique(flat_codes)) < len(flat_codes):
+        raise ValueError('Several values per relation, metric, model and dim, select a single side and rank type')
+
+    values = np.full(shape, np.nan)
+    values.flat[flat_codes] = predicate_metrics['Value'].to_numpy(dtype=float)
+    return {
+        'axes': axes,
+        'values': values,
+    }
+
+
+# Variance of every metric over the models, averaged over the metrics and dimensions, per relation in descending
+# order. The variances are not normalised, so metrics on larger scales like the mean rank dominate.
+def get_metric_variances(predicate_tensor):
+    model_axis = TENSOR_AXES.index('model')
+    # Relations without any value of a metric give all-NaN slices, which are expected
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        variances = np.nanvar(predicate_tensor['values'], axis=model_axis)
+        # Relations without any metric, model or dim have no variance, e.g. if none of the selected metrics exist
+        if variances.size == 0:
+            variances = np.full(len(variances), np.nan)
+        else:
+            variances = np.nanmean(variances.reshape(len(variances), -1), axis=1)
+
+    variances_df = pd.DataFrame({
+        'relation_label': predicate_tensor['axes']['relation_label'],
+        'variance': variances,
+    })
+    return variances_df.sort_values(by='variance', ascending=False, ignore_index=True)
+
+
+# Ranks of the models for every relation, metric and dim, 1 is the best value of the metric. Ties get the
+# average rank and missing values stay NaN.
+def get_model_ranks(predicate_tensor):
+    metric_axis = TENSOR_AXES.index('Metric')
+    signs = np.array([-1.0 if get_metric_optimum(metric_name) == 'max' else 1.0
+                      for metric_name in predicate_tensor['axes']['Metric']])
+    oriented = predicate_tensor['values'] * np.expand_dims(signs, [axis for axis in range(len(TENSOR_AXES))
+                                                                   if axis != metric_axis])
+    return rankdata(oriented, axis=TENSOR_AXES.index('model'), nan_policy='omit')
+
+
+# Kendall's coefficient of concordance W of the model rankings, with the metrics (or the dimensions) as raters.
+# 1 means that all raters rank the models the same, 0 that there is no agreement. Tied models get the average rank
+# and W is corrected for the ties. Only the models with a value for every rater are ranked, e.g. the models of all
+# compared dimensions. Returns a DataFrame of the relations by the remaining axis, NaN where fewer than two models
+# are complete, where there are fewer than two raters or where every rater ties all models.
+def get_rank_agreement(predicate_tensor, rater_axis='Metric'):
+    if rater_axis not in ('Metric', 'dim'):
+        raise ValueError(f'Rank agreement is computed over metrics or dimensions, not {rater_axis}')
+
+    model_axis = TENSOR_AXES.index('model')
+    values = predicate_tensor['values']
+    incomplete = np.isnan(values).any(axis=TENSOR_AXES.index(rater_axis), keepdims=True)
+    ranks = get_model_ranks({**predicate_tensor, 'values': np.where(incomplete, np.nan, values)})
+
+    # relation x remaining axis x model x rater
+    ranks = np.moveaxis(ranks, [model_axis, TENSOR_AXES.index(rater_axis)], [2, 3])
+    num_models = np.sum(~np.isnan(ranks[..., 0]), axis=2)
+    num_raters = ranks.shape[3]
+
+    # Every group of t models tied by a rater adds t^3 - t to the tie correction, which is the sum of t^2 - 1
+    # over the models of the group
+    tie_counts = np.sum(ranks[..., :, None, :] == ranks[..., None, :, :], axis=3)
+    ties = np.nansum(np.where(np.isnan(ranks), np.nan, tie_counts ** 2 - 1), axis=(2, 3))
+
+    rank_sums = ranks.sum(axis=3)
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        squared_deviations = np.nansum((rank_sums - np.nanmean(rank_sums, axis=2, keepdims=True)) ** 2, axis=2)
+        denominator = num_raters ** 2 * (num_models ** 3 - num_models) - num_raters * ties
+        agreement = 12 * squared_deviations / denominator
+    # A single rater cannot disagree and raters that tie all models do not rank them at all
+    agreement[(num_models < 2) | (num_raters < 2) | (denominator <= 0)] = np.nan
+
+    remaining_axis = 'dim' if rater_axis == 'Metric' else 'Metric'
+    return pd.DataFrame(agreement, index=predicate_tensor['axes']['relation_label'],
+                        columns=predicate_tensor['axes'][remaining_axis])
+
+
+# Best and worst model of every relation, metric and dim with their values and the spread between them
+def get_model_extremes(predicate_tensor):
+    axes = predicate_tensor['axes']
+    values = predicate_tensor['values']
+    model_axis = TENSOR_AXES.index('model')
+
+    ranks = get_model_ranks(predicate_tensor)
+    missing = np.isnan(values).all(axis=model_axis)
+    best = np.nanargmin(np.where(missing[:, :, None], 0, ranks), axis=model_axis)
+    worst = np.nanargmax(np.where(missing[:, :, None], 0, ranks), axis=model_axis)
+    best_values = np.take_along_axis(values, best[:, :, None], axis=model_axis).squeeze(model_axis)
+    worst_values = np.take_along_axis(values, worst[:, :, None], axis=model_axis).squeeze(model_axis)
+
+    index = pd.MultiIndex.from_product([axes['relation_label'], axes['Metric'], axes['dim']])
+    extremes = pd.DataFrame({
+        'best_model': np.asarray(axes['model'])[best].reshape(-1),
+        'best_value': best_values.reshape(-1),
+        'worst_model': np.asarray(axes['model'])[worst].reshape(-1),
+        'worst_value': worst_values.reshape(-1),
+        'spread': np.abs(best_values - worst_values).reshape(-1),
+    }, index=index).reset_index()
+    return extremes[~missing.reshape(-1)].reset_index(drop=True)
+
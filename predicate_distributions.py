@@ -1,31 +1,34 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from dataset_statistics import load_dataset_statistics
+from triple_store import get_store_dir
+
 
 def main():
-    df = pd.read_csv('dataset/wikidata5m/wikidata5m_transductive_train.txt', sep='\t', names=['S', 'P', 'O'])
-    get_predicate_frequencies(df)
-    get_object_frequencies_per_predicate(df)
-    get_subject_frequencies_per_predicate(df)
+    # All counts come from the cached statistics of the integer-coded training triples
+    predicate_statistics = load_dataset_statistics(get_store_dir(32), ['train'])['predicates']
+    get_predicate_frequencies(predicate_statistics)
+    get_object_frequencies_per_predicate(predicate_statistics)
+    get_subject_frequencies_per_predicate(predicate_statistics)
 
 
-def get_predicate_frequencies(df):
-    p_frequencies = df['P'].value_counts(sort=True)
+def get_predicate_frequencies(predicate_statistics):
+    p_frequencies = predicate_statistics['triples'].sort_values(ascending=False)
     print(f'Predicate frequencies length: {p_frequencies.size}')
     plt.bar(np.arange(p_frequencies.size), p_frequencies)
     plt.show()
 
 
-def get_object_frequencies_per_predicate(df):
-    o_frequencies = df[['P', 'O']].groupby('P').nunique()['O']
+def get_object_frequencies_per_predicate(predicate_statistics):
+    o_frequencies = predicate_statistics['objects']
     print(f'Object frequencies length: {o_frequencies.size}')
     plt.bar(np.arange(o_frequencies.size), o_frequencies)
     plt.show()
 
 
-def get_subject_frequencies_per_predicate(df):
-    s_frequencies = df[['S', 'P']].groupby('P').nunique()['S']
+def get_subject_frequencies_per_predicate(predicate_statistics):
+    s_frequencies = predicate_statistics['subjects']
     print(f'Subject frequencies length: {s_frequencies.size}')
     plt.bar(np.arange(s_frequencies.size), s_frequencies)
     plt.show()
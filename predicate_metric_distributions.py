@@ -3,9 +3,11 @@ import pandas as pd
 import seaborn as sns
 from matplotlib import pyplot as plt
 
+from metrics_store import get_metric_slice, load_metrics_store
+
 
 def main():
-    predicate_metrics = pd.read_csv('metrics/predicate_metrics.csv')
+    predicate_metrics = load_metrics_store('metrics/predicate_metrics.csv')
 
     distmult_512_metrics = pd.read_csv('embeddings/dim_512/distmult/predicate_metrics.csv')
     simple_512_metrics = pd.read_csv('embeddings/dim_512/simple/predicate_metrics.csv')
@@ -92,15 +94,14 @@ def plot_joint_metric_distributions(metric_name,
     plt.show()
 
 
-def get_predicate_metric_distribution(metrics: pd.DataFrame,
+def get_predicate_metric_distribution(metrics_store,
                                       metric_name: str,
                                       model_name: str,
                                       target: str,
                                       metric_type: str):
-    return metrics.query('Metric == @metric_name and '
-                         'Type == @metric_type and '
-                         'model == @model_name and '
-                         'Side == @target')['Value']
+    # Values of all predicates, indexed by relation label
+    return get_metric_slice(metrics_store, metric_name=metric_name, model_name=model_name, side=target,
+                            rank_type=metric_type)
 
 
 if __name__ == '__main__':
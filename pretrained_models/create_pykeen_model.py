@@ -35,6 +35,8 @@ def main():
         relation_initializer=PretrainedInitializer(tensor=torch.view_as_real(relation_embeddings))
     )
 
+    # Inference loads entity_embeddings.npy and relation_embeddings.npy memory-mapped through mmap_models.py,
+    # the state dict is only a fallback for embeddings whose layout does not match the model
     print(f'[X] Saving PyKEEN model to {trained_model_path}')
     torch.save(model.state_dict(), trained_model_path, pickle_protocol=pickle.HIGHEST_PROTOCOL)
 
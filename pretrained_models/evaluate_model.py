@@ -1,94 +1,76 @@
-import numpy as np
-import pandas as pd
+import argparse
+import sys
+from pathlib import Path
+
 import torch
-from pykeen.datasets import get_dataset
-from pykeen.evaluation import RankBasedEvaluator, RankBasedMetricResults
-from pykeen.evaluation.rank_based_evaluator import _iter_ranks
 from pykeen.models import DistMult
 from pykeen.triples import TriplesFactory
 
 from extract_pretrained_embeddings import ModelName
 
+# Make the modules of the repository root importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from filtered_ranking import get_filter_index
+from metrics_cache import load_cached_predicate_metrics, update_rank_cache
+from pipeline_trace import add_profiler_argument, run_trace, trace_stage
+from sampled_evaluation import CI_TOLERANCE, evaluate_sampled_predicate_metrics
+from triple_store import get_store_dir, open_triple_store
+
 # Get torch device
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Evaluate a pretrained model per predicate')
+    parser.add_argument('--sampled', action='store_true',
+                        help='Estimate the metrics from sampled candidates with bootstrap confidence intervals')
+    parser.add_argument('--tolerance', type=float, default=CI_TOLERANCE)
+    add_profiler_argument(parser)
+    args = parser.parse_args()
+
     model_name: ModelName = 'distmult'
+    with run_trace('evaluate_model', [f'../embeddings/dim_512/{model_name}'], args.profiler):
+        evaluate_model(model_name, args.sampled, args.tolerance)
 
-    print('[X] Loading Wikidata5M test set')
-    wikidata5m_test = pd.read_csv('../dataset/wikidata5m/wikidata5m_transductive_test.txt', sep='\t',
-                                  names=['S', 'P', 'O'], header=None)
-    wikidata5m_dataset = get_dataset(dataset='Wikidata5M')
 
-    print(f'[X] Loading train factory for {model_name}')
-    train_factory = TriplesFactory.from_path_binary(f'../embeddings/dim_512/{model_name}/training_factory')
+def evaluate_model(model_name: ModelName, sampled=False, tolerance: float = CI_TOLERANCE):
 
-    print(f'[X] Loading {model_name} model')
-    model = DistMult(
-        triples_factory=train_factory,
-        embedding_dim=512
-    )
-    model.load_state_dict(torch.load(f'../embeddings/dim_512/{model_name}/trained_model_state_dict.pt'))
+    print('[X] Loading Wikidata5M triple store')
+    wikidata5m_store = open_triple_store(get_store_dir(512, root='..'))
+    filter_index = get_filter_index(get_store_dir(512, root='..'))
 
-    print(f'[X] Starting evaluation on Wikidata5M test set with {model_name}')
-    predicate_metrics = evaluate_model_per_predicate(model, model_name, train_factory, wikidata5m_test, wikidata5m_dataset)
+    @trace_stage('load_model')
+    def get_model():
+        print(f'[X] Loading train factory for {model_name}')
+        train_factory = TriplesFactory.from_path_binary(f'../embeddings/dim_512/{model_name}/training_factory')
 
-    print(f'[X] Finished evaluation, saving results')
-    predicate_metrics.to_csv(f'../embeddings/dim_512/{model_name}/predicate_metrics.csv', index=False)
+        print(f'[X] Loading {model_name} model')
+        model = DistMult(
+            triples_factory=train_factory,
+            embedding_dim=512
+        )
+        model.load_state_dict(torch.load(f'../embeddings/dim_512/{model_name}/trained_model_state_dict.pt'))
+        return model
 
+    if sampled:
+        # Minutes instead of hours, the ranks are estimated and not cached
+        print(f'[X] Starting sampled evaluation on Wikidata5M test set with {model_name}')
+        predicate_metrics = evaluate_sampled_predicate_metrics(get_model().to(device), wikidata5m_store, filter_index,
+                                                               model_name, tolerance=tolerance)
+        predicate_metrics.to_csv(f'../embeddings/dim_512/{model_name}/predicate_metrics_sampled.csv', index=False)
+        return
 
-def evaluate_model_per_predicate(trained_model, model_name, train_factory, wikidata5m_test_set, dataset):
-    test_factory = TriplesFactory.from_labeled_triples(
-        triples=wikidata5m_test_set.values,
-        entity_to_id=train_factory.entity_to_id,
-        relation_to_id=train_factory.relation_to_id
-    )
-
-    evaluator = RankBasedEvaluator(clear_on_finalize=False)
-    evaluator.evaluate(
-        model=trained_model,
-        mapped_triples=test_factory.mapped_triples,
-        batch_size=4,
-        additional_filter_triples=[
-            dataset.training.mapped_triples,
-            dataset.validation.mapped_triples
-        ]
-    )
-
-    ranks_df = test_factory.tensor_to_df(
-        tensor=test_factory.mapped_triples,
-        **{"-".join(("rank",) + key): np.concatenate(value) for key, value in evaluator.ranks.items()},
-        **{"-".join(("num_candidates", key)): np.concatenate(value) for key, value in
-           evaluator.num_candidates.items()},
-    )
+    print(f'[X] Starting evaluation on Wikidata5M test set with {model_name}')
+    # Ranks are cached per relation under a fingerprint of the model files and the relation's triples. A restarted
+    # or repeated evaluation only ranks the relations that are missing or changed and loads the model only then.
+    update_rank_cache(model_name, 512, wikidata5m_store, filter_index, get_model, root='..')
 
     print('[X] Aggregating all metrics in a dataframe')
+    predicate_metrics = load_cached_predicate_metrics(model_name, 512, wikidata5m_store, root='..')
 
-    aggregated_metrics = pd.DataFrame()
-
-    for (relation_id, relation_label), group in ranks_df.groupby(by=['relation_id', 'relation_label']):
-        relation_ranks = {}
-        relation_num_candidates = {}
-
-        for column in group.columns:
-            if column.startswith('rank-'):
-                relation_ranks[tuple(column.split('-')[1:])] = [group[column].values]
-            elif column.startswith('num_candidates-'):
-                relation_num_candidates[tuple(column.split('-'))[1]] = [group[column].values]
-
-        metric_results = RankBasedMetricResults.from_ranks(
-            metrics=evaluator.metrics,
-            rank_and_candidates=_iter_ranks(ranks=relation_ranks, num_candidates=relation_num_candidates)
-        ).to_df()
-
-        metric_results['relation_id'] = relation_id
-        metric_results['relation_label'] = relation_label
-        metric_results['model'] = model_name
-
-        aggregated_metrics = pd.concat([aggregated_metrics, metric_results], ignore_index=True)
-
-    return aggregated_metrics
+    print(f'[X] Finished evaluation, saving results')
+    predicate_metrics.to_csv(f'../embeddings/dim_512/{model_name}/predicate_metrics.csv', index=False)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,8 @@
 #!/usr/bin/env bash
 
 # Script to evaluate a model on Google Cloud Engine
-# and shutdown afterwards
+# and shutdown afterwards. Ranks are cached per relation,
+# so a re-run after pre-emption skips the finished relations.
 
 python evaluate_model.py
 
@@ -0,0 +1,209 @@
+import argparse
+import json
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import torch
+from numpy.lib.format import open_memmap
+
+from batch_tuner import tune_batch_size
+from evaluation_shards import evaluate_shards, get_evaluation_fingerprint, load_shard_ranks
+from filtered_ranking import get_filter_index
+from metric_aggregation import aggregate_predicate_metrics
+from mmap_models import MemoryMappedEmbedding, create_empty_model
+from model_loading import MODEL_CLASSES, MODEL_NAMES, load_model
+from triple_store import get_mapped_triples, get_store_dir, open_triple_store
+
+Precision = Literal['float16', 'int8']
+
+PRECISIONS: list[Precision] = ['float16', 'int8']
+
+# Number of entity rows that are quantised at once
+CHUNK_SIZE = 100_000
+
+# Metrics of the accuracy regression report
+REPORT_METRICS = ['hits_at_1', 'hits_at_3', 'hits_at_10']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantise the entity embeddings of the 512-dim models')
+    parser.add_argument('--models', nargs='+', choices=MODEL_NAMES, default=MODEL_NAMES)
+    parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=PRECISIONS)
+    parser.add_argument('--report', action='store_true',
+                        help='Evaluate the quantised models and compare their per-predicate hits@k to float32')
+    args = parser.parse_args()
+
+    embedding_dim = 512
+    for model_name in args.models:
+        missing = [precision for precision in args.precisions
+                   if not is_quantized_model(get_quantized_dir(model_name, embedding_dim, precision))]
+        if missing:
+            print(f'[X] Loading {model_name} model with dimension {embedding_dim}')
+            model = load_model(model_name, embedding_dim)
+            for precision in missing:
+                print(f'[X] Quantising {model_name} entity embeddings to {precision}')
+                quantize_model(model, get_quantized_dir(model_name, embedding_dim, precision), precision)
+
+            # Release the float32 model before the next one is loaded
+            del model
+
+        if args.report:
+            for precision in args.precisions:
+                report = create_accuracy_report(model_name, embedding_dim, precision)
+                print(f'[X] Largest per-predicate hits@k drops of {model_name} with {precision}:')
+                print(report.nsmallest(5, 'delta'))
+
+
+def get_quantized_dir(model_name, embedding_dim: int, precision: Precision, root: str = '.'):
+    return Path(root) / f'embeddings/dim_{embedding_dim}/{model_name}/quantized_{precision}'
+
+
+def is_quantized_model(quantized_dir):
+    return (Path(quantized_dir) / 'metadata.json').exists()
+
+
+# Saves the entity representations with float16 values or int8 values with one float32 scale per row.
+# Relations are few, their representations are kept in float32.
+def quantize_model(model, quantized_dir, precision: Precision):
+    quantized_dir = Path(quantized_dir)
+    quantized_dir.mkdir(parents=True, exist_ok=True)
+
+    metadata = {
+        'model': type(model).__name__.lower(),
+        'precision': precision,
+        'num_entities': model.num_entities,
+        'num_relations': model.num_relations,
+        'entity_representations': [],
+        'relation_representations': [],
+    }
+
+    with torch.inference_mode():
+        for index, representation in enumerate(model.entity_representations):
+            metadata['entity_representations'].append(
+                _quantize_representation(representation, quantized_dir / f'entity_{index}', precision)
+            )
+
+        for index, representation in enumerate(model.relation_representations):
+            metadata['relation_representations'].append(
+                _quantize_representation(representation, quantized_dir / f'relation_{index}', 'float32')
+            )
+
+    # The metadata is written last and marks the quantised model as complete
+    with open(quantized_dir / 'metadata.json', 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+
+# Creates the model without allocating its float32 representations and scores from the memory-mapped quantised
+# entity arrays, which are dequantised per batch
+def load_quantized_model(model_name, embedding_dim: int = 512, precision: Precision = 'int8', root: str = '.'):
+    quantized_dir = get_quantized_dir(model_name, embedding_dim, precision, root)
+    with open(quantized_dir / 'metadata.json') as metadata_file:
+        metadata = json.load(metadata_file)
+
+    model = create_empty_model(MODEL_CLASSES[model_name], embedding_dim, metadata['num_entities'],
+                               metadata['num_relations'])
+    model.entity_representations = torch.nn.ModuleList([
+        _load_representation(quantized_dir / f'entity_{index}', settings)
+        for index, settings in enumerate(metadata['entity_representations'])
+    ])
+    model.relation_representations = torch.nn.ModuleList([
+        _load_representation(quantized_dir / f'relation_{index}', settings)
+        for index, settings in enumerate(metadata['relation_representations'])
+    ])
+    return model.eval()
+
+
+# Evaluates the quantised model on the test set and compares its per-predicate hits@k with the float32 metrics
+# in predicate_metrics.csv of the model directory
+def create_accuracy_report(model_name, embedding_dim: int, precision: Precision, root: str = '.'):
+    quantized_dir = get_quantized_dir(model_name, embedding_dim, precision, root)
+    store_dir = get_store_dir(embedding_dim, root)
+    store = open_triple_store(store_dir)
+
+    model = load_quantized_model(model_name, embedding_dim, precision, root)
+    settings = tune_batch_size(model)
+
+    print(f'[X] Evaluating {model_name} with {precision} entity embeddings')
+    test_triples = get_mapped_triples(store, 'test')
+    filter_index = get_filter_index(store_dir)
+
+    # Ranks of an earlier quantisation, model or filter index are evaluated again
+    model_paths = [quantized_dir / 'metadata.json', *sorted(quantized_dir.glob('entity_*')),
+                   *sorted(quantized_dir.glob('relation_*'))]
+    fingerprint = get_evaluation_fingerprint(model_paths, test_triples, filter_index, root)
+
+    shard_dir = quantized_dir / 'ranks'
+    evaluate_shards(model, test_triples, filter_index, shard_dir, batch_size=settings['batch_size'],
+                    slice_size=settings['slice_size'], fingerprint=fingerprint)
+    relation_ids, ranks, num_candidates = load_shard_ranks(shard_dir)
+    quantized_metrics = aggregate_predicate_metrics(relation_ids, ranks, num_candidates, store['relation_labels'],
+                                                    model_name)
+
+    float_metrics = pd.read_csv(Path(root) / f'embeddings/dim_{embedding_dim}/{model_name}/predicate_metrics.csv')
+
+    keys = ['relation_label', 'Metric']
+    query = 'Side == "both" and Type == "realistic" and Metric in @REPORT_METRICS'
+    report = pd.merge(
+        float_metrics.query(query)[keys + ['Value']].rename(columns={'Value': 'float32'}),
+        quantized_metrics.query(query)[keys + ['Value']].rename(columns={'Value': precision}),
+        on=keys
+    )
+    report['delta'] = report[precision] - report['float32']
+
+    report.to_csv(quantized_dir / 'accuracy_report.csv', index=False)
+    print(report.groupby('Metric')['delta'].agg(['mean', 'min', 'max']))
+    return report
+
+
+def _load_representation(path, settings):
+    scales = np.load(path.with_suffix('.scales.npy'), mmap_mode='c') if settings['precision'] == 'int8' else None
+    return MemoryMappedEmbedding(np.load(path.with_suffix('.npy'), mmap_mode='c'), shape=settings['shape'],
+                                 scales=scales, is_complex=settings['is_complex'])
+
+
+def _quantize_representation(representation, path, precision):
+    num_rows = representation.max_id
+    is_complex = False
+    x = representation(indices=torch.zeros(1, dtype=torch.long, device=representation.device))
+    if x.is_complex():
+        is_complex = True
+        x = torch.view_as_real(x)
+    row_size = x[0].numel()
+
+    values = open_memmap(path.with_suffix('.npy'), mode='w+', dtype=np.dtype(precision), shape=(num_rows, row_size))
+    scales = None
+    if precision == 'int8':
+        scales = open_memmap(path.with_suffix('.scales.npy'), mode='w+', dtype=np.float32, shape=(num_rows,))
+
+    for start in range(0, num_rows, CHUNK_SIZE):
+        indices = torch.arange(start, min(start + CHUNK_SIZE, num_rows), device=representation.device)
+        x = representation(indices=indices)
+        if is_complex:
+            x = torch.view_as_real(x)
+        x = x.reshape(len(indices), row_size).float().cpu()
+
+        if precision == 'int8':
+            # Symmetric per-row scale, so that the largest absolute value of every row maps to 127
+            row_scales = x.abs().amax(dim=1) / 127
+            row_scales[row_scales == 0] = 1
+            values[start:start + len(indices)] = torch.round(x / row_scales[:, None]).to(torch.int8).numpy()
+            scales[start:start + len(indices)] = row_scales.numpy()
+        else:
+            values[start:start + len(indices)] = x.numpy().astype(precision)
+
+    values.flush()
+    if scales is not None:
+        scales.flush()
+
+    return {
+        'max_id': num_rows,
+        'shape': list(representation.shape),
+        'precision': precision,
+        'is_complex': is_complex,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from batch_prediction import TOP_K, TargetSide
+from completion_engine import complete_targets, get_route_names, load_completion_engine
+from triple_store import map_entity_labels, map_relation_labels
+
+# Number of partial bindings that are kept after every hop
+BEAM_WIDTH = 100
+
+# Number of (side, model, entity, relation) predictions that are memoised
+PREDICTION_CACHE_SIZE = 100_000
+
+
+def main():
+    engine = load_completion_engine(embedding_dim=32)
+    cache = create_prediction_cache()
+
+    query = 'Q328584 P17 ?o1 . ?o1 P47 ?o2'
+    print(f'[X] Completing {query}')
+    print(complete_query(engine, query, cache=cache).head(TOP_K))
+    print(f'[X] Prediction cache hits: {cache["hits"]}, misses: {cache["misses"]}')
+
+
+# Parses a basic graph pattern like 's p1 ?o1 . ?o1 p2 ?o2' into (s, p, o) term tuples
+def parse_query(query):
+    patterns = []
+    for pattern in query.split(' .'):
+        terms = pattern.split()
+        if not terms:
+            continue
+        if len(terms) != 3:
+            raise ValueError(f'Triple pattern "{pattern.strip()}" does not consist of subject, predicate and object')
+        patterns.append(tuple(terms))
+    return patterns
+
+
+def is_variable(term):
+    return term.startswith('?')
+
+
+# Orders the patterns so that every pattern starts from a term that is already bound, either a constant or a
+# variable completed by an earlier step. Patterns with both ends bound only check the beam and are scheduled
+# as early as possible, expansions from constants before expansions from variables, which keeps the beam small.
+def plan_query(patterns):
+    for pattern in patterns:
+        if is_variable(pattern[1]):
+            raise ValueError(f'Triple pattern "{" ".join(pattern)}" has a variable predicate')
+
+    bound = {term for pattern in patterns for term in (pattern[0], pattern[2]) if not is_variable(term)}
+    remaining = list(patterns)
+    steps = []
+    while remaining:
+        candidates = []
+        for pattern in remaining:
+            subject, _, obj = pattern
+            if subject in bound and obj in bound:
+                candidates.append((0, pattern, 'tail', subject, obj, False))
+            elif subject in bound:
+                candidates.append((1 if is_variable(subject) else 0.5, pattern, 'tail', subject, obj, True))
+            elif obj in bound:
+                candidates.append((1 if is_variable(obj) else 0.5, pattern, 'head', obj, subject, True))
+
+        if not candidates:
+            unbound = ' . '.join(' '.join(pattern) for pattern in remaining)
+            raise ValueError(f'Triple patterns "{unbound}" are not connected to a constant')
+
+        _, pattern, side, source, target, expand = min(candidates, key=lambda candidate: candidate[0])
+        steps.append({'pattern': pattern, 'side': side, 'source': source, 'target': target, 'expand': expand})
+        bound.add(target)
+        remaining.remove(pattern)
+
+    return steps
+
+
+# Completes a query hop by hop. Every hop scores the distinct (entity, relation) pairs of the beam in one batch,
+# expands every binding by its top k targets and keeps the beam_width bindings with the smallest product of
+# ranks. Patterns whose target is already bound keep the bindings whose target is among the top k.
+# predict(side, queries, top_k) replaces the cached predictions, e.g. to batch the hops of concurrent queries.
+def complete_query(engine, query, top_k: int = TOP_K, beam_width: int = BEAM_WIDTH, cache=None, model_name=None,
+                   predict=None):
+    patterns = parse_query(query) if isinstance(query, str) else query
+    if not patterns:
+        raise ValueError('Query does not contain any triple pattern')
+    steps = plan_query(patterns)
+    store = engine['store']
+    if predict is None:
+        cache = create_prediction_cache() if cache is None else cache
+        predict = lambda side, queries, k: predict_cached(engine, cache, side, queries, k, model_name)
+
+    constants = sorted({term for pattern in patterns for term in (pattern[0], pattern[2]) if not is_variable(term)})
+    constant_ids = dict(zip(constants, map_entity_labels(store, constants)))
+    unknown = [term for term, entity_id in constant_ids.items() if entity_id < 0]
+    if unknown:
+        raise ValueError(f'Entities {unknown} are not part of the store')
+
+    relations = sorted({pattern[1] for pattern in patterns})
+    relation_ids = dict(zip(relations, map_relation_labels(store, relations)))
+    unknown = [term for term, relation_id in relation_ids.items() if relation_id < 0]
+    if unknown:
+        raise ValueError(f'Relations {unknown} are not part of the store')
+
+    # Beam of partial bindings as aligned columns
+    columns = {}
+    combined_rank = np.ones(1, dtype=np.int64)
+
+    for step in steps:
+        source = step['source']
+        if is_variable(source):
+            source_ids = columns[f'{source[1:]}_id']
+        else:
+            source_ids = np.full(len(combined_rank), constant_ids[source], dtype=np.int32)
+
+        relation = np.full(len(source_ids), relation_ids[step['pattern'][1]], dtype=np.int32)
+        queries = np.stack([source_ids, relation] if step['side'] == 'tail' else [relation, source_ids], axis=1)
+        if len(queries) > 0:
+            top_ids, top_scores, models = predict(step['side'], queries, top_k)
+        else:
+            # An empty beam stays empty, the remaining steps only add their columns to the empty result
+            top_ids, top_scores, models = _get_empty_predictions(top_k)
+
+        target = step['target']
+        if step['expand']:
+            num_targets = top_ids.shape[1]
+            columns = {name: np.repeat(values, num_targets) for name, values in columns.items()}
+            ranks = np.tile(np.arange(1, num_targets + 1), len(top_ids))
+
+            name = target[1:]
+            columns[f'{name}_id'] = top_ids.reshape(-1)
+            columns[f'{name}_score'] = top_scores.reshape(-1)
+            columns[f'{name}_model'] = np.repeat(models, num_targets)
+            columns[f'{name}_rank'] = ranks
+            combined_rank = np.repeat(combined_rank, num_targets) * ranks
+        else:
+            if is_variable(target):
+                target_ids = columns[f'{target[1:]}_id']
+            else:
+                target_ids = np.full(len(top_ids), constant_ids[target], dtype=np.int32)
+
+            matches = top_ids == target_ids[:, None]
+            found = matches.any(axis=1)
+            columns = {name: values[found] for name, values in columns.items()}
+            combined_rank = combined_rank[found] * (matches[found].argmax(axis=1) + 1)
+
+        # A stable sort keeps bindings with equal combined ranks in the order of the earlier hops
+        beam = np.argsort(combined_rank, kind='stable')[:beam_width]
+        columns = {name: values[beam] for name, values in columns.items()}
+        combined_rank = combined_rank[beam]
+
+    predictions = pd.DataFrame(columns)
+    for name in [column[:-3] for column in columns if column.endswith('_id')]:
+        predictions.insert(predictions.columns.get_loc(f'{name}_id'), f'{name}_label',
+                           store['entity_labels'][predictions[f'{name}_id'].to_numpy()])
+    predictions['combined_rank'] = combined_rank
+    return predictions
+
+
+def create_prediction_cache(max_size: int = PREDICTION_CACHE_SIZE):
+    return {'entries': OrderedDict(), 'max_size': max_size, 'hits': 0, 'misses': 0}
+
+
+# Scores only the distinct queries that are not memoised yet in one batch and returns the top k ids, scores
+# and model names of all queries. Cached entries are reused for any top k up to the one they were computed for.
+def predict_cached(engine, cache, side: TargetSide, queries, top_k: int = TOP_K, model_name=None):
+    top_k = min(top_k, engine['models'][0].num_entities)
+    if len(queries) == 0:
+        return _get_empty_predictions(top_k)
+    unique_queries, inverse = np.unique(np.asarray(queries, dtype=np.int64), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    entries = cache['entries']
+    keys = [(side, model_name, int(first), int(second)) for first, second in unique_queries]
+    results = [None] * len(keys)
+    for index, key in enumerate(keys):
+        entry = entries.get(key)
+        if entry is not None and len(entry[0]) >= top_k:
+            entries.move_to_end(key)
+            results[index] = entry
+
+    missing = [index for index, result in enumerate(results) if result is None]
+    cache['hits'] += len(keys) - len(missing)
+    cache['misses'] += len(missing)
+
+    if missing:
+        top_ids, top_scores, routes = complete_targets(engine, side, unique_queries[missing], top_k, model_name)
+        model_names = get_route_names(engine, routes)
+        for row, index in enumerate(missing):
+            results[index] = (top_ids[row], top_scores[row], model_names[row])
+            entries[keys[index]] = results[index]
+            entries.move_to_end(keys[index])
+
+        while len(entries) > cache['max_size']:
+            entries.popitem(last=False)
+
+    top_ids = np.stack([result[0][:top_k] for result in results])
+    top_scores = np.stack([result[1][:top_k] for result in results])
+    model_names = np.asarray([result[2] for result in results])
+    return top_ids[inverse], top_scores[inverse], model_names[inverse]
+
+
+def _get_empty_predictions(top_k: int):
+    return np.empty((0, top_k), dtype=np.int32), np.empty((0, top_k), dtype=np.float32), np.empty(0, dtype=object)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import gzip
+import os
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+
+from triple_store import O, P, S, SUBSET_TYPES, get_store_dir, is_triple_store, open_triple_store
+
+RdfFormat = Literal['nt', 'ttl']
+
+WIKIDATA_PREFIX = 'https://www.wikidata.org/wiki/'
+
+# Graph that Virtuoso's ld_dir assigns to every file of an export directory through global.graph
+GRAPH_IRI = 'https://www.wikidata.org/wikidata5m'
+
+# Triples per output file, the files of a directory are loaded in parallel by several rdf_loader_run() calls
+TRIPLES_PER_FILE = 1_000_000
+
+# Fast compression, the exported files are only read once by the bulk loader
+COMPRESS_LEVEL = 3
+
+# Start and end of every IRI, Turtle uses the wd: prefix declared at the top of each file
+TERM_DELIMITERS = {
+    'nt': (f'<{WIKIDATA_PREFIX}', '>'),
+    'ttl': ('wd:', ''),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export Wikidata5M triples as gzipped N-Triples or Turtle files')
+    parser.add_argument('--subsets', nargs='+', choices=SUBSET_TYPES, default=['train'])
+    parser.add_argument('--format', choices=list(TERM_DELIMITERS), default='nt')
+    parser.add_argument('--output-dir', default='dataset/wikidata5m/rdf')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    export_store(get_store_dir(32), args.subsets, args.output_dir, args.format, args.workers)
+
+
+# Splits the subsets of a triple store into files of TRIPLES_PER_FILE triples, which the workers read from the
+# memory-mapped store, format and compress independently
+def export_store(store_dir, subset_types, output_dir, rdf_format: RdfFormat = 'nt', num_workers: int = os.cpu_count(),
+                 triples_per_file: int = TRIPLES_PER_FILE, graph_iri: str = GRAPH_IRI):
+    if not is_triple_store(store_dir):
+        raise ValueError(f'No triple store found at {store_dir}, run triple_store.py first')
+
+    output_dir = prepare_output_dir(output_dir, graph_iri)
+    num_triples = open_triple_store(store_dir)['metadata']['num_triples']
+
+    work_units = []
+    for subset_type in subset_types:
+        for part, start in enumerate(range(0, num_triples[subset_type], triples_per_file)):
+            end = min(start + triples_per_file, num_triples[subset_type])
+            output_file = output_dir / get_part_file(f'wikidata5m_transductive_{subset_type}', part, rdf_format)
+            work_units.append((store_dir, subset_type, start, end, output_file, rdf_format))
+
+    print(f'[X] Exporting {sum(num_triples[s] for s in subset_types)} triples to {len(work_units)} {rdf_format} '
+          f'files in {output_dir}')
+    _run_work_units(_export_store_part, work_units, num_workers)
+
+
+# Exports labeled triples from a tab separated file, for datasets without a triple store
+def export_labeled_triples(triples_file, name, output_dir, rdf_format: RdfFormat = 'nt',
+                           num_workers: int = os.cpu_count(), triples_per_file: int = TRIPLES_PER_FILE,
+                           graph_iri: str = GRAPH_IRI):
+    output_dir = prepare_output_dir(output_dir, graph_iri)
+    chunks = pd.read_csv(triples_file, sep='\t', names=['S', 'P', 'O'], dtype=str, chunksize=triples_per_file)
+
+    # Chunks are read lazily while the workers format and compress the previous ones
+    work_units = ((chunk, output_dir / get_part_file(name, part, rdf_format), rdf_format)
+                  for part, chunk in enumerate(chunks))
+
+    print(f'[X] Exporting {triples_file} to {rdf_format} files in {output_dir}')
+    _run_work_units(_export_labeled_part, work_units, num_workers)
+
+
+def prepare_output_dir(output_dir, graph_iri: str = GRAPH_IRI):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / 'global.graph', 'w') as graph_file:
+        graph_file.write(graph_iri + '\n')
+    return output_dir
+
+
+def get_part_file(name, part, rdf_format: RdfFormat):
+    return f'{name}-{part:05d}.{rdf_format}.gz'
+
+
+# Formats all lines of a file in one comprehension over the label lists. This is about three times faster than
+# elementwise concatenation of object arrays or numpy's string ufuncs, which allocate an array per operand.
+def format_triples(subjects, predicates, objects, rdf_format: RdfFormat):
+    start, end = TERM_DELIMITERS[rdf_format]
+    return ''.join([
+        f'{start}{subject}{end} {start}{predicate}{end} {start}{obj}{end} .\n'
+        for subject, predicate, obj in zip(_to_list(subjects), _to_list(predicates), _to_list(objects))
+    ])
+
+
+def write_rdf_file(output_file, subjects, predicates, objects, rdf_format: RdfFormat):
+    text = format_triples(subjects, predicates, objects, rdf_format)
+
+    # Every file declares the prefix itself, since the files are loaded independently
+    if rdf_format == 'ttl':
+        text = f'@prefix wd: <{WIKIDATA_PREFIX}> .\n\n' + text
+    write_compressed_file(output_file, text)
+
+
+# Writes to a temporary file first, so that an existing output file is always complete
+def write_compressed_file(output_file, text):
+    output_file = Path(output_file)
+    temporary_file = output_file.with_name(f'{output_file.name}.tmp')
+    with gzip.open(temporary_file, 'wt', encoding='utf-8', compresslevel=COMPRESS_LEVEL) as file:
+        file.write(text)
+    os.replace(temporary_file, output_file)
+
+
+def _to_list(labels):
+    return labels.tolist() if isinstance(labels, np.ndarray) else list(labels)
+
+
+def _run_work_units(export_part, work_units, num_workers):
+    with get_context('spawn').Pool(processes=max(1, num_workers)) as pool:
+        for output_file in pool.imap_unordered(export_part, work_units):
+            print(f'[X] Finished {output_file.name}')
+
+
+def _export_store_part(work_unit):
+    store_dir, subset_type, start, end, output_file, rdf_format = work_unit
+    store = open_triple_store(store_dir)
+    triples = np.asarray(store[subset_type][:, start:end])
+
+    entity_labels, relation_labels = store['entity_labels'], store['relation_labels']
+    write_rdf_file(output_file, entity_labels[triples[S]], relation_labels[triples[P]], entity_labels[triples[O]],
+                   rdf_format)
+    return output_file
+
+
+def _export_labeled_part(work_unit):
+    chunk, output_file, rdf_format = work_unit
+    write_rdf_file(output_file, chunk['S'].to_numpy(), chunk['P'].to_numpy(), chunk['O'].to_numpy(), rdf_format)
+    return output_file
+
+
+if __name__ == '__main__':
+    main()
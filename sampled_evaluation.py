@@ -0,0 +1,238 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from filter_index import get_filter_pairs
+from filtered_ranking import RANK_SIDES
+from metric_aggregation import HITS_AT_K, RANK_TYPES, SIDES, aggregate_predicate_metrics
+from pipeline_trace import trace_stage
+from triple_store import O, P, S, get_mapped_triples
+
+# Entities are stratified by their degree in the training set at these quantiles, so that the few popular
+# entities, which tend to score high for many queries, are sampled as often as the long tail
+STRATUM_QUANTILES = [0.5, 0.9, 0.99]
+
+# Negative candidates that are sampled from every stratum per test triple and side
+NUM_SAMPLES = 64
+
+# Test triples that are added per relation and round, a relation stops once its intervals are tight enough
+ROUND_SIZE = 50
+
+NUM_BOOTSTRAP = 1000
+CONFIDENCE_LEVEL = 0.95
+
+# Largest half width of the confidence intervals of the stopping metrics, on the realistic ranks of both sides
+CI_TOLERANCE = 0.02
+STOPPING_METRICS = ['inverse_harmonic_mean_rank', 'hits_at_10']
+
+# Metrics with bootstrap confidence intervals, all of them are means over the ranks of the test triples
+INTERVAL_METRICS = ['arithmetic_mean_rank', 'inverse_harmonic_mean_rank'] + [f'hits_at_{k}' for k in HITS_AT_K]
+
+# Test triples that are scored against their sampled candidates at once
+BATCH_SIZE = 1024
+
+
+# Estimates the filtered ranks of the test triples from stratified samples of negative candidates and aggregates
+# them like compute_filtered_ranks. Test triples are ranked in rounds of ROUND_SIZE triples per relation until the
+# bootstrap confidence intervals of the relation's stopping metrics are narrower than tolerance or all of its
+# test triples are ranked. The metrics come with Lower and Upper bounds for INTERVAL_METRICS.
+def evaluate_sampled_predicate_metrics(model, store, filter_index, model_name, num_samples: int = NUM_SAMPLES,
+                                       tolerance: float = CI_TOLERANCE, round_size: int = ROUND_SIZE,
+                                       num_bootstrap: int = NUM_BOOTSTRAP, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    test_triples = get_mapped_triples(store, 'test')
+    strata = get_entity_strata(store)
+
+    ranks = {key: np.full(len(test_triples), np.nan) for key in _get_rank_keys()}
+    num_candidates = {side: np.zeros(len(test_triples), dtype=np.int64) for side in SIDES}
+    ranked = np.zeros(len(test_triples), dtype=bool)
+
+    # Test triples of every relation in random order
+    order = rng.permutation(len(test_triples))
+    order = order[np.argsort(test_triples[order, P], kind='stable')]
+    relations, starts = np.unique(test_triples[order, P], return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    active = np.ones(len(relations), dtype=bool)
+    positions = starts.copy()
+    round_index = 0
+    while active.any():
+        batch = np.concatenate([order[position:min(position + round_size, end)]
+                                for position, end in zip(positions[active], ends[active])])
+        positions[active] = np.minimum(positions[active] + round_size, ends[active])
+
+        batch_ranks, batch_candidates = estimate_filtered_ranks(model, test_triples[batch], filter_index, strata,
+                                                                num_samples, rng)
+        for key, value in batch_ranks.items():
+            ranks[key][batch] = value
+        for side, value in batch_candidates.items():
+            num_candidates[side][batch] = value
+        ranked[batch] = True
+
+        # Relations stop when all of their triples are ranked or their stopping intervals are tight enough
+        for index in np.flatnonzero(active):
+            if positions[index] >= ends[index]:
+                active[index] = False
+                continue
+            relation_triples = order[starts[index]:positions[index]]
+            intervals = bootstrap_confidence_intervals({key: value[relation_triples] for key, value in ranks.items()},
+                                                       STOPPING_METRICS, [('both', 'realistic')], num_bootstrap, rng)
+            active[index] = np.max(intervals[:, 1] - intervals[:, 0]) / 2 > tolerance
+
+        round_index += 1
+        print(f'[X] Round {round_index}: ranked {ranked.sum()} of {len(test_triples)} test triples, '
+              f'{active.sum()} of {len(relations)} relations still sampling')
+
+    relation_ids = test_triples[ranked, P]
+    predicate_metrics = aggregate_predicate_metrics(
+        relation_ids=relation_ids,
+        ranks={key: value[ranked] for key, value in ranks.items()},
+        num_candidates={side: value[ranked] for side, value in num_candidates.items()},
+        relation_labels=store['relation_labels'],
+        model_name=model_name
+    )
+
+    packs = [(side, rank_type) for rank_type in RANK_TYPES for side in SIDES + ['both']]
+    interval_rows = []
+    for relation_id in np.unique(relation_ids):
+        relation_triples = np.flatnonzero(ranked & (test_triples[:, P] == relation_id))
+        intervals = bootstrap_confidence_intervals({key: value[relation_triples] for key, value in ranks.items()},
+                                                   INTERVAL_METRICS, packs, num_bootstrap, rng)
+        interval_rows.append(pd.DataFrame({
+            'relation_id': relation_id,
+            'Side': np.tile([side for side, _ in packs], len(INTERVAL_METRICS)),
+            'Type': np.tile([rank_type for _, rank_type in packs], len(INTERVAL_METRICS)),
+            'Metric': np.repeat(INTERVAL_METRICS, len(packs)),
+            'Lower': intervals[:, 0],
+            'Upper': intervals[:, 1],
+        }))
+
+    return predicate_metrics.merge(pd.concat(interval_rows, ignore_index=True),
+                                   on=['relation_id', 'Side', 'Type', 'Metric'], how='left')
+
+
+# Degree strata of all entities, as entity ids sorted by stratum with the offsets of the strata
+def get_entity_strata(store, quantiles=STRATUM_QUANTILES):
+    train_triples = store['train']
+    num_entities = store['metadata']['num_entities']
+    degrees = (np.bincount(train_triples[S], minlength=num_entities)
+               + np.bincount(train_triples[O], minlength=num_entities))
+
+    # Ties of the many low degree entities can leave strata empty, which are dropped
+    stratum_codes = np.searchsorted(np.quantile(degrees, quantiles), degrees, side='right')
+    stratum_codes = np.unique(stratum_codes, return_inverse=True)[1].reshape(-1)
+
+    entities = np.argsort(stratum_codes, kind='stable')
+    sizes = np.bincount(stratum_codes)
+    return {
+        'codes': stratum_codes,
+        'entities': entities,
+        'offsets': np.concatenate([[0], np.cumsum(sizes)]),
+        'sizes': sizes,
+    }
+
+
+# Estimates the filtered optimistic, realistic and pessimistic ranks of (n, 3) mapped triples on both sides.
+# The number of candidates of a stratum that score higher than the true target is estimated as the share of
+# higher scoring samples among the unknown sampled candidates, times the number of unknown entities in the stratum.
+def estimate_filtered_ranks(model, mapped_triples, filter_index, strata, num_samples: int = NUM_SAMPLES, rng=None,
+                            batch_size: int = BATCH_SIZE):
+    rng = rng or np.random.default_rng()
+    mapped_triples = np.asarray(mapped_triples, dtype=np.int64)
+    num_entities = len(strata['codes'])
+    num_strata = len(strata['sizes'])
+
+    ranks = {key: [] for key in _get_rank_keys()}
+    num_candidates = {side: [] for side in SIDES}
+
+    model.eval()
+    with torch.inference_mode(), trace_stage('estimate_ranks', num_triples=len(mapped_triples), batch_size=batch_size):
+        for start in range(0, len(mapped_triples), batch_size):
+            batch = mapped_triples[start:start + batch_size]
+            hrt_batch = torch.as_tensor(batch, device=model.device)
+            true_scores = model.score_hrt(hrt_batch).view(-1, 1).cpu()
+
+            # The same candidates are used for both sides of a triple, num_samples per stratum
+            samples = rng.integers(0, strata['sizes'], size=(len(batch), num_samples, num_strata))
+            candidates = strata['entities'][strata['offsets'][:-1] + samples].reshape(len(batch), -1)
+            candidate_strata = np.tile(np.arange(num_strata), len(batch) * num_samples).reshape(len(batch), -1)
+            candidate_tensor = torch.as_tensor(candidates, device=model.device)
+
+            for side, column in RANK_SIDES.items():
+                if side == 'tail':
+                    scores = model.score_t(hrt_batch[:, :2], tails=candidate_tensor)
+                else:
+                    scores = model.score_h(hrt_batch[:, 1:], heads=candidate_tensor)
+                scores = scores.cpu()
+
+                # Known targets, including the true one, are neither candidates nor counted in the strata sizes
+                batch_indices, entity_ids = get_filter_pairs(filter_index, side, batch)
+                known_keys = batch_indices * num_entities + entity_ids
+                valid = ~np.isin(np.arange(len(batch))[:, None] * num_entities + candidates, known_keys)
+                known_counts = np.bincount(batch_indices * num_strata + strata['codes'][entity_ids],
+                                           minlength=len(batch) * num_strata).reshape(len(batch), num_strata)
+                stratum_candidates = strata['sizes'][None, :] - known_counts
+
+                higher = _count_per_stratum((scores > true_scores).numpy() & valid, candidate_strata, num_strata)
+                equal = _count_per_stratum((scores == true_scores).numpy() & valid, candidate_strata, num_strata)
+                sampled = _count_per_stratum(valid, candidate_strata, num_strata)
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    num_higher = np.sum(np.where(sampled > 0, stratum_candidates * higher / sampled, 0), axis=1)
+                    num_equal = np.sum(np.where(sampled > 0, stratum_candidates * equal / sampled, 0), axis=1)
+
+                # Same definitions as compute_filtered_ranks, the true target is counted once
+                optimistic = num_higher + 1
+                pessimistic = num_higher + num_equal + 1
+                ranks[side, 'optimistic'].append(optimistic)
+                ranks[side, 'pessimistic'].append(pessimistic)
+                ranks[side, 'realistic'].append(0.5 * (optimistic + pessimistic))
+                num_candidates[side].append(stratum_candidates.sum(axis=1) + 1)
+
+    return (
+        {key: np.concatenate(value) for key, value in ranks.items()},
+        {key: np.concatenate(value) for key, value in num_candidates.items()}
+    )
+
+
+# Percentile bootstrap intervals of rank means, resampling test triples with the head and tail ranks of a
+# triple kept together. Returns a (len(metrics) * len(packs), 2) array of lower and upper bounds, metric-major.
+def bootstrap_confidence_intervals(ranks, metrics, packs, num_bootstrap: int = NUM_BOOTSTRAP, rng=None,
+                                   confidence_level: float = CONFIDENCE_LEVEL):
+    rng = rng or np.random.default_rng()
+    num_triples = len(next(iter(ranks.values())))
+
+    # Per-triple values of every metric and pack, the mean of a column is the metric
+    columns = []
+    for metric_name in metrics:
+        for side, rank_type in packs:
+            sides = SIDES if side == 'both' else [side]
+            columns.append(np.mean([_get_rank_values(metric_name, ranks[s, rank_type]) for s in sides], axis=0))
+    values = np.stack(columns, axis=1)
+
+    # Resampling counts instead of indices keep the memory at num_bootstrap * num_triples
+    weights = rng.multinomial(num_triples, np.full(num_triples, 1 / num_triples), size=num_bootstrap)
+    estimates = weights @ values / num_triples
+
+    alpha = 1 - confidence_level
+    return np.quantile(estimates, [alpha / 2, 1 - alpha / 2], axis=0).T
+
+
+def _get_rank_values(metric_name, ranks):
+    if metric_name == 'arithmetic_mean_rank':
+        return ranks
+    if metric_name == 'inverse_harmonic_mean_rank':
+        return 1.0 / ranks
+    if metric_name.startswith('hits_at_'):
+        return (ranks <= int(metric_name.split('_')[-1])).astype(float)
+    raise ValueError(f'No bootstrap interval for metric {metric_name}')
+
+
+def _get_rank_keys():
+    return [(side, rank_type) for side in SIDES for rank_type in RANK_TYPES]
+
+
+def _count_per_stratum(mask, candidate_strata, num_strata):
+    rows = np.repeat(np.arange(len(mask)), mask.shape[1]).reshape(mask.shape)
+    return np.bincount((rows * num_strata + candidate_strata)[mask], minlength=len(mask) * num_strata) \
+        .reshape(len(mask), num_strata)
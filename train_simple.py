@@ -4,18 +4,33 @@ from datetime import timedelta
 from pykeen.pipeline import pipeline
 from pykeen.datasets import Wikidata5M
 
+from pipeline_trace import run_trace, trace_stage
+
 
 def main():
     start = timer()
 
-    pipeline_result = pipeline(
-        dataset=Wikidata5M,
-        model='SimplE',
-        model_kwargs={
-            'embedding_dim': 32
-        }
-    )
-    pipeline_result.save_to_directory('embeddings/dim_32/simple')
+    # The profiler is selected with $KGE_PROFILER, the trace is written next to the saved model
+    with run_trace('train_simple', ['embeddings/dim_32/simple']):
+        with trace_stage('load_dataset') as stage:
+            dataset = Wikidata5M()
+            stage['num_triples'] = dataset.training.num_triples
+
+        with trace_stage('train') as stage:
+            pipeline_result = pipeline(
+                dataset=dataset,
+                model='SimplE',
+                model_kwargs={
+                    'embedding_dim': 32
+                }
+            )
+            # The pipeline evaluates the model on the test triples after training
+            stage['num_triples'] = dataset.training.num_triples * len(pipeline_result.losses)
+            stage['train_seconds'] = pipeline_result.train_seconds
+            stage['evaluate_seconds'] = pipeline_result.evaluate_seconds
+
+        with trace_stage('save'):
+            pipeline_result.save_to_directory('embeddings/dim_32/simple')
 
     end = timer()
     print(f'Time elapsed: {timedelta(seconds=end - start)}')
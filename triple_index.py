@@ -0,0 +1,124 @@
+from pathlib import Path
+
+import numpy as np
+
+from triple_store import O, P, S, SUBSET_TYPES, STORE_FACTORIES, SubsetType, is_triple_store, open_triple_store
+
+# Sort orders of the permutation indexes as column sequences. The sorted triples
+# keep the S, P, O row layout of the store, only their order differs.
+INDEX_ORDERS = {
+    'spo': (S, P, O),
+    'pos': (P, O, S),
+    'osp': (O, S, P),
+}
+
+
+def main():
+    for store_dir in STORE_FACTORIES:
+        if not is_triple_store(store_dir):
+            print(f'[X] Skipping {store_dir}, no triple store found')
+            continue
+
+        store = open_triple_store(store_dir)
+        for subset_type in SUBSET_TYPES:
+            print(f'[X] Building SPO, POS and OSP indexes for {subset_type} triples in {store_dir}')
+            build_triple_index(store_dir, store, subset_type)
+
+
+def build_triple_index(store_dir, store, subset_type: SubsetType):
+    index_dir = Path(store_dir) / 'index'
+    index_dir.mkdir(exist_ok=True)
+
+    triples = np.asarray(store[subset_type])
+    num_keys = {
+        S: store['metadata']['num_entities'],
+        P: store['metadata']['num_relations'],
+        O: store['metadata']['num_entities'],
+    }
+
+    for order_name, (first, second, third) in INDEX_ORDERS.items():
+        # np.lexsort sorts by the last key first
+        permutation = np.lexsort((triples[third], triples[second], triples[first]))
+        sorted_triples = triples[:, permutation]
+
+        # offsets[k]:offsets[k + 1] is the range of triples whose first column equals k
+        offsets = np.zeros(num_keys[first] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sorted_triples[first], minlength=num_keys[first]), out=offsets[1:])
+
+        np.save(index_dir / f'{subset_type}_{order_name}.npy', sorted_triples)
+        np.save(index_dir / f'{subset_type}_{order_name}_offsets.npy', offsets)
+
+
+def is_triple_index(store_dir, subset_type: SubsetType = 'train'):
+    return (Path(store_dir) / 'index' / f'{subset_type}_osp_offsets.npy').exists()
+
+
+def open_triple_index(store_dir, subset_type: SubsetType = 'train'):
+    index_dir = Path(store_dir) / 'index'
+    return {
+        order_name: {
+            'triples': np.load(index_dir / f'{subset_type}_{order_name}.npy', mmap_mode='r'),
+            'offsets': np.load(index_dir / f'{subset_type}_{order_name}_offsets.npy', mmap_mode='r')
+        }
+        for order_name in INDEX_ORDERS
+    }
+
+
+# Unbound pattern positions are given as None, matching triples are returned as (3, k) array
+def find_triples(index, s=None, p=None, o=None):
+    order_name, start, end = _find_range(index, s, p, o)
+    return index[order_name]['triples'][:, start:end]
+
+
+def count_triples(index, s=None, p=None, o=None):
+    _, start, end = _find_range(index, s, p, o)
+    return end - start
+
+
+def sample_triple(index, s=None, p=None, o=None, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+
+    order_name, start, end = _find_range(index, s, p, o)
+    if start == end:
+        return None
+
+    return tuple(int(x) for x in index[order_name]['triples'][:, rng.integers(start, end)])
+
+
+def _find_range(index, s, p, o):
+    bound = {S: s, P: p, O: o}
+
+    # Pick the sort order whose key prefix consists of the bound positions
+    if s is not None and p is None and o is not None:
+        order_name = 'osp'
+    elif s is not None:
+        order_name = 'spo'
+    elif p is not None:
+        order_name = 'pos'
+    elif o is not None:
+        order_name = 'osp'
+    else:
+        return 'spo', 0, index['spo']['triples'].shape[1]
+
+    triples = index[order_name]['triples']
+    offsets = index[order_name]['offsets']
+    first, second, third = INDEX_ORDERS[order_name]
+
+    key = bound[first]
+    if key < 0 or key >= len(offsets) - 1:
+        return order_name, 0, 0
+    start, end = int(offsets[key]), int(offsets[key + 1])
+
+    # Narrow down the range by binary search on the following sorted columns
+    for column in (second, third):
+        if bound[column] is None:
+            break
+        values = triples[column, start:end]
+        start, end = (start + int(np.searchsorted(values, bound[column], side='left')),
+                      start + int(np.searchsorted(values, bound[column], side='right')))
+
+    return order_name, start, end
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+from pykeen.triples import TriplesFactory
+
+from pipeline_trace import run_trace, trace_stage
+
+SubsetType = Literal['train', 'valid', 'test']
+
+SUBSET_TYPES: list[SubsetType] = ['train', 'valid', 'test']
+
+# Columns of the store arrays, each subset is saved as a (3, num_triples) int32 array
+# so that every column is contiguous on disk
+S, P, O = 0, 1, 2
+
+# Store directories and the triples factories whose entity and relation ids they reuse.
+# The dim 32 models share the PyKEEN Wikidata5M mapping, the dim 512 models the GraphVite one.
+STORE_FACTORIES = {
+    'dataset/wikidata5m/store/dim_32': 'embeddings/dim_32/complex/training_triples',
+    'dataset/wikidata5m/store/dim_512': 'embeddings/dim_512/complex/training_factory',
+}
+
+CHUNK_SIZE = 1_000_000
+
+
+def main():
+    for store_dir, factory_path in STORE_FACTORIES.items():
+        if not Path(factory_path).exists():
+            print(f'[X] Skipping {store_dir}, no triples factory found at {factory_path}')
+            continue
+
+        # The trace is written next to the metadata of the store
+        with run_trace('triple_store', [store_dir]):
+            print(f'[X] Loading entity and relation mappings from {factory_path}')
+            with trace_stage('load_factory'):
+                train_factory = TriplesFactory.from_path_binary(factory_path)
+
+            build_triple_store(store_dir, train_factory.entity_to_id, train_factory.relation_to_id)
+
+
+def get_store_dir(embedding_dim: int, root: str = '.'):
+    return str(Path(root) / f'dataset/wikidata5m/store/dim_{embedding_dim}')
+
+
+def build_triple_store(store_dir, entity_to_id, relation_to_id, dataset_dir='dataset/wikidata5m'):
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    # The metadata marks a complete store, a store that is ingested again is incomplete until it is written
+    (store_dir / 'metadata.json').unlink(missing_ok=True)
+
+    entity_labels = _labels_by_id(entity_to_id)
+    relation_labels = _labels_by_id(relation_to_id)
+
+    print(f'[X] Saving {len(entity_labels)} entity and {len(relation_labels)} relation labels to {store_dir}')
+    np.save(store_dir / 'entity_labels.npy', entity_labels)
+    np.save(store_dir / 'relation_labels.npy', relation_labels)
+    _save_label_order(store_dir, 'entity', entity_labels)
+    _save_label_order(store_dir, 'relation', relation_labels)
+
+    entity_index = pd.Index(entity_labels)
+    relation_index = pd.Index(relation_labels)
+
+    num_triples = {}
+    fingerprints = {}
+    for subset_type in SUBSET_TYPES:
+        subset_file = Path(dataset_dir) / f'wikidata5m_transductive_{subset_type}.txt'
+        print(f'[X] Interning {subset_type} triples from {subset_file}')
+
+        with trace_stage(f'intern_{subset_type}') as stage:
+            triples = _intern_triples(subset_file, entity_index, relation_index)
+            np.save(store_dir / f'{subset_type}.npy', triples)
+            num_triples[subset_type] = stage['num_triples'] = triples.shape[1]
+            fingerprints[subset_type] = hashlib.sha256(triples.tobytes()).hexdigest()
+
+    metadata = {
+        'num_entities': len(entity_labels),
+        'num_relations': len(relation_labels),
+        'num_triples': num_triples,
+        # Indexes derived from the store, like the filter index, compare these to detect a store ingested again
+        'fingerprints': fingerprints,
+    }
+    with open(store_dir / 'metadata.json', 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+
+def _labels_by_id(label_to_id):
+    labels = np.empty(len(label_to_id), dtype=object)
+    for label, index in label_to_id.items():
+        labels[index] = label
+    return labels.astype(str)
+
+
+def _save_label_order(store_dir, name, labels):
+    # Sorted labels allow label to id lookups by binary search directly on the memory map
+    order = np.argsort(labels).astype(np.int32)
+    np.save(store_dir / f'{name}_label_order.npy', order)
+    np.save(store_dir / f'{name}_labels_sorted.npy', labels[order])
+
+
+def _intern_triples(subset_file, entity_index, relation_index):
+    columns = []
+    num_dropped = 0
+    for chunk in pd.read_csv(subset_file, sep='\t', names=['S', 'P', 'O'], dtype=str, chunksize=CHUNK_SIZE):
+        ids = np.stack([
+            entity_index.get_indexer(chunk['S']),
+            relation_index.get_indexer(chunk['P']),
+            entity_index.get_indexer(chunk['O'])
+        ])
+
+        # Drop triples with labels unknown to the mapping, like TriplesFactory.map_triples does
+        known = (ids >= 0).all(axis=0)
+        num_dropped += int((~known).sum())
+        columns.append(ids[:, known].astype(np.int32))
+
+    if num_dropped > 0:
+        print(f'[X] Dropped {num_dropped} triples with unknown entities or relations from {subset_file}')
+
+    return np.concatenate(columns, axis=1) if columns else np.empty((3, 0), dtype=np.int32)
+
+
+def is_triple_store(store_dir):
+    return (Path(store_dir) / 'metadata.json').exists()
+
+
+def open_triple_store(store_dir):
+    store_dir = Path(store_dir)
+    with open(store_dir / 'metadata.json') as metadata_file:
+        metadata = json.load(metadata_file)
+
+    store = {
+        'metadata': metadata,
+        'entity_labels': np.load(store_dir / 'entity_labels.npy', mmap_mode='r'),
+        'relation_labels': np.load(store_dir / 'relation_labels.npy', mmap_mode='r'),
+        'entity_label_order': np.load(store_dir / 'entity_label_order.npy', mmap_mode='r'),
+        'relation_label_order': np.load(store_dir / 'relation_label_order.npy', mmap_mode='r'),
+        'entity_labels_sorted': np.load(store_dir / 'entity_labels_sorted.npy', mmap_mode='r'),
+        'relation_labels_sorted': np.load(store_dir / 'relation_labels_sorted.npy', mmap_mode='r'),
+    }
+    for subset_type in SUBSET_TYPES:
+        store[subset_type] = np.load(store_dir / f'{subset_type}.npy', mmap_mode='r')
+
+    return store
+
+
+def get_mapped_triples(store, subset_type: SubsetType):
+    # Row-major (num_triples, 3) int64 array, as expected by PyKEEN's mapped_triples
+    return np.ascontiguousarray(store[subset_type].T, dtype=np.int64)
+
+
+def get_labeled_triples(store, subset_type: SubsetType):
+    triples = store[subset_type]
+    return pd.DataFrame({
+        'S': store['entity_labels'][triples[S]],
+        'P': store['relation_labels'][triples[P]],
+        'O': store['entity_labels'][triples[O]]
+    })
+
+
+def get_triple_labels(store, triple):
+    s, p, o = triple
+    return str(store['entity_labels'][s]), str(store['relation_labels'][p]), str(store['entity_labels'][o])
+
+
+def map_entity_labels(store, labels):
+    return _map_labels(store['entity_labels_sorted'], store['entity_label_order'], labels)
+
+
+def map_relation_labels(store, labels):
+    return _map_labels(store['relation_labels_sorted'], store['relation_label_order'], labels)
+
+
+def _map_labels(sorted_labels, label_order, labels):
+    labels = np.asarray(labels, dtype=str)
+    positions = np.searchsorted(sorted_labels, labels).clip(max=len(sorted_labels) - 1)
+    ids = np.asarray(label_order[positions], dtype=np.int64)
+
+    # Unknown labels are mapped to -1
+    ids[sorted_labels[positions] != labels] = -1
+    return ids
+
+
+if __name__ == '__main__':
+    main()
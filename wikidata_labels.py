@@ -0,0 +1,178 @@
+import sqlite3
+import time
+from pathlib import Path
+
+import requests
+
+LABEL_DB = 'dataset/wikidata5m/labels.sqlite'
+
+# Alias files of the Wikidata5M dump, every line holds an id followed by its tab separated aliases,
+# the first alias is used as label
+ALIAS_FILES = [
+    'dataset/wikidata5m/wikidata5m_alias/wikidata5m_entity.txt',
+    'dataset/wikidata5m/wikidata5m_alias/wikidata5m_relation.txt',
+]
+
+WIKIDATA_API = 'https://www.wikidata.org/w/api.php'
+
+# Maximum number of ids per wbgetentities request
+WIKIDATA_API_LIMIT = 50
+
+# Seconds until a wbgetentities request is given up
+WIKIDATA_API_TIMEOUT = 30
+
+# Label of ids that were fetched without a label, so that they expire like fetched labels. The alias files
+# never contain empty labels.
+MISSING_LABEL = ''
+
+# Seconds after which labels fetched from the remote API are fetched again, labels of the dump never expire
+LABEL_EXPIRY = 30 * 24 * 60 * 60
+
+# Maximum number of host parameters per SQLite statement
+SQLITE_CHUNK_SIZE = 500
+
+CHUNK_SIZE = 1_000_000
+
+
+def main():
+    build_label_index(LABEL_DB, ALIAS_FILES)
+
+    label_index = open_label_index(LABEL_DB)
+    print(get_labels(label_index, ['Q1236794', 'P31', 'P106']))
+
+
+def build_label_index(db_file=LABEL_DB, alias_files=ALIAS_FILES):
+    Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+    connection = _connect(db_file)
+
+    with connection:
+        for alias_file in alias_files:
+            if not Path(alias_file).exists():
+                print(f'[X] Skipping {alias_file}, alias file not found')
+                continue
+
+            print(f'[X] Loading labels from {alias_file}')
+            num_labels = 0
+            for chunk in _read_first_aliases(alias_file):
+                connection.executemany(
+                    'INSERT OR REPLACE INTO labels (id, label, fetched_at) VALUES (?, ?, NULL)', chunk
+                )
+                num_labels += len(chunk)
+            print(f'[X] Saved {num_labels} labels to {db_file}')
+
+    connection.close()
+
+
+# The fetcher is called with the ids missing from the index (or expired) and returns a dict from id to label,
+# pass fetcher=None to resolve labels offline only
+def open_label_index(db_file=LABEL_DB, fetcher=None, expiry: int = LABEL_EXPIRY):
+    # Fetched labels are cached in a new index on checkouts without the dataset directory
+    Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+    return {
+        'connection': _connect(db_file),
+        'fetcher': fetcher,
+        'expiry': expiry,
+        'labels': {},
+    }
+
+
+# Resolves all ids with one query per chunk of ids, ids that can neither be found nor fetched keep their id as label.
+# If fetching fails, expired labels are used until the next call fetches them again.
+def get_labels(label_index, ids):
+    ids = [str(entity_id) for entity_id in ids]
+    labels = label_index['labels']
+
+    missing = list(dict.fromkeys(entity_id for entity_id in ids if entity_id not in labels))
+    if missing:
+        expired_before = time.time() - label_index['expiry']
+        unresolved = set(missing)
+        expired = {}
+
+        connection = label_index['connection']
+        for start in range(0, len(missing), SQLITE_CHUNK_SIZE):
+            chunk = missing[start:start + SQLITE_CHUNK_SIZE]
+            rows = connection.execute(
+                f'SELECT id, label, fetched_at FROM labels WHERE id IN ({",".join("?" * len(chunk))})', chunk
+            )
+            for entity_id, label, fetched_at in rows:
+                label = entity_id if label == MISSING_LABEL else label
+                if fetched_at is None or fetched_at >= expired_before or label_index['fetcher'] is None:
+                    labels[entity_id] = label
+                    unresolved.discard(entity_id)
+                else:
+                    expired[entity_id] = label
+
+        if unresolved and label_index['fetcher'] is not None:
+            try:
+                fetched = label_index['fetcher'](sorted(unresolved))
+            except requests.RequestException as error:
+                print(f'[X] Fetching {len(unresolved)} labels failed, using expired labels: {error}')
+                return [labels.get(entity_id, expired.get(entity_id, entity_id)) for entity_id in ids]
+
+            save_fetched_labels(label_index, fetched, missing_ids=unresolved.difference(fetched))
+            labels.update(fetched)
+            labels.update({entity_id: entity_id for entity_id in unresolved.difference(fetched)})
+
+    return [labels.get(entity_id, entity_id) for entity_id in ids]
+
+
+# Ids that were fetched without a label are saved as MISSING_LABEL, so that they are only fetched again once expired
+def save_fetched_labels(label_index, fetched_labels, missing_ids=()):
+    connection = label_index['connection']
+    fetched_at = time.time()
+    rows = [(entity_id, label, fetched_at) for entity_id, label in fetched_labels.items()]
+    rows += [(entity_id, MISSING_LABEL, fetched_at) for entity_id in sorted(missing_ids)]
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO labels (id, label, fetched_at) VALUES (?, ?, ?)', rows)
+
+
+# Remote fetcher for open_label_index, ids without an English label are left out
+def fetch_wikidata_labels(ids, language='en'):
+    fetched_labels = {}
+    for start in range(0, len(ids), WIKIDATA_API_LIMIT):
+        params = {
+            'action': 'wbgetentities',
+            'ids': '|'.join(ids[start:start + WIKIDATA_API_LIMIT]),
+            'languages': language,
+            'props': 'labels',
+            'format': 'json'
+        }
+        response = requests.get(WIKIDATA_API, params, timeout=WIKIDATA_API_TIMEOUT)
+        response.raise_for_status()
+        response = response.json()
+
+        for entity_id, entity in response.get('entities', {}).items():
+            label = entity.get('labels', {}).get(language)
+            if label is not None:
+                fetched_labels[entity_id] = label['value']
+
+    return fetched_labels
+
+
+def _connect(db_file):
+    connection = sqlite3.connect(db_file)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS labels (id TEXT PRIMARY KEY, label TEXT NOT NULL, fetched_at REAL) WITHOUT ROWID'
+    )
+    return connection
+
+
+def _read_first_aliases(alias_file):
+    # Lines have a varying number of aliases, so only the id and the first alias are split off
+    chunk = []
+    with open(alias_file, encoding='utf-8') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t', 2)
+            if len(fields) >= 2 and fields[1]:
+                chunk.append((fields[0], fields[1]))
+
+            if len(chunk) == CHUNK_SIZE:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+
+if __name__ == '__main__':
+    main()